@@ -0,0 +1,84 @@
+"""
+Startup time of the command line, and of importing the modules behind it.
+
+Every case runs in a fresh interpreter, so nothing is imported beforehand:
+
+    PYTHONPATH=. python benchmarks/import_time.py
+    PYTHONPATH=. python benchmarks/import_time.py --repeat 10 --importtime
+
+`--importtime` also prints the slowest imports of `python -m opendatabo --help`, as reported by
+`python -X importtime`.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+CASES = [
+    ('python', ['-c', 'pass']),
+    ('import opendatabo.cli', ['-c', 'import opendatabo.cli']),
+    ('opendatabo --help', ['-m', 'opendatabo', '--help']),
+    ('opendatabo export-sic --help', ['-m', 'opendatabo', 'export-sic', '--help']),
+    ('import opendatabo.sic', ['-c', 'import opendatabo.sic']),
+    ('import opendatabo.cruzero', ['-c', 'import opendatabo.cruzero']),
+]
+
+HEAVY_MODULES = ['pandas', 'numpy', 'requests', 'ckanapi', 'structlog', 'geojson']
+
+
+def _env() -> dict:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in [ROOT, env.get('PYTHONPATH')] if p)
+    return env
+
+
+def measure(args, repeat: int) -> float:
+    """Best wall time of `repeat` fresh interpreters running `args`."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, check=True, env=_env())
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def loaded_heavy_modules(code: str) -> list:
+    script = '{}\nimport sys\nprint(" ".join(m for m in {!r} if m in sys.modules))'.format(code, HEAVY_MODULES)
+    out = subprocess.run([sys.executable, '-c', script], stdout=subprocess.PIPE, check=True, env=_env())
+    return out.stdout.decode().split()
+
+
+def slowest_imports(args, n: int = 15) -> list:
+    """The `n` imports with the largest cumulative time, in microseconds."""
+    out = subprocess.run([sys.executable, '-X', 'importtime'] + args, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE, check=True, env=_env())
+    rows = []
+    for line in out.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:n]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the startup time of the command line')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per case, the best one is reported')
+    parser.add_argument('--importtime', action='store_true', help='Also print the slowest imports of --help')
+    args = parser.parse_args()
+
+    print('{:<32} {:>10}'.format('case', 'ms'))
+    for name, case_args in CASES:
+        print('{:<32} {:>10.1f}'.format(name, measure(case_args, args.repeat) * 1000))
+
+    print()
+    print('heavy modules loaded by `import opendatabo.cli`: {}'.format(
+        ', '.join(loaded_heavy_modules('import opendatabo.cli')) or 'none'))
+
+    if args.importtime:
+        print()
+        for cumulative, name in slowest_imports(['-m', 'opendatabo', '--help']):
+            print('{:>10} us  {}'.format(cumulative, name))
@@ -0,0 +1,169 @@
+"""
+Throughput and peak memory benchmarks for the fetch, parse and serialize paths.
+
+Everything runs offline against the local fixture server, on synthetic data of several sizes. Results can
+be saved as a baseline and later runs compared against it:
+
+    PYTHONPATH=. python benchmarks/run.py --save benchmarks/baseline.json
+    PYTHONPATH=. python benchmarks/run.py --baseline benchmarks/baseline.json
+
+The comparison exits with status 1 when any case got slower (or hungrier) than the allowed tolerance.
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+
+from fixture_server import FixtureServer, synthetic_market_prices_csv, synthetic_bus_line_json  # noqa: E402
+
+from opendatabo import cruzero, sic  # noqa: E402
+from opendatabo.cruzero import BusLine, get_bus_line, bus_lines_to_geojson  # noqa: E402
+from opendatabo.sic import City, Year, get_market_prices, prepare_raw_market_prices, parse_column_units  # noqa: E402
+from opendatabo.parallel import MarketPricesParser  # noqa: E402
+from opendatabo.routing import TransferGraph  # noqa: E402
+from opendatabo.tiles import render_tiles  # noqa: E402
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+def measure(func, repeat: int = 3) -> dict:
+    """Best wall time out of `repeat` runs, and the peak traced memory of one run."""
+    best = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'seconds': best, 'peak_bytes': peak}
+
+
+def _bus_lines(n_lines: int, points: int):
+    rng = np.random.RandomState(0)
+    lines = []
+    for i in range(n_lines):
+        coords = np.array([-63.18, -17.78]) + np.cumsum(rng.uniform(-0.0005, 0.0005, size=(points, 2)), axis=0)
+        lines.append(BusLine(i, 'Linea {}'.format(i), Decimal('18.5'), Decimal('21.3'), Decimal('75'),
+                             coords=coords.round(7)))
+    return lines
+
+
+def run_cases(server: FixtureServer, size: int, repeat: int):
+    csv = synthetic_market_prices_csv(size)
+    server.add('/sic/pref_sc_2010_ano_export.php', csv, content_type='text/csv')
+
+    raw_df = pd.read_csv(io.StringIO(csv))
+    prices = raw_df['Precio Mayorista']
+
+    # The same number of route points, spread over lines of 1000 points each
+    points = size
+    server.add('/cruzero/lineasbuses/json_rutas?lbsId=1', synthetic_bus_line_json(1, points),
+               content_type='application/json')
+    lines = _bus_lines(max(1, size // 1000), min(size, 1000))
+
+    yield 'get_market_prices', size, measure(lambda: get_market_prices(City.SANTA_CRUZ, Year(2010)), repeat)
+    yield 'prepare_raw_market_prices', size, measure(lambda: prepare_raw_market_prices(raw_df), repeat)
+    yield 'prepare_compact', size, measure(lambda: prepare_raw_market_prices(raw_df, compact=True), repeat)
+
+    payload = csv.encode('utf-8')
+    with MarketPricesParser(chunk_size=max(1, len(payload) // (os.cpu_count() or 1))) as parser:
+        parser.parse(payload)  # Start the workers outside of the timings
+        yield 'parse_parallel', size, measure(lambda: parser.parse(payload), repeat)
+
+    yield 'parse_serial', size, measure(lambda: prepare_raw_market_prices(pd.read_csv(io.BytesIO(payload))), repeat)
+    yield 'parse_column_units', size, measure(lambda: parse_column_units(prices), repeat)
+    yield 'get_bus_line', points, measure(lambda: get_bus_line(1), repeat)
+    yield 'bus_lines_to_geojson', points, measure(lambda: bus_lines_to_geojson(lines), repeat)
+    yield 'render_tiles', points, measure(lambda: list(render_tiles(lines, processes=1)), repeat)
+
+    graph = TransferGraph.build(lines)
+    rng = np.random.RandomState(1)
+    ends = lines[0].coords[rng.randint(len(lines[0].coords), size=(2, 100))][..., ::-1]
+    yield 'build_transfer_graph', points, measure(lambda: TransferGraph.build(lines), repeat)
+    yield 'plan_many', points, measure(lambda: graph.plan_many(np.repeat(ends[0][:10], 10, axis=0), ends[1]), repeat)
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        for metric in ('seconds', 'peak_bytes'):
+            before, after = baseline[key][metric], result[metric]
+            if before > 0 and after > before * (1 + tolerance):
+                regressions.append((key, metric, before, after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the fetch, parse and serialize paths')
+
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Synthetic data sizes, in rows or route points')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Timed runs per case; the best one is kept')
+    parser.add_argument('--save', type=str,
+                        help='Write the results to this JSON file, to serve as a baseline')
+    parser.add_argument('--baseline', type=str,
+                        help='Compare the results with a previously saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed relative slowdown or memory growth before a case counts as a regression')
+
+    args = parser.parse_args()
+
+    results = {}
+
+    with FixtureServer() as server:
+        sic.SIC_URL = server.url + '/sic'
+        cruzero.CRUZERO_URL = server.url + '/cruzero'
+
+        print('{:<28} {:>8} {:>12} {:>14} {:>12}'.format('case', 'size', 'seconds', 'items/s', 'peak MiB'))
+
+        for size in args.sizes:
+            for name, items, result in run_cases(server, size, args.repeat):
+                result['items_per_second'] = items / result['seconds']
+                results['{}[{}]'.format(name, size)] = result
+
+                print('{:<28} {:>8} {:>12.4f} {:>14,.0f} {:>12.2f}'.format(
+                    name, size, result['seconds'], result['items_per_second'], result['peak_bytes'] / 2 ** 20))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, args.tolerance)
+
+        for key, metric, before, after in regressions:
+            print('REGRESSION {} {}: {:.4g} -> {:.4g} ({:+.0%})'.format(key, metric, before, after,
+                                                                      after / before - 1))
+
+        if regressions:
+            sys.exit(1)
+
+        print('no regressions against {}'.format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
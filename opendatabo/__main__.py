@@ -0,0 +1,3 @@
+from opendatabo.cli import main
+
+main()
@@ -0,0 +1,259 @@
+import datetime
+from typing import Optional, Iterable, List
+
+import pandas as pd
+
+from opendatabo import metrics
+from opendatabo.cache import hash_content
+from opendatabo.sic import City
+from opendatabo.store import PriceStore, restore_variedad
+
+SIDES = ['mayorista', 'minorista']
+
+SERIES_COLUMNS = ['period', 'city', 'producto', 'variedad', 'side', 'basis']
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS price_aggregates (
+    period TEXT NOT NULL,
+    producto TEXT NOT NULL,
+    variedad TEXT NOT NULL,
+    city TEXT NOT NULL,
+    side TEXT NOT NULL,
+    basis TEXT NOT NULL,
+    period_start TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    total REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    rolling_mean REAL,
+    PRIMARY KEY (period, producto, variedad, city, side, basis, period_start)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS price_aggregates_by_city ON price_aggregates (period, city, period_start);
+
+CREATE TABLE IF NOT EXISTS ingested_frames (
+    city TEXT NOT NULL,
+    source TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (city, source)
+) WITHOUT ROWID;
+'''
+
+
+class Period:
+    """A calendar resampling period, as SQLite date expressions over ISO date strings."""
+
+    def __init__(self, code: str, bucket: str, last_day: str, step: str, step_size: int, rolling: int):
+        self.code = code
+        self._bucket = bucket
+        self._last_day = last_day
+        self._step = step
+        self._step_size = step_size
+        self.rolling = rolling
+
+    def bucket(self, x: str) -> str:
+        """First day of the period containing the date `x`."""
+        return self._bucket.format(x)
+
+    def last_day(self, x: str) -> str:
+        """Last day of the period starting on `x`."""
+        return self._last_day.format(x)
+
+    def shift(self, x: str, n: int) -> str:
+        """Start of the period `n` periods after the one starting on `x`."""
+        return "date({}, '{:+d} {}')".format(x, n * self._step_size, self._step)
+
+
+WEEKLY = Period('W', "date({}, '-6 days', 'weekday 1')", "date({}, '+6 days')", 'days', 7, rolling=4)
+MONTHLY = Period('M', "date({}, 'start of month')", "date({}, '+1 month', '-1 day')", 'months', 1, rolling=3)
+
+PERIODS = {p.code: p for p in [WEEKLY, MONTHLY]}
+
+
+def _price(side: str) -> str:
+    # Compare like with like: per kg for weights, per piece for counts, else per one of the quoted unit
+    return ('CASE WHEN precio_{0}_per_kg IS NOT NULL THEN precio_{0}_per_kg '
+            'WHEN precio_{0}_per_unit IS NOT NULL THEN precio_{0}_per_unit '
+            'ELSE precio_{0}_val / precio_{0}_unit_val END').format(side)
+
+
+def _basis(side: str) -> str:
+    return ("CASE WHEN precio_{0}_per_kg IS NOT NULL THEN 'kg' "
+            "WHEN precio_{0}_per_unit IS NOT NULL THEN 'unit' "
+            "ELSE precio_{0}_unit_name END").format(side)
+
+
+class PriceAggregates:
+    """
+    Weekly and monthly count/mean/min/max of the prices in a `PriceStore`, per city, product, variety and
+    side (wholesale or retail), kept next to the prices in the same database.
+
+    Prices are compared on a common basis: per kg, per piece, or per one of the quoted unit otherwise.
+    `rolling_mean` is the mean over the last `Period.rolling` periods, the period itself included.
+
+    Ingesting rows only recomputes the periods they fall in (and the rolling means that depend on them),
+    so keeping up with new `Today` or current-year data never rescans history. Frames ingested with a
+    `source` are skipped when their content is the same as last time.
+    """
+
+    def __init__(self, store: PriceStore, periods: Iterable[Period] = (WEEKLY, MONTHLY)):
+        self.store = store
+        self.periods = list(periods)
+
+        with store.transaction() as conn:
+            conn.executescript(_SCHEMA)
+
+    def ingest(self, city: City, df: pd.DataFrame, source: Optional[str] = None) -> int:
+        """
+        Upsert a prepared frame into the store and bring the aggregates it affects up to date. With a `source`
+        naming where the frame comes from (e.g. a year), a frame identical to the one last ingested from it
+        is skipped and 0 returned.
+        """
+        digest = None
+        if source is not None:
+            digest = hash_content(df.sort_index().to_csv().encode('utf-8'))
+            if digest == self._digest(city, source):
+                metrics.incr('aggregates.unchanged')
+                return 0
+
+        n = self.store.upsert(city, df)
+
+        if n:
+            fechas = df.index.get_level_values('fecha')
+            self.refresh(city, min(fechas), max(fechas))
+
+        # Recorded last, so a frame whose refresh failed is ingested again next time
+        if digest is not None:
+            with self.store.transaction() as conn:
+                conn.execute('INSERT OR REPLACE INTO ingested_frames (city, source, sha256) VALUES (?, ?, ?)',
+                             [city.value, source, digest])
+
+        return n
+
+    def _digest(self, city: City, source: str) -> Optional[str]:
+        with self.store.transaction() as conn:
+            row = conn.execute('SELECT sha256 FROM ingested_frames WHERE city = ? AND source = ?',
+                               [city.value, source]).fetchone()
+        return None if row is None else row[0]
+
+    def refresh(self, city: City, start: datetime.date, end: datetime.date) -> None:
+        """Recompute the aggregates of `city` for every period overlapping `start`..`end`."""
+        start, end = start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+        with metrics.stage('aggregates.refresh'):
+            with self.store.transaction() as conn:
+                for period in self.periods:
+                    self._refresh_period(conn, period, city.value, start, end)
+
+    def _refresh_period(self, conn, period: Period, city: str, start: str, end: str) -> None:
+        lo, hi = conn.execute('SELECT {}, {}'.format(period.bucket('?'), period.bucket('?')), [start, end]).fetchone()
+        last_day = conn.execute('SELECT {}'.format(period.last_day('?')), [hi]).fetchone()[0]
+
+        conn.execute('DELETE FROM price_aggregates WHERE period = ? AND city = ? AND period_start BETWEEN ? AND ?',
+                     [period.code, city, lo, hi])
+
+        for side in SIDES:
+            conn.execute('''
+                INSERT INTO price_aggregates
+                    (period, producto, variedad, city, side, basis, period_start, count, total, min, max)
+                SELECT ?, producto, variedad, city, ?, basis, {bucket}, COUNT(*), SUM(price), MIN(price), MAX(price)
+                FROM (SELECT producto, variedad, city, fecha, {price} AS price, {basis} AS basis
+                      FROM prices
+                      WHERE city = ? AND fecha BETWEEN ? AND ?)
+                WHERE price IS NOT NULL AND basis IS NOT NULL
+                GROUP BY producto, variedad, basis, {bucket}
+            '''.format(bucket=period.bucket('fecha'), price=_price(side), basis=_basis(side)),
+                         [period.code, side, city, lo, last_day])
+
+        # Rolling means of the refreshed periods, and of the later ones whose window reaches back into them
+        conn.execute('''
+            UPDATE price_aggregates
+            SET rolling_mean = (SELECT SUM(a.total) / SUM(a.count)
+                                FROM price_aggregates a
+                                WHERE a.period = price_aggregates.period
+                                  AND a.producto = price_aggregates.producto
+                                  AND a.variedad = price_aggregates.variedad
+                                  AND a.city = price_aggregates.city
+                                  AND a.side = price_aggregates.side
+                                  AND a.basis = price_aggregates.basis
+                                  AND a.period_start BETWEEN {window_start} AND price_aggregates.period_start)
+            WHERE period = ? AND city = ? AND period_start BETWEEN ? AND {rolling_hi}
+        '''.format(window_start=period.shift('price_aggregates.period_start', 1 - period.rolling),
+                   rolling_hi=period.shift('?', period.rolling - 1)),
+                     [period.code, city, lo, hi])
+
+    def rebuild(self) -> None:
+        """Recompute every aggregate from the stored prices, e.g. after changing the rolling windows."""
+        spans = self.store.read_sql('SELECT city, MIN(fecha) AS lo, MAX(fecha) AS hi FROM prices GROUP BY city')
+
+        with self.store.transaction() as conn:
+            conn.execute('DELETE FROM price_aggregates')
+
+        for row in spans.itertuples():
+            self.refresh(City(row.city), datetime.datetime.strptime(row.lo, '%Y-%m-%d').date(),
+                         datetime.datetime.strptime(row.hi, '%Y-%m-%d').date())
+
+    def _select(self, where: List[str], params: list, latest: bool = False) -> pd.DataFrame:
+        columns = ', '.join(SERIES_COLUMNS + ['period_start', 'count', 'total / count AS mean', 'min', 'max',
+                                              'rolling_mean'])
+
+        if latest:
+            sql = '''
+                SELECT {columns}
+                FROM price_aggregates
+                JOIN (SELECT {series}, MAX(period_start) AS period_start
+                      FROM price_aggregates
+                      WHERE {where}
+                      GROUP BY {series}) latest
+                USING ({series}, period_start)
+                ORDER BY {series}
+            '''.format(columns=columns, series=', '.join(SERIES_COLUMNS), where=' AND '.join(where))
+        else:
+            sql = 'SELECT {} FROM price_aggregates WHERE {} ORDER BY {}, period_start'.format(
+                columns, ' AND '.join(where), ', '.join(SERIES_COLUMNS))
+
+        df = self.store.read_sql(sql, params)
+
+        df['period_start'] = pd.to_datetime(df['period_start'], format='%Y-%m-%d').dt.date
+        restore_variedad(df)
+        df.set_index(SERIES_COLUMNS + ['period_start'], inplace=True)
+        return df
+
+    def series(self, producto: str, variedad: Optional[str] = None, cities: Optional[Iterable[City]] = None,
+               period: str = 'M', side: str = 'mayorista', start: Optional[datetime.date] = None,
+               end: Optional[datetime.date] = None) -> pd.DataFrame:
+        """Aggregates of one product over time, indexed by `SERIES_COLUMNS` and `period_start`."""
+        where = ['period = ?', 'side = ?', 'producto = ?']
+        params = [period, side, producto]
+
+        if variedad is not None:
+            where.append('variedad = ?')
+            params.append(variedad)
+
+        if cities is not None:
+            codes = [city.value for city in cities]
+            where.append('city IN ({})'.format(', '.join('?' * len(codes))))
+            params.extend(codes)
+
+        if start is not None:
+            where.append('period_start >= ?')
+            params.append(start.strftime('%Y-%m-%d'))
+
+        if end is not None:
+            where.append('period_start <= ?')
+            params.append(end.strftime('%Y-%m-%d'))
+
+        return self._select(where, params)
+
+    def latest(self, period: str = 'W', side: str = 'mayorista',
+               cities: Optional[Iterable[City]] = None) -> pd.DataFrame:
+        """The most recent period of every series, e.g. for an overview of current prices."""
+        where = ['period = ?', 'side = ?']
+        params = [period, side]
+
+        if cities is not None:
+            codes = [city.value for city in cities]
+            where.append('city IN ({})'.format(', '.join('?' * len(codes))))
+            params.extend(codes)
+
+        return self._select(where, params, latest=True)
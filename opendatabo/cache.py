@@ -0,0 +1,256 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from typing import Callable, Optional, Mapping
+
+import requests
+
+from opendatabo.common import atomic_write
+
+
+class CacheEntry:
+    def __init__(self, content: bytes, status_code: int = 200, stored_at: Optional[float] = None,
+                 ttl: Optional[float] = None, digest: Optional[str] = None):
+        self.content = content
+        self.status_code = status_code
+        self.stored_at = time.time() if stored_at is None else stored_at
+        self.ttl = ttl
+        self.digest = hash_content(content) if digest is None else digest
+
+    def is_fresh(self, now: Optional[float] = None) -> bool:
+        if self.ttl is None:
+            return True
+        return (time.time() if now is None else now) - self.stored_at < self.ttl
+
+    def __repr__(self):
+        return 'CacheEntry(size={}, digest={!r}, ttl={!r})'.format(len(self.content), self.digest, self.ttl)
+
+
+class CachedResponse:
+    """The subset of `requests.Response` the fetchers rely on, served from a cache entry."""
+
+    def __init__(self, url: str, entry: CacheEntry):
+        self.url = url
+        self.status_code = entry.status_code
+        self.content = entry.content
+        self.digest = entry.digest
+        self.from_cache = True
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_lines(self):
+        return iter(self.content.splitlines())
+
+    def close(self) -> None:
+        pass
+
+
+class ResponseCache(metaclass=ABCMeta):
+    @abstractmethod
+    def get(self, key: str) -> Optional[CacheEntry]:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, entry: CacheEntry) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        pass
+
+
+class MemoryCache(ResponseCache):
+    """In-process LRU cache bounded by the total size of the cached payloads."""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        if max_bytes < 0:
+            raise ValueError('max_bytes >= 0')
+
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            except KeyError:
+                return None
+
+    def set(self, key: str, entry: CacheEntry) -> None:
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = entry
+            self._size += len(entry.content)
+
+            while self._size > self.max_bytes and self._entries:
+                self._pop(next(iter(self._entries)))
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._pop(key)
+
+    def _pop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry.content)
+
+
+class DiskCache(ResponseCache):
+    """
+    Persistent LRU cache. Each entry is a payload file next to a small JSON metadata file; the
+    metadata file's mtime records the last access and drives eviction once `max_bytes` is exceeded.
+    Payloads whose content hash no longer matches the metadata are treated as missing.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 * 1024):
+        if max_bytes < 0:
+            raise ValueError('max_bytes >= 0')
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+        self._sizes = {}
+        for name in os.listdir(directory):
+            if name.endswith('.bin'):
+                key = name[:-len('.bin')]
+                if os.path.exists(self._meta_path(key)):
+                    self._sizes[key] = os.path.getsize(os.path.join(directory, name))
+
+    @property
+    def size(self) -> int:
+        return sum(self._sizes.values())
+
+    def _body_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.bin')
+
+    def _meta_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            if key not in self._sizes:
+                return None
+
+            try:
+                with open(self._meta_path(key)) as f:
+                    meta = json.load(f)
+                with open(self._body_path(key), 'rb') as f:
+                    content = f.read()
+            except (OSError, ValueError):
+                self._remove(key)
+                return None
+
+            if hash_content(content) != meta['digest']:
+                self._remove(key)
+                return None
+
+            os.utime(self._meta_path(key))
+
+            return CacheEntry(content, status_code=meta['status_code'], stored_at=meta['stored_at'],
+                              ttl=meta['ttl'], digest=meta['digest'])
+
+    def set(self, key: str, entry: CacheEntry) -> None:
+        meta = {'status_code': entry.status_code,
+                'stored_at': entry.stored_at,
+                'ttl': entry.ttl,
+                'digest': entry.digest,
+                }
+
+        with self._lock:
+            atomic_write(self._body_path(key), entry.content)
+            atomic_write(self._meta_path(key), json.dumps(meta).encode('utf-8'))
+            self._sizes[key] = len(entry.content)
+            self._evict()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        self._sizes.pop(key, None)
+        for path in (self._body_path(key), self._meta_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self) -> None:
+        total = sum(self._sizes.values())
+        if total <= self.max_bytes:
+            return
+
+        by_access = sorted(self._sizes, key=lambda k: os.path.getmtime(self._meta_path(k)))
+
+        for key in by_access:
+            if total <= self.max_bytes:
+                break
+            total -= self._sizes[key]
+            self._remove(key)
+
+
+def hash_content(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def make_cache_key(method: str, url: str, data: Optional[Mapping[str, str]] = None) -> str:
+    h = hashlib.sha256()
+    h.update(method.upper().encode('utf-8'))
+    h.update(b'\0')
+    h.update(url.encode('utf-8'))
+    for k, v in sorted((data or {}).items()):
+        h.update(b'\0')
+        h.update('{}={}'.format(k, v).encode('utf-8'))
+    return h.hexdigest()
+
+
+def cached_request(method: str, url: str, data: Optional[Mapping[str, str]] = None,
+                   cache: Optional[ResponseCache] = None, ttl: Optional[float] = None, refresh: bool = False,
+                   session: Optional[requests.Session] = None, validate: Optional[Callable[[bytes], bool]] = None,
+                   **kwargs):
+    """
+    Perform a request through `cache`, keyed on method, URL and POST body.
+
+    Fresh entries are served without touching the network unless `refresh` is set, in which case the
+    response is downloaded again and the entry replaced. Only successful responses are stored, and with
+    `validate` only those whose body it accepts: an error page served with status 200 must not be kept.
+    Without a cache this is a plain request.
+    """
+    if cache is None:
+        return (session or requests).request(method, url, data=data, **kwargs)
+
+    key = make_cache_key(method, url, data)
+
+    if not refresh:
+        entry = cache.get(key)
+        if entry is not None and entry.is_fresh():
+            return CachedResponse(url, entry)
+
+    kwargs.pop('stream', None)
+    r = (session or requests).request(method, url, data=data, **kwargs)
+
+    if r.status_code == 200 and (validate is None or validate(r.content)):
+        entry = CacheEntry(r.content, status_code=r.status_code, ttl=ttl)
+        cache.set(key, entry)
+        r.digest = entry.digest
+    r.from_cache = False
+
+    return r
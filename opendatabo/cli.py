@@ -0,0 +1,487 @@
+"""
+Command line interface, run as `python -m opendatabo <command>`.
+
+Only the standard library is imported up front. Each command imports pandas, requests, ckanapi, structlog
+and the modules built on them when it runs, so `--help` and small exports start quickly.
+"""
+import argparse
+import os
+import sys
+from typing import Optional, List
+
+
+def _logger():
+    import structlog
+    return structlog.get_logger()
+
+
+def _add_fetch_options(parser: argparse.ArgumentParser, site: str) -> None:
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='Number of requests made concurrently')
+    parser.add_argument('--per-host', type=int, default=4,
+                        help='Maximum concurrent requests against {}'.format(site))
+    parser.add_argument('--cache-dir', type=str,
+                        help='Directory for the persistent response cache')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Download everything again, replacing cached responses')
+
+
+def _add_ckan_options(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--host', type=str, required=True,
+                        help='Hostname of the target CKAN node')
+    parser.add_argument('-k', '--key', type=str,
+                        help='API Key for said host')
+    parser.add_argument('-p', '--package', type=str, required=True,
+                        help='Target package (dataset) ID where the resource will be created')
+    parser.add_argument('-r', '--resource', type=str, required=True,
+                        help='Target resource name')
+    parser.add_argument('--compress', action='store_true',
+                        help='Upload the file gzipped')
+    parser.add_argument('--force-upload', action='store_true',
+                        help='Upload even when the published resource already has the same content')
+    parser.add_argument('--metrics-json', type=str,
+                        help='Write per-stage timings and counters of the run to this JSON file')
+    parser.add_argument('--metrics-prom', type=str,
+                        help='Write per-stage timings and counters as a Prometheus textfile')
+
+
+def _publish(publisher, args, resource_name: str, artifact) -> None:
+    import ckanapi
+    from opendatabo.publish import AmbiguousResourceError
+
+    logger = _logger()
+
+    try:
+        result = publisher.publish(resource_name, artifact, force=args.force_upload)
+
+    except AmbiguousResourceError:
+        logger.error('more than one matching resources found', name=resource_name)
+        sys.exit(1)
+
+    except ckanapi.errors.NotFound:
+        logger.error('package does not exist')
+        sys.exit(1)
+
+    except ckanapi.errors.CKANAPIError as e:
+        logger.error('ckan api fail', error=e)
+        sys.exit(1)
+
+    if result.action == result.UNCHANGED:
+        logger.info('unchanged, not uploading', name=resource_name, hash=artifact.hash)
+    else:
+        logger.info('saved', action=result.action, resource=result.resource)
+
+
+def export_sic(args) -> None:
+    from opendatabo.sic import City, Today, Year, save_market_prices
+
+    timeframe = Today() if args.when == 'hoy' else Year(int(args.when))
+
+    save_market_prices(City(args.location), timeframe, args.raw, args.output, args.format, args.compression)
+
+
+def _write_years(parts, fp) -> None:
+    # Years never overlap, so writing them in order gives the same file as sorting their concatenation. Their
+    # columns differ though: every year is written under the columns of all of them, in order of appearance
+    # like `merge_partitions`, a year lacking one leaving it empty
+    columns = []
+    for df in parts:
+        columns.extend(c for c in df.columns if c not in columns)
+
+    header = True
+    for df in parts:
+        df.sort_index().reindex(columns=columns).to_csv(fp, header=header)
+        header = False
+
+
+def _upload_city(publisher, args, city, write_csv) -> None:
+    from opendatabo.publish import Artifact
+
+    filename = 'sic_{}.csv'.format(city.name)
+
+    with Artifact.render(write_csv, filename, 'csv', compress=args.compress) as artifact:
+        _logger().info('data ready', city=city, data_size=artifact.size)
+
+        _publish(publisher, args, '{} {}'.format(args.resource, city.name), artifact)
+
+
+def upload_sic(args) -> None:
+    from opendatabo.aggregates import PriceAggregates
+    from opendatabo.cache import DiskCache
+    from opendatabo.common import RetryBudget
+    from opendatabo.publish import Publisher, make_ckan
+    from opendatabo.sic import make_retry_policy
+    from opendatabo.store import PriceStore
+
+    # One breaker and one retry budget for every download of the run
+    retry_policy = make_retry_policy(budget=RetryBudget(args.retry_budget))
+
+    cache = DiskCache(args.cache_dir) if args.cache_dir else None
+
+    # One client, and so one pooled connection, for every city
+    publisher = Publisher(make_ckan(args.host, args.key), args.package)
+
+    # Weekly and monthly aggregates are kept up to date alongside the stored prices
+    aggregates = PriceAggregates(PriceStore(args.price_store)) if args.price_store else None
+
+    parser = None
+    if args.parse_processes:
+        from opendatabo.parallel import MarketPricesParser
+        parser = MarketPricesParser(processes=args.parse_processes)
+
+    try:
+        _upload_sic(args, cache, publisher, aggregates, parser, retry_policy)
+    finally:
+        if parser is not None:
+            parser.close()
+
+
+def _upload_sic(args, cache, publisher, aggregates, parser, retry_policy) -> None:
+    from opendatabo.sic import City, Year, fetch_market_prices
+    from opendatabo.sync import PartitionStore
+
+    logger = _logger()
+
+    if args.sync_dir:
+        store = PartitionStore(args.sync_dir)
+        report = store.sync(workers=args.workers, per_host=args.per_host, timeout=args.timeout, cache=cache,
+                            force=args.refresh, parser=parser, retry_policy=retry_policy)
+        logger.info('sync done', report=report)
+
+        for city, year, error in report.failed:
+            logger.warning('fetch fail', city=city, year=year, error=error)
+
+        for city, year in report.changed:
+            if aggregates is not None:
+                aggregates.ingest(city, store.load_partition(city, year))
+
+        # Every stored city is rendered on every run and the publisher skips what is published already: the
+        # partitions are in the manifest before the upload, so a city whose upload failed would otherwise
+        # never look changed again
+        for city in City.all():
+            if not store.years(city):
+                logger.warning('no data', city=city)
+                continue
+
+            # Streamed from the sorted partitions, a chunk of each at a time
+            _upload_city(publisher, args, city, lambda fp, city=city: store.write_city(city, fp))
+
+        return
+
+    jobs = [(city, year) for city in City.all() for year in Year.all_valid()]
+
+    pending = {}
+    parts = {}
+
+    for city, _ in jobs:
+        pending[city] = pending.get(city, 0) + 1
+        parts[city] = []
+
+    logger.info('fetching data', jobs=len(jobs))
+
+    for outcome in fetch_market_prices(jobs, workers=args.workers, per_host=args.per_host, timeout=args.timeout,
+                                       cache=cache, refresh=args.refresh, parser=parser,
+                                       retry_policy=retry_policy):
+        city = outcome.city
+
+        if outcome.ok:
+            logger.info('data fetched', city=city, year=outcome.timeframe, rows=outcome.df.shape[0],
+                        elapsed=outcome.elapsed)
+            parts[city].append((outcome.timeframe.value, outcome.df))
+            if aggregates is not None:
+                # Closed years come back the same on every run, and are only ingested the first time
+                aggregates.ingest(city, outcome.df, source=outcome.timeframe.to_filename_suffix())
+        else:
+            logger.warning('fetch fail', city=city, year=outcome.timeframe, error=outcome.error,
+                           elapsed=outcome.elapsed)
+
+        pending[city] -= 1
+
+        # Each city is uploaded as soon as all of its years are in, while the rest keep downloading
+        if pending[city] == 0:
+            if parts[city]:
+                years = [df for _, df in sorted(parts.pop(city), key=lambda part: part[0])]
+                logger.info('city ready', city=city, rows=sum(df.shape[0] for df in years))
+                _upload_city(publisher, args, city, lambda fp, years=years: _write_years(years, fp))
+            else:
+                logger.warning('no data', city=city)
+
+
+def _harvest(args):
+    """
+    Fetch the bus lines for the cruzero commands, as a `HarvestResult` or with a snapshot a `RouteSyncResult`
+    still to commit. Returns None when the snapshot shows nothing changed.
+    """
+    from opendatabo.cache import DiskCache
+    from opendatabo.common import make_session
+    from opendatabo.cruzero import get_all_bus_line_ids, harvest_bus_lines
+    from opendatabo.routes import RouteSnapshot
+
+    logger = _logger()
+
+    cache = DiskCache(args.cache_dir) if args.cache_dir else None
+
+    session = make_session(pool_size=args.per_host)
+
+    line_ids = get_all_bus_line_ids(session=session, cache=cache, refresh=args.refresh)
+    logger.info('line_ids', len=len(line_ids))
+
+    if getattr(args, 'snapshot_dir', None):
+        # Conditional requests against the previous run; unchanged routes come from the snapshot
+        harvest = RouteSnapshot(args.snapshot_dir).fetch(line_ids, workers=args.workers, per_host=args.per_host,
+                                                         session=session)
+        logger.info('routes fetched', diff=harvest.diff, not_modified=harvest.not_modified)
+
+        if not harvest.diff.changed and not args.force_upload:
+            logger.info('no route changes, nothing to publish')
+            return None
+    else:
+        harvest = harvest_bus_lines(line_ids, workers=args.workers, per_host=args.per_host, session=session,
+                                    cache=cache, refresh=args.refresh)
+
+    for bus_line in harvest.lines:
+        logger.info('bus_line', id=bus_line.line_id, name=bus_line.name, points_len=len(bus_line.coords))
+
+    for failure in harvest.failures:
+        logger.warning('bus_line failed', id=failure.line_id, error=failure.error)
+
+    return harvest
+
+
+def export_cruzero(args) -> None:
+    from opendatabo.cruzero import write_geojson
+
+    bus_lines = _harvest(args).lines
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        write_geojson(bus_lines, f, precision=args.precision, tolerance=args.tolerance)
+
+
+def tile_cruzero(args) -> None:
+    from opendatabo.tiles import write_tiles
+
+    bus_lines = _harvest(args).lines
+
+    stats = write_tiles(bus_lines, args.output, min_zoom=args.min_zoom, max_zoom=args.max_zoom,
+                        precision=args.precision, processes=args.processes)
+    _logger().info('tiles written', path=args.output, stats=stats)
+
+
+def upload_cruzero(args) -> None:
+    from opendatabo.cruzero import simplify_bus_lines, write_geojson
+    from opendatabo.publish import Artifact, Publisher, make_ckan
+
+    harvest = _harvest(args)
+    if harvest is None:
+        return
+
+    bus_lines = harvest.lines
+
+    publisher = Publisher(make_ckan(args.host, args.key), args.package)
+
+    def upload(resource_name, filename, lines):
+        with Artifact.render(lambda fp: write_geojson(lines, fp, precision=args.precision), filename, 'geojson',
+                             compress=args.compress) as artifact:
+            _logger().info('data ready', name=resource_name, lines=len(lines), data_size=artifact.size)
+
+            _publish(publisher, args, resource_name, artifact)
+
+    upload(args.resource, args.name, bus_lines)
+
+    if args.lod:
+        levels, stats = simplify_bus_lines(bus_lines, args.lod)
+        _logger().info('simplified', stats=stats)
+
+        base_name, ext = os.path.splitext(args.name)
+
+        for tolerance in sorted(levels):
+            upload('{} ({:g} m)'.format(args.resource, tolerance), '{}-{:g}m{}'.format(base_name, tolerance, ext),
+                   levels[tolerance])
+
+    if args.snapshot_dir:
+        from opendatabo.routes import RouteSnapshot
+
+        # Only once everything is published: after a failed upload the next run still sees the changes
+        diff = RouteSnapshot(args.snapshot_dir).commit(harvest)
+        _logger().info('snapshot updated', diff=diff)
+
+
+def run_daemon(args) -> None:
+    import signal
+    import threading
+    from opendatabo.aggregates import PriceAggregates
+    from opendatabo.common import HostRateLimiter, make_session
+    from opendatabo.daemon import Scheduler, StatusServer, refresh_jobs, stagger
+    from opendatabo.routes import RouteSnapshot
+    from opendatabo.sic import City
+    from opendatabo.store import PriceStore
+
+    logger = _logger()
+
+    if not args.price_store and not args.snapshot_dir:
+        logger.error('nothing to refresh, give --price-store and/or --snapshot-dir')
+        sys.exit(1)
+
+    # One pool of connections for every job, and every request waits for its turn at the host
+    session = make_session(pool_size=args.per_host, rate_limiter=HostRateLimiter(args.rate))
+
+    store = PriceStore(args.price_store) if args.price_store else None
+    aggregates = PriceAggregates(store) if store is not None else None
+    snapshot = RouteSnapshot(args.snapshot_dir) if args.snapshot_dir else None
+
+    jobs = refresh_jobs(aggregates, snapshot, session, cities=[City(c) for c in args.cities or []],
+                        today_every=args.today_every * 60, year_every=args.year_every * 60,
+                        routes_every=args.routes_every * 60, per_host=args.per_host, timeout=args.timeout)
+    delays = stagger(jobs, args.stagger)
+
+    stopped = threading.Event()
+
+    def shutdown(signum, frame):
+        logger.info('stopping, waiting for running jobs', signal=signum)
+        stopped.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    scheduler = Scheduler(workers=args.workers, logger=logger)
+    for job in jobs:
+        scheduler.add(job, delay=delays[job.name])
+
+    status_server = None
+    if args.status_port is not None:
+        status_server = StatusServer(scheduler, args.status_host, args.status_port).start()
+        logger.info('status', url=status_server.url)
+
+    scheduler.start()
+    logger.info('daemon started', jobs=len(jobs))
+
+    try:
+        # Waking up now and then lets the signal handlers run
+        while not stopped.wait(1.0):
+            pass
+    finally:
+        scheduler.stop()
+        if status_server is not None:
+            status_server.stop()
+        if store is not None:
+            store.close()
+        logger.info('daemon stopped')
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='opendatabo', description='Fetch, export and publish Bolivian open data')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    p = commands.add_parser('export-sic', help="Export data from SIC's website to a file")
+    p.add_argument('-c', '--clean', dest='raw', action='store_false', help='Give a better structure to the data')
+    p.add_argument('-l', '--location', type=str, default='sc', help="City code, known values are [sc, trd, cbb]")
+    p.add_argument('-o', '--output', type=str, help='Output file')
+    p.add_argument('-w', '--when', type=str, default='hoy', help="Year for the dataset you want")
+    p.add_argument('-f', '--format', type=str, default='csv', choices=['csv', 'parquet', 'feather'],
+                   help='Output file format')
+    p.add_argument('-z', '--compression', type=str,
+                   help='Compression codec: gzip or zstd for csv, passed on to pyarrow otherwise')
+    p.set_defaults(func=export_sic)
+
+    p = commands.add_parser('upload-sic', help='Publish the SIC market prices of every city to CKAN')
+    _add_ckan_options(p)
+    _add_fetch_options(p, 'the SIC website')
+    p.add_argument('-t', '--timeout', type=float, default=60.0,
+                   help='Timeout in seconds for each request')
+    p.add_argument('--retry-budget', type=float, default=300.0,
+                   help='Total seconds all the requests of the run may spend waiting between retries')
+    p.add_argument('--price-store', type=str,
+                   help='SQLite database where the fetched prices and their aggregates are also kept')
+    p.add_argument('--sync-dir', type=str,
+                   help='Directory of per-year partitions; only years that may have changed are fetched')
+    p.add_argument('--parse-processes', type=int,
+                   help='Prepare the downloaded exports on this many worker processes (needs pyarrow)')
+    p.set_defaults(func=upload_sic)
+
+    p = commands.add_parser('export-cruzero', help='Export the Cruzero bus lines to a GeoJSON file')
+    _add_fetch_options(p, 'cruzero.net')
+    p.add_argument('-o', '--output', type=str, default='lineas-de-buses.json',
+                   help='Output file')
+    p.add_argument('--precision', type=int, default=6,
+                   help='Decimals kept in the coordinates')
+    p.add_argument('--tolerance', type=float,
+                   help='Simplify the routes to this many meters')
+    p.set_defaults(func=export_cruzero)
+
+    p = commands.add_parser('tile-cruzero', help='Render the Cruzero bus lines as a z/x/y pyramid of GeoJSON tiles')
+    _add_fetch_options(p, 'cruzero.net')
+    p.add_argument('-o', '--output', type=str, default='lineas-de-buses',
+                   help='Output directory, or a .zip archive')
+    p.add_argument('--min-zoom', type=int, default=10,
+                   help='Lowest zoom level rendered')
+    p.add_argument('--max-zoom', type=int, default=16,
+                   help='Highest zoom level rendered')
+    p.add_argument('--precision', type=int, default=6,
+                   help='Decimals kept in the coordinates')
+    p.add_argument('--processes', type=int,
+                   help='Worker processes rendering tiles, one per CPU by default')
+    p.set_defaults(func=tile_cruzero)
+
+    p = commands.add_parser('upload-cruzero', help='Publish the Cruzero bus lines to CKAN')
+    _add_ckan_options(p)
+    _add_fetch_options(p, 'cruzero.net')
+    p.add_argument('-n', '--name', type=str, default='lineas-de-buses.json',
+                   help='Filename for upload')
+    p.add_argument('--snapshot-dir', type=str,
+                   help='Directory keeping the routes of the previous run; only changes are published')
+    p.add_argument('--precision', type=int, default=6,
+                   help='Decimals kept in the published coordinates')
+    p.add_argument('--lod', type=float, nargs='*', default=[],
+                   help='Also publish simplified routes, one resource per tolerance in meters')
+    p.set_defaults(func=upload_cruzero)
+
+    p = commands.add_parser('daemon', help='Keep the SIC prices and the Cruzero routes up to date, until stopped')
+    p.add_argument('--price-store', type=str,
+                   help='SQLite database where the prices and their aggregates are kept')
+    p.add_argument('--snapshot-dir', type=str,
+                   help='Directory keeping the routes; without it routes are not refreshed')
+    p.add_argument('-l', '--cities', type=str, nargs='*',
+                   help='City codes to refresh, all of them by default')
+    p.add_argument('--today-every', type=float, default=15.0,
+                   help="Minutes between refreshes of today's prices")
+    p.add_argument('--year-every', type=float, default=60.0,
+                   help='Minutes between refreshes of the current year')
+    p.add_argument('--routes-every', type=float, default=24 * 60.0,
+                   help='Minutes between refreshes of the bus routes')
+    p.add_argument('--stagger', type=float, default=60.0,
+                   help='Seconds over which the first runs are spread out')
+    p.add_argument('-w', '--workers', type=int, default=4,
+                   help='Jobs run concurrently')
+    p.add_argument('--per-host', type=int, default=4,
+                   help='Maximum concurrent requests against each host')
+    p.add_argument('--rate', type=float, default=2.0,
+                   help='Maximum requests per second started against each host')
+    p.add_argument('-t', '--timeout', type=float, default=60.0,
+                   help='Timeout in seconds for each request')
+    p.add_argument('--status-host', type=str, default='127.0.0.1',
+                   help='Address of the status endpoint')
+    p.add_argument('--status-port', type=int,
+                   help='Serve the job status as JSON on this port')
+    p.set_defaults(func=run_daemon)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = build_parser().parse_args(argv)
+
+    run_metrics = None
+    if getattr(args, 'metrics_json', None) or getattr(args, 'metrics_prom', None):
+        from opendatabo import metrics
+        run_metrics = metrics.enable(metrics.Metrics(logger=_logger()))
+
+    try:
+        args.func(args)
+    finally:
+        if run_metrics is not None:
+            run_metrics.log_summary(_logger())
+            if args.metrics_json:
+                run_metrics.write_json(args.metrics_json)
+            if args.metrics_prom:
+                run_metrics.write_prometheus(args.metrics_prom)
@@ -1,29 +1,382 @@
-from typing import Type, Callable
-
+import asyncio
+import functools
+import os
+import random
+import tempfile
+import threading
 import time
+from contextlib import contextmanager
+from typing import Type, Callable, Iterable, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from opendatabo import metrics
 
 
 class DataNotAvailableException(Exception):
-    pass
+    def __init__(self, status_code: Optional[int] = None):
+        super().__init__(*(() if status_code is None else (status_code,)))
+        self.status_code = status_code
 
 
-def retry_on(exception_type: Type, retries: int = 1, delay: Callable[[int], float] = lambda i: 0.0):
-    if retries < 0:
-        raise ValueError('retries >= 0')
+class CircuitOpenError(Exception):
+    """Raised instead of calling out to a host whose circuit breaker is open."""
+
+    def __init__(self, key: str):
+        super().__init__('circuit open for {!r}'.format(key))
+        self.key = key
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast once a host is clearly down, instead of every caller waiting out its own retries.
+
+    After `threshold` consecutive failures against the same key (usually a host) the circuit opens and
+    calls raise `CircuitOpenError` right away. Once `reset_after` seconds have passed a single trial call
+    is let through: a success closes the circuit again, a failure keeps it open for another period.
+    """
+
+    def __init__(self, threshold: int = 5, reset_after: float = 30.0):
+        if threshold < 1:
+            raise ValueError('threshold >= 1')
+
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._opened_at = {}
+
+    def is_open(self, key: str) -> bool:
+        with self._lock:
+            return key in self._opened_at
+
+    def before_call(self, key: str) -> None:
+        with self._lock:
+            opened_at = self._opened_at.get(key)
+            if opened_at is None:
+                return
+            now = time.monotonic()
+            if now - opened_at < self.reset_after:
+                raise CircuitOpenError(key)
+            # Half-open: this caller makes the trial call, the others keep failing fast meanwhile
+            self._opened_at[key] = now
+
+    def record_success(self, key: str) -> None:
+        with self._lock:
+            self._failures.pop(key, None)
+            self._opened_at.pop(key, None)
+
+    def record_failure(self, key: str) -> None:
+        with self._lock:
+            failures = self._failures.get(key, 0) + 1
+            self._failures[key] = failures
+            if failures >= self.threshold:
+                self._opened_at[key] = time.monotonic()
+
+
+class RetryBudget:
+    """Total seconds that all the calls sharing it may spend sleeping between retries, e.g. over one run."""
+
+    def __init__(self, seconds: float):
+        if seconds < 0:
+            raise ValueError('seconds >= 0')
+
+        self._remaining = seconds
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self) -> float:
+        return self._remaining
+
+    def take(self, seconds: float) -> bool:
+        with self._lock:
+            if seconds > self._remaining:
+                return False
+            self._remaining -= seconds
+            return True
+
+
+class RetryPolicy:
+    """
+    Decorator retrying a sync or async callable with jittered exponential backoff.
+
+    A call is retried when it raises one of `exceptions`, raises a `requests.HTTPError` whose status is in
+    `statuses`, or returns a response whose `status_code` is in `statuses` (the last such response is
+    returned once the attempts run out). It gives up early rather than sleep past `deadline` seconds
+    since the call started, or beyond what is left of the shared `budget`.
+
+    With a `breaker`, failures are counted per `key(*args, **kwargs)` (one key per decorated function by
+    default) and calls fail fast with `CircuitOpenError` while the circuit is open. `trips(exception)` tells
+    which exceptions count as failures of the key, retryable or not; by default every retryable one does.
+    """
+
+    def __init__(self, exceptions=(requests.ConnectionError, requests.Timeout), attempts: int = 3,
+                 base_delay: float = 1.0, max_delay: float = 30.0, jitter: bool = True,
+                 delay: Optional[Callable[[int], float]] = None, statuses: Iterable[int] = (),
+                 deadline: Optional[float] = None, budget: Optional[RetryBudget] = None,
+                 breaker: Optional[CircuitBreaker] = None, key: Optional[Callable[..., str]] = None,
+                 trips: Optional[Callable[[BaseException], bool]] = None):
+        if attempts < 1:
+            raise ValueError('attempts >= 1')
+
+        self.exceptions = exceptions
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.delay = delay
+        self.statuses = frozenset(statuses)
+        self.deadline = deadline
+        self.budget = budget
+        self.breaker = breaker
+        self.key = key
+        self.trips = trips
+
+    def backoff(self, i: int) -> float:
+        """Seconds to wait after the `i`-th failed attempt (starting at 0)."""
+        if self.delay is not None:
+            return self.delay(i)
+
+        t = min(self.max_delay, self.base_delay * 2.0 ** i)
+        if self.jitter:
+            # Keep at least half of the delay, so that jitter spreads retries without collapsing them to 0
+            t = random.uniform(t / 2, t)
+        return t
+
+    def _failed_status(self, result) -> bool:
+        return getattr(result, 'status_code', None) in self.statuses
+
+    def _is_retryable(self, e: BaseException) -> bool:
+        if isinstance(e, self.exceptions):
+            return True
+        response = getattr(e, 'response', None)
+        return isinstance(e, requests.HTTPError) and self._failed_status(response)
+
+    def _trips(self, e: BaseException) -> bool:
+        return self._is_retryable(e) if self.trips is None else self.trips(e)
+
+    def _wait(self, i: int, start: float) -> Optional[float]:
+        """Seconds to sleep before attempt `i + 1`, or None when the policy gives up."""
+        if i + 1 >= self.attempts:
+            return None
+
+        t = self.backoff(i)
+
+        if self.deadline is not None and time.monotonic() - start + t > self.deadline:
+            return None
+        if self.budget is not None and not self.budget.take(t):
+            return None
+
+        metrics.incr('retries')
+        return t
 
-    def wrapper(func):
+    def _before_call(self, key: Optional[str]) -> None:
+        if key is not None:
+            try:
+                self.breaker.before_call(key)
+            except CircuitOpenError:
+                metrics.incr('circuit_open')
+                raise
+
+    def _record(self, key: Optional[str], ok: bool) -> None:
+        if key is not None:
+            if ok:
+                self.breaker.record_success(key)
+            else:
+                self.breaker.record_failure(key)
+
+    def _key(self, func, args, kwargs) -> Optional[str]:
+        if self.breaker is None:
+            return None
+        if self.key is None:
+            return func.__qualname__
+        return self.key(*args, **kwargs)
+
+    def __call__(self, func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapped_async(*args, **kwargs):
+                key = self._key(func, args, kwargs)
+                start = time.monotonic()
+                i = 0
+                while True:
+                    self._before_call(key)
+                    try:
+                        result = await func(*args, **kwargs)
+                    except Exception as e:
+                        if self._trips(e):
+                            self._record(key, ok=False)
+                        if not self._is_retryable(e):
+                            raise
+                        t = self._wait(i, start)
+                        if t is None:
+                            raise
+                    else:
+                        if not self._failed_status(result):
+                            self._record(key, ok=True)
+                            return result
+                        self._record(key, ok=False)
+                        t = self._wait(i, start)
+                        if t is None:
+                            return result
+                        _close(result)
+                    with metrics.stage('retry_sleep'):
+                        await asyncio.sleep(t)
+                    i += 1
+
+            return wrapped_async
+
+        @functools.wraps(func)
         def wrapped(*args, **kwargs):
-            culprit = None
-            for i in range(retries):
+            key = self._key(func, args, kwargs)
+            start = time.monotonic()
+            i = 0
+            while True:
+                self._before_call(key)
                 try:
-                    return func(*args, **kwargs)
-                except exception_type as e:
-                    t = delay(i)
+                    result = func(*args, **kwargs)
+                except Exception as e:
+                    if self._trips(e):
+                        self._record(key, ok=False)
+                    if not self._is_retryable(e):
+                        raise
+                    t = self._wait(i, start)
+                    if t is None:
+                        raise
+                else:
+                    if not self._failed_status(result):
+                        self._record(key, ok=True)
+                        return result
+                    self._record(key, ok=False)
+                    t = self._wait(i, start)
+                    if t is None:
+                        return result
+                    _close(result)
+                with metrics.stage('retry_sleep'):
                     time.sleep(t)
-                    culprit = e
-                    continue
-            raise culprit
+                i += 1
 
         return wrapped
 
-    return wrapper
+
+def _close(response) -> None:
+    close = getattr(response, 'close', None)
+    if close is not None:
+        close()
+
+
+def retry_on(exception_type: Type, retries: int = 1, delay: Callable[[int], float] = lambda i: 0.0):
+    """Make up to `retries` attempts (at least one) while `exception_type` is raised. See `RetryPolicy`."""
+    if retries < 0:
+        raise ValueError('retries >= 0')
+
+    return RetryPolicy(exception_type, attempts=max(retries, 1), delay=delay)
+
+
+class HostRateLimiter:
+    """
+    Spaces out the requests made to the same host, at most `rate` per second each.
+
+    Callers reserve the next free slot of the host and sleep until it comes, so bursts from many threads
+    are queued in order instead of reaching the host at once.
+    """
+
+    def __init__(self, rate: float, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        if rate <= 0:
+            raise ValueError('rate > 0')
+
+        self.rate = rate
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._next = {}
+
+    def wait(self, url: str) -> float:
+        """Block until a request to the host of `url` may start. Returns the seconds waited."""
+        host = urlsplit(url).netloc
+
+        with self._lock:
+            now = self._clock()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + 1.0 / self.rate
+
+        delay = start - now
+        if delay > 0:
+            metrics.incr('rate_limited')
+            self._sleep(delay)
+        return delay
+
+
+class _RateLimitedAdapter(HTTPAdapter):
+    def __init__(self, rate_limiter: HostRateLimiter, **kwargs):
+        self.rate_limiter = rate_limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.rate_limiter.wait(request.url)
+        return super().send(request, **kwargs)
+
+
+def make_session(pool_size: int = 10, rate_limiter: Optional[HostRateLimiter] = None) -> requests.Session:
+    """
+    Build a session whose connection pool can keep `pool_size` connections per host alive. With a
+    `rate_limiter`, every request the session sends waits for its turn at the host.
+    """
+    if pool_size < 1:
+        raise ValueError('pool_size >= 1')
+
+    if rate_limiter is None:
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    else:
+        adapter = _RateLimitedAdapter(rate_limiter, pool_connections=pool_size, pool_maxsize=pool_size)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+class HostLimiter:
+    """Caps how many requests may be in flight against the same host at once."""
+
+    def __init__(self, per_host: int):
+        if per_host < 1:
+            raise ValueError('per_host >= 1')
+
+        self._per_host = per_host
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    @property
+    def per_host(self) -> int:
+        return self._per_host
+
+    def _semaphore(self, host: str) -> threading.Semaphore:
+        with self._lock:
+            try:
+                return self._semaphores[host]
+            except KeyError:
+                sem = threading.BoundedSemaphore(self._per_host)
+                self._semaphores[host] = sem
+                return sem
+
+    @contextmanager
+    def limit(self, url: str):
+        with self._semaphore(urlsplit(url).netloc):
+            yield
+
+
+def atomic_write(path: str, data: bytes) -> None:
+    """Write `data` to `path` so that readers only ever see the old or the new file, never a partial one."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -1,12 +1,27 @@
+import hashlib
+import io
+import json
 import re
-from decimal import Decimal
-from operator import itemgetter
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+from typing import List, Iterable, Optional, Sequence, Dict, Tuple
 
 import geojson
+import numpy as np
 import requests
 
-from opendatabo.common import DataNotAvailableException
+from opendatabo import metrics
+from opendatabo.cache import ResponseCache, cached_request
+from opendatabo.common import DataNotAvailableException, HostLimiter, make_session
+from opendatabo.geometry import douglas_peucker_thresholds, project, simplify
+
+CRUZERO_URL = 'http://cruzero.net/cruzero'
+
+# Routes only change a few times a year
+CACHE_TTL = 24 * 60 * 60
+
+# How the line list page links to each line
+_LINE_ID_PATTERN = re.compile(r'mostrarLinea\((\d+),')
 
 
 class GeoJSONEncoderWithDecimal(geojson.GeoJSONEncoder):
@@ -17,6 +32,8 @@ class GeoJSONEncoderWithDecimal(geojson.GeoJSONEncoder):
 
 
 class LatLng:
+    __slots__ = ('lat', 'lng')
+
     def __init__(self, lat: Decimal, lng: Decimal):
         self.lat = lat
         self.lng = lng
@@ -26,76 +43,314 @@ class LatLng:
 
 
 class BusLine:
-    def __init__(self, line_id: int, name: str, speed: Decimal, distance: Decimal, total_time: Decimal, points: List[LatLng]):
+    """
+    A bus line and its route. The route is kept as an (n, 2) NumPy array of (longitude, latitude) pairs,
+    in GeoJSON order; `points` offers the same route as `LatLng` objects for older callers.
+    """
+
+    __slots__ = ('line_id', 'name', 'speed', 'distance', 'total_time', 'coords')
+
+    def __init__(self, line_id: int, name: str, speed: Decimal, distance: Decimal, total_time: Decimal,
+                 points: Optional[List[LatLng]] = None, coords: Optional[np.ndarray] = None, dtype=np.float64):
+        if coords is None:
+            coords = np.array([(p.lng, p.lat) for p in points or []], dtype=dtype).reshape(-1, 2)
+
         self.line_id = line_id
         self.name = name
         self.speed = speed
         self.distance = distance
         self.total_time = total_time
-        self.points = points
+        self.coords = coords
+
+    @property
+    def points(self) -> List[LatLng]:
+        return [LatLng(lat=Decimal(repr(lat)), lng=Decimal(repr(lng))) for lng, lat in self.coords.tolist()]
+
+    def with_coords(self, coords: np.ndarray) -> 'BusLine':
+        return BusLine(line_id=self.line_id, name=self.name, speed=self.speed, distance=self.distance,
+                       total_time=self.total_time, coords=coords)
+
+    def fingerprint(self) -> str:
+        """Hash of the metadata and the route, at the 7 decimals the source publishes, to detect changes."""
+        h = hashlib.sha256()
+        h.update(json.dumps([self.line_id, self.name, str(self.speed), str(self.distance),
+                             str(self.total_time)]).encode('utf-8'))
+        h.update(np.ascontiguousarray(np.round(self.coords, 7), dtype='<f8').tobytes())
+        return h.hexdigest()
+
+    @property
+    def properties(self) -> dict:
+        return {'line_id': self.line_id,
+                'name': self.name,
+                'speed': self.speed,
+                'distance': self.distance,
+                'total_time': self.total_time,
+                }
 
     def to_geojson(self):
         return geojson.dumps(self, cls=GeoJSONEncoderWithDecimal)
 
     @property
     def __geo_interface__(self):
-        props = self.__dict__.copy()
-        del props['points']
+        geometry = geojson.LineString(self.coords.tolist())
+
+        return geojson.Feature(id=self.line_id, geometry=geometry, properties=self.properties)
+
+
+def bus_lines_to_geojson(lines: List[BusLine], precision: Optional[int] = None,
+                         tolerance: Optional[float] = None) -> str:
+    buf = io.StringIO()
+    write_geojson(lines, buf, precision=precision, tolerance=tolerance)
+    return buf.getvalue()
+
+
+def _feature(line: BusLine, precision: Optional[int], tolerance: Optional[float]) -> dict:
+    coords = line.coords if tolerance is None else simplify(line.coords, tolerance)
+    coords = coords if precision is None else np.round(coords, precision)
 
-        coords = []
-        for point in self.points:
-            coords.append((point.lng, point.lat))
+    properties = {k: float(v) if isinstance(v, Decimal) else v for k, v in line.properties.items()}
 
-        geometry = geojson.LineString(coords)
+    return {'type': 'Feature',
+            'id': line.line_id,
+            'geometry': {'type': 'LineString', 'coordinates': coords.tolist()},
+            'properties': properties,
+            }
 
-        return geojson.Feature(id=self.line_id, geometry=geometry, properties=props)
 
+def write_geojson(lines: Iterable[BusLine], fp, precision: Optional[int] = None,
+                  tolerance: Optional[float] = None) -> None:
+    """
+    Write the lines as a GeoJSON FeatureCollection to the text file `fp`, one feature at a time.
 
-def bus_lines_to_geojson(lines: List[BusLine]) -> str:
-    coll = geojson.FeatureCollection(lines)
-    return geojson.dumps(coll, cls=GeoJSONEncoderWithDecimal)
+    Routes are simplified to `tolerance` meters and coordinates rounded to `precision` decimals when given.
+    Without either the output is the same as `geojson.dumps(geojson.FeatureCollection(lines))`.
+    """
+    with metrics.stage('cruzero.serialize'):
+        fp.write('{"type": "FeatureCollection", "features": [')
 
+        for i, line in enumerate(lines):
+            if i:
+                fp.write(', ')
+            fp.write(json.dumps(_feature(line, precision, tolerance), allow_nan=False))
 
-def get_bus_line(line_id: int) -> BusLine:
-    url = 'http://cruzero.net/cruzero/lineasbuses/json_rutas?lbsId={}'.format(line_id)
+        fp.write(']}')
 
-    r = requests.get(url)
 
+class SimplificationStats:
+    def __init__(self, vertices: int, kept: Dict[float, int]):
+        self.vertices = vertices
+        self.kept = kept
+
+    def reduction(self, tolerance: float) -> float:
+        """Fraction of the vertices dropped at `tolerance`."""
+        if self.vertices == 0:
+            return 0.0
+        return 1.0 - self.kept[tolerance] / self.vertices
+
+    def __repr__(self):
+        levels = ', '.join('{:g} m: {} ({:.1%} less)'.format(t, k, self.reduction(t))
+                           for t, k in sorted(self.kept.items()))
+        return 'SimplificationStats(vertices={}, {})'.format(self.vertices, levels)
+
+
+def simplify_bus_lines(lines: Iterable[BusLine], tolerances: Sequence[float]) \
+        -> Tuple[Dict[float, List[BusLine]], SimplificationStats]:
+    """
+    Build several levels of detail of the routes at once, one per tolerance in meters.
+
+    Each route is ranked by Douglas-Peucker only once; every level is then a cheap filter on that ranking.
+    """
+    tolerances = sorted(set(tolerances))
+    if not tolerances:
+        raise ValueError('tolerances')
+
+    levels = {t: [] for t in tolerances}
+    kept = {t: 0 for t in tolerances}
+    vertices = 0
+
+    for line in lines:
+        vertices += len(line.coords)
+
+        if len(line.coords) < 3:
+            thresholds = np.full(len(line.coords), np.inf)
+        else:
+            thresholds = douglas_peucker_thresholds(project(line.coords), min_tolerance=tolerances[0])
+
+        for t in tolerances:
+            mask = thresholds > t
+            levels[t].append(line.with_coords(line.coords[mask]))
+            kept[t] += int(mask.sum())
+
+    return levels, SimplificationStats(vertices, kept)
+
+
+def bus_line_url(line_id: int) -> str:
+    return '{}/lineasbuses/json_rutas?lbsId={}'.format(CRUZERO_URL, line_id)
+
+
+def _is_bus_line(content: bytes) -> bool:
+    # A maintenance page or a truncated body is not worth keeping for a day
     try:
-        data = r.json()
+        data = json.loads(content.decode('utf-8'))
     except ValueError:
-        raise DataNotAvailableException()
+        return False
+    return isinstance(data, dict) and 'infoLinea' in data and 'lineasbusesruta' in data
+
+
+def _lists_bus_lines(content: bytes) -> bool:
+    return _LINE_ID_PATTERN.search(content.decode('utf-8', errors='replace')) is not None
+
 
-    points: List[LatLng] = []
+def _parse_bus_line(line_id: int, r, dtype) -> BusLine:
+    metrics.incr('cruzero.bytes', len(r.content))
+
+    with metrics.stage('cruzero.parse'):
+        try:
+            data = r.json()
+        except ValueError:
+            raise DataNotAvailableException()
+
+        info = data['infoLinea']
+        route = data['lineasbusesruta']
+
+        # Parse the route straight into one contiguous array, without intermediate point objects
+        coords = np.empty((len(route), 2), dtype=dtype)
+        coords[:, 0] = np.fromiter((float(p['lbrLongitud']) for p in route), dtype=dtype, count=len(route))
+        coords[:, 1] = np.fromiter((float(p['lbrLatitud']) for p in route), dtype=dtype, count=len(route))
+
+    metrics.incr('cruzero.points', len(route))
 
     bus_line = BusLine(line_id=line_id,
-                       name=data['infoLinea']['lbsNombre'],
-                       speed=Decimal(data['infoLinea']['lbsVelocidad']),
-                       distance=Decimal(data['infoLinea']['lbsDistancia']),
-                       total_time=Decimal(data['infoLinea']['lbsTiempo']),
-                       points=points,
+                       name=info['lbsNombre'],
+                       speed=Decimal(info['lbsVelocidad']),
+                       distance=Decimal(info['lbsDistancia']),
+                       total_time=Decimal(info['lbsTiempo']),
+                       coords=coords,
                        )
 
-    for point_data in data['lineasbusesruta']:
-        points.append(LatLng(lat=Decimal(point_data['lbrLatitud']),
-                             lng=Decimal(point_data['lbrLongitud']),
-                             ))
-
     return bus_line
 
 
-def get_all_bus_line_ids() -> List[int]:
-    url = 'http://cruzero.net/cruzero/lineasbuses'
+def get_bus_line(line_id: int, session: Optional[requests.Session] = None, timeout: Optional[float] = None,
+                 cache: Optional[ResponseCache] = None, refresh: bool = False, dtype=np.float64) -> BusLine:
+    with metrics.stage('cruzero.request'):
+        r = cached_request('GET', bus_line_url(line_id), cache=cache, ttl=CACHE_TTL, refresh=refresh,
+                           session=session, timeout=timeout, validate=_is_bus_line)
+    metrics.incr('cruzero.requests')
+
+    return _parse_bus_line(line_id, r, dtype)
+
+
+def get_bus_line_if_modified(line_id: int, etag: Optional[str] = None, last_modified: Optional[str] = None,
+                             session: Optional[requests.Session] = None, timeout: Optional[float] = None,
+                             dtype=np.float64) -> Tuple[Optional[BusLine], Dict[str, Optional[str]]]:
+    """
+    Fetch a bus line unless it is unchanged since the response that carried `etag` or `last_modified`.
+
+    Returns None instead of the line when the server answers 304 Not Modified, together with the validators
+    to send next time. A server that ignores conditional requests simply always sends the line.
+    """
+    headers = {}
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
 
-    html = requests.get(url).text
+    with metrics.stage('cruzero.request'):
+        r = (session or requests).get(bus_line_url(line_id), headers=headers, timeout=timeout)
+    metrics.incr('cruzero.requests')
+
+    if r.status_code == 304:
+        metrics.incr('cruzero.not_modified')
+        return None, {'etag': r.headers.get('ETag', etag),
+                      'last_modified': r.headers.get('Last-Modified', last_modified)}
+
+    return _parse_bus_line(line_id, r, dtype), {'etag': r.headers.get('ETag'),
+                                                 'last_modified': r.headers.get('Last-Modified')}
+
+
+def get_all_bus_line_ids(session: Optional[requests.Session] = None, timeout: Optional[float] = None,
+                         cache: Optional[ResponseCache] = None, refresh: bool = False) -> List[int]:
+    url = '{}/lineasbuses'.format(CRUZERO_URL)
+
+    with metrics.stage('cruzero.request'):
+        html = cached_request('GET', url, cache=cache, ttl=CACHE_TTL, refresh=refresh, session=session,
+                              timeout=timeout, validate=_lists_bus_lines).text
+    metrics.incr('cruzero.requests')
 
     result = []
 
-    for match in re.findall(r'mostrarLinea\((\d+),', html):
+    for match in _LINE_ID_PATTERN.findall(html):
         result.append(int(match))
 
     return result
 
 
-def get_all_bus_lines() -> List[BusLine]:
-    return list(map(get_bus_line, get_all_bus_line_ids()))
+class BusLineFailure:
+    def __init__(self, line_id: int, error: Exception):
+        self.line_id = line_id
+        self.error = error
+
+    def __repr__(self):
+        return 'BusLineFailure({!r}, {!r})'.format(self.line_id, self.error)
+
+
+class HarvestResult:
+    def __init__(self, lines: List[BusLine], failures: List[BusLineFailure]):
+        self.lines = lines
+        self.failures = failures
+
+    def __repr__(self):
+        return 'HarvestResult(lines={}, failures={!r})'.format(len(self.lines), self.failures)
+
+
+def harvest_bus_lines(line_ids: Optional[Iterable[int]] = None, workers: int = 8, per_host: int = 4,
+                      session: Optional[requests.Session] = None, timeout: Optional[float] = 30.0,
+                      cache: Optional[ResponseCache] = None, refresh: bool = False,
+                      dtype=np.float64) -> HarvestResult:
+    """
+    Fetch many bus lines concurrently over one pooled session.
+
+    Lines come back in the same order as `line_ids` (or as listed by the site when omitted), no matter
+    in which order the requests finish. Lines that could not be fetched are reported as failures
+    instead of aborting the whole harvest.
+    """
+    if workers < 1:
+        raise ValueError('workers >= 1')
+
+    if session is None:
+        session = make_session(pool_size=min(workers, per_host))
+
+    if line_ids is None:
+        line_ids = get_all_bus_line_ids(session=session, timeout=timeout, cache=cache, refresh=refresh)
+
+    limiter = HostLimiter(per_host)
+
+    def fetch(line_id: int) -> BusLine:
+        with limiter.limit(CRUZERO_URL):
+            return get_bus_line(line_id, session=session, timeout=timeout, cache=cache, refresh=refresh,
+                                dtype=dtype)
+
+    lines = []
+    failures = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(line_id, executor.submit(fetch, line_id)) for line_id in line_ids]
+
+        for line_id, future in futures:
+            try:
+                lines.append(future.result())
+            except (DataNotAvailableException, requests.RequestException,
+                    KeyError, TypeError, ValueError, InvalidOperation) as e:
+                failures.append(BusLineFailure(line_id, e))
+
+    return HarvestResult(lines, failures)
+
+
+def get_all_bus_lines(workers: int = 8) -> List[BusLine]:
+    result = harvest_bus_lines(workers=workers)
+
+    if result.failures:
+        raise result.failures[0].error
+
+    return result.lines
@@ -0,0 +1,382 @@
+"""
+Long-running refresh of the SIC prices and the Cruzero routes, instead of one cron-launched script per run.
+
+A `Scheduler` runs periodic `Job`s on a thread pool, all of them sharing one pooled, rate-limited session,
+so connections stay open between runs and overlapping refreshes take turns at each host. A job whose
+previous run is still going is not started again, and `stop` lets the running jobs finish. `StatusServer`
+reports the queue and the latency of every job over HTTP.
+"""
+import heapq
+import json
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Callable, Hashable, Optional, Iterable, List, Dict
+
+import requests
+
+from opendatabo import metrics
+from opendatabo.aggregates import PriceAggregates
+from opendatabo.common import HostLimiter, RetryPolicy
+from opendatabo.routes import RouteSnapshot
+from opendatabo.sic import City, Timeframe, Today, Year, get_market_prices, make_retry_policy
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time: asking for a key already in flight returns the future of
+    that call instead of starting another.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._calls)
+
+    def submit(self, key: Hashable, executor, fn: Callable, *args) -> (Future, bool):
+        """The future of the call for `key`, and whether this submission started it."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+
+            future = executor.submit(fn, *args)
+            self._calls[key] = future
+
+        future.add_done_callback(lambda f: self._done(key, f))
+        return future, True
+
+    def _done(self, key: Hashable, future: Future) -> None:
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+
+class Job:
+    """`func` run every `interval` seconds. Jobs sharing a `key` (the name by default) never run at once."""
+
+    def __init__(self, name: str, interval: float, func: Callable[[], object], key: Optional[Hashable] = None):
+        if interval <= 0:
+            raise ValueError('interval > 0')
+
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.key = name if key is None else key
+
+    def __repr__(self):
+        return 'Job({!r}, interval={:g})'.format(self.name, self.interval)
+
+
+class JobStatus:
+    def __init__(self, job: Job):
+        self.job = job
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.next_run = None
+        self.last_started = None
+        self.last_finished = None
+        self.last_latency = None
+        self.last_error = None
+        self.last_result = None
+
+    def to_dict(self, now: float) -> dict:
+        return {
+            'interval': self.job.interval,
+            'runs': self.runs,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'next_run_in': None if self.next_run is None else max(0.0, self.next_run - now),
+            'last_started': self.last_started,
+            'last_finished': self.last_finished,
+            'last_latency': self.last_latency,
+            'last_error': self.last_error,
+            'last_result': self.last_result,
+        }
+
+
+class Scheduler:
+    """
+    Runs jobs on a pool of `workers` threads, each first `delay` seconds after `add` and then every
+    `interval` seconds after the previous run started. When a run is due while the previous one is still
+    in flight, it is skipped rather than queued behind it.
+
+    Failures are logged (with a `logger`) and kept in the status; the job runs again at its next time.
+    """
+
+    def __init__(self, workers: int = 4, logger=None):
+        if workers < 1:
+            raise ValueError('workers >= 1')
+
+        self.logger = logger
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._flights = SingleFlight()
+        self._cond = threading.Condition()
+        self._heap = []
+        self._status = {}
+        self._futures = set()
+        self._queued = 0
+        self._running = 0
+        self._stopping = False
+        self._thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+
+    def add(self, job: Job, delay: float = 0.0) -> None:
+        with self._cond:
+            if job.name in self._status:
+                raise ValueError('job already added: {!r}'.format(job.name))
+
+            status = JobStatus(job)
+            status.next_run = time.monotonic() + delay
+            self._status[job.name] = status
+            heapq.heappush(self._heap, (status.next_run, job.name))
+            self._cond.notify()
+
+    def start(self) -> 'Scheduler':
+        self._thread.start()
+        return self
+
+    def trigger(self, name: str) -> Future:
+        """Run a job now, out of schedule; or get the future of its run in flight."""
+        with self._cond:
+            job = self._status[name].job
+        return self._submit(job)
+
+    def _submit(self, job: Job) -> Future:
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError('scheduler is stopping')
+
+            future, started = self._flights.submit(job.key, self._executor, self._run, job)
+            if started:
+                self._queued += 1
+                self._futures.add(future)
+                future.add_done_callback(self._forget)
+            else:
+                self._status[job.name].skipped += 1
+                metrics.incr('daemon.skipped')
+
+        return future
+
+    def _forget(self, future: Future) -> None:
+        with self._cond:
+            self._futures.discard(future)
+            if future.cancelled():
+                self._queued -= 1
+
+    def _run(self, job: Job):
+        status = self._status[job.name]
+
+        with self._cond:
+            self._queued -= 1
+            self._running += 1
+            status.last_started = time.time()
+
+        start = time.perf_counter()
+        error = None
+        result = None
+        try:
+            with metrics.stage('daemon.' + job.name):
+                result = job.func()
+        except Exception as e:
+            error = e
+        latency = time.perf_counter() - start
+
+        with self._cond:
+            self._running -= 1
+            status.runs += 1
+            status.last_finished = time.time()
+            status.last_latency = latency
+            status.last_result = None if result is None else repr(result)
+            status.last_error = None if error is None else repr(error)
+            status.failures += error is not None
+
+        if self.logger is not None:
+            if error is None:
+                self.logger.info('job done', job=job.name, seconds=latency, result=result)
+            else:
+                self.logger.warning('job fail', job=job.name, seconds=latency, error=error)
+
+        if error is not None:
+            raise error
+        return result
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._stopping and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    self._cond.wait(None if not self._heap else self._heap[0][0] - time.monotonic())
+
+                if self._stopping:
+                    return
+
+                due, name = heapq.heappop(self._heap)
+                status = self._status[name]
+                # The next run counts from when this one was due, so runs do not drift later and later
+                status.next_run = max(due + status.job.interval, time.monotonic())
+                heapq.heappush(self._heap, (status.next_run, name))
+
+            try:
+                self._submit(status.job)
+            except RuntimeError:
+                return
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        with self._cond:
+            return {
+                'queued': self._queued,
+                'running': self._running,
+                'stopping': self._stopping,
+                'jobs': {name: status.to_dict(now) for name, status in sorted(self._status.items())},
+            }
+
+    def stop(self, wait: bool = True) -> None:
+        """Stop scheduling, drop the runs not yet started, and (with `wait`) let the running ones finish."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            pending = list(self._futures)
+
+        for future in pending:
+            future.cancel()
+
+        if self._thread.is_alive():
+            self._thread.join()
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StatusServer:
+    """Serves `scheduler.status()` as JSON at `GET /status` on `host`:`port` (0 picks a free port)."""
+
+    def __init__(self, scheduler: Scheduler, host: str = '127.0.0.1', port: int = 0):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/status'):
+                    self.send_error(404)
+                    return
+
+                body = json.dumps(scheduler.status()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='status', daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return 'http://{}:{}/status'.format(host, port)
+
+    def start(self) -> 'StatusServer':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def _prices_job(name: str, key: Hashable, city: City, timeframe: Callable[[], Timeframe], interval: float,
+                aggregates: PriceAggregates, session: requests.Session, limiter: HostLimiter,
+                timeout: Optional[float], retry_policy: Optional[RetryPolicy]) -> Job:
+    def refresh() -> int:
+        # Asked for on every run, so a timeframe can move on while the daemon runs
+        tf = timeframe()
+        df = get_market_prices(city, tf, session=session, timeout=timeout, retry_policy=retry_policy,
+                               limiter=limiter)
+        return aggregates.ingest(city, df, source=tf.to_filename_suffix())
+
+    return Job(name, interval, refresh, key=key)
+
+
+def market_prices_job(city: City, timeframe: Timeframe, interval: float, aggregates: PriceAggregates,
+                      session: requests.Session, limiter: HostLimiter, timeout: Optional[float] = 60.0,
+                      retry_policy: Optional[RetryPolicy] = None) -> Job:
+    """Fetch the prices of `city` for `timeframe` into the store of `aggregates`, every `interval` seconds."""
+    # The filename suffix of Today is the date, which would rename the job every day
+    name = 'sic-{}-{}'.format(city.value, 'hoy' if isinstance(timeframe, Today) else timeframe.to_filename_suffix())
+    return _prices_job(name, ('sic', city, timeframe), city, lambda: timeframe, interval, aggregates, session,
+                       limiter, timeout, retry_policy)
+
+
+def current_year_job(city: City, interval: float, aggregates: PriceAggregates, session: requests.Session,
+                     limiter: HostLimiter, timeout: Optional[float] = 60.0,
+                     retry_policy: Optional[RetryPolicy] = None) -> Job:
+    """Like `market_prices_job` for the year running when each refresh starts, rather than when it was made."""
+    return _prices_job('sic-{}-ano'.format(city.value), ('sic', city, Year), city, Year.current, interval,
+                       aggregates, session, limiter, timeout, retry_policy)
+
+
+def routes_job(snapshot: RouteSnapshot, interval: float, session: requests.Session, workers: int = 8,
+               per_host: int = 4, timeout: Optional[float] = 30.0) -> Job:
+    """Sync the bus lines into `snapshot` every `interval` seconds."""
+
+    def refresh():
+        return snapshot.sync(workers=workers, per_host=per_host, session=session, timeout=timeout).diff
+
+    return Job('cruzero-routes', interval, refresh)
+
+
+def refresh_jobs(aggregates: Optional[PriceAggregates], snapshot: Optional[RouteSnapshot],
+                 session: requests.Session, cities: Optional[Iterable[City]] = None, today_every: float = 15 * 60,
+                 year_every: float = 60 * 60, routes_every: float = 24 * 60 * 60, per_host: int = 4,
+                 timeout: Optional[float] = 60.0) -> List[Job]:
+    """
+    Today's prices of every city every `today_every` seconds, the current year every `year_every` seconds and
+    the bus routes every `routes_every` seconds. Prices are only refreshed with `aggregates` to keep them in,
+    routes only with a `snapshot`.
+    """
+    jobs = []
+
+    if aggregates is not None:
+        cities = list(cities or City.all())
+        limiter = HostLimiter(per_host)
+        # One circuit breaker on the SIC host for every price job
+        retry_policy = make_retry_policy()
+        for city in cities:
+            jobs.append(market_prices_job(city, Today(), today_every, aggregates, session, limiter, timeout,
+                                          retry_policy))
+        # The current year is the last one the SIC publishes
+        for city in cities:
+            jobs.append(current_year_job(city, year_every, aggregates, session, limiter, timeout, retry_policy))
+
+    if snapshot is not None:
+        jobs.append(routes_job(snapshot, routes_every, session, per_host=per_host, timeout=timeout))
+
+    return jobs
+
+
+def stagger(jobs: List[Job], spread: float) -> Dict[str, float]:
+    """First-run delays spreading `jobs` evenly over `spread` seconds, so they do not all start at once."""
+    if not jobs:
+        return {}
+    step = spread / len(jobs)
+    return {job.name: i * step for i, job in enumerate(jobs)}
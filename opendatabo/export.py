@@ -0,0 +1,190 @@
+import gzip
+import io
+import os
+from collections import OrderedDict
+from typing import Optional, Iterable
+
+import pandas as pd
+
+# Low-cardinality text columns, stored as dictionary-encoded categoricals in the columnar formats
+CATEGORICAL_COLUMNS = ['producto', 'variedad', 'procedencia', 'mercado',
+                       'Procedencia', 'Nom_Procedencia', 'Mercado']
+
+FORMATS = {'csv': '.csv',
+           'parquet': '.parquet',
+           'feather': '.feather',
+           }
+
+CSV_COMPRESSIONS = {None: '',
+                    'gzip': '.gz',
+                    'zstd': '.zst',
+                    }
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('the parquet and feather formats need pyarrow installed')
+    return pyarrow
+
+
+def make_filename(stem: str, format: str = 'csv', compression: Optional[str] = None) -> str:
+    if format not in FORMATS:
+        raise ValueError('unknown format: {!r}'.format(format))
+
+    suffix = FORMATS[format]
+    if format == 'csv':
+        suffix += CSV_COMPRESSIONS[compression]
+    return stem + suffix
+
+
+def _open_csv(path: str, compression: Optional[str]):
+    if compression is None:
+        return open(path, 'w', encoding='utf-8', newline='')
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstd compression needs zstandard installed')
+        raw = open(path, 'wb')
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(raw), encoding='utf-8', newline='')
+    raise ValueError('unknown compression: {!r}'.format(compression))
+
+
+def _to_table(df: pd.DataFrame):
+    pa = _import_pyarrow()
+
+    columns = {col: df[col].astype('category') for col in CATEGORICAL_COLUMNS
+               if col in df.columns and df[col].dtype == object}
+    if columns:
+        df = df.assign(**columns)
+
+    # The index (e.g. the fecha/producto/variedad MultiIndex) is stored too, and restored on load
+    return pa.Table.from_pandas(df, preserve_index=True)
+
+
+def write_market_prices(df: pd.DataFrame, path: str, format: str = 'csv', compression: Optional[str] = None) -> None:
+    """
+    Write a market prices frame to `path`.
+
+    CSV goes through a streaming gzip or zstd writer when `compression` is given. Parquet and feather keep
+    the dtypes and the index, with the text columns dictionary-encoded; `compression` is then passed on to
+    pyarrow.
+    """
+    if format == 'csv':
+        with _open_csv(path, compression) as f:
+            df.to_csv(f)
+    elif format == 'parquet':
+        pa = _import_pyarrow()
+        pa.parquet.write_table(_to_table(df), path, compression=compression or 'snappy')
+    elif format == 'feather':
+        pa = _import_pyarrow()
+        pa.feather.write_feather(_to_table(df), path, compression=compression)
+    else:
+        raise ValueError('unknown format: {!r}'.format(format))
+
+
+def _read_table(path: str):
+    pa = _import_pyarrow()
+
+    if path.endswith(FORMATS['parquet']):
+        return pa.parquet.read_table(path)
+    if path.endswith(FORMATS['feather']):
+        return pa.feather.read_table(path)
+    raise ValueError('not a columnar file: {!r}'.format(path))
+
+
+def load_market_prices(path: str) -> pd.DataFrame:
+    """Load a frame written by `write_market_prices` in a columnar format, with its index restored."""
+    return _read_table(path).to_pandas()
+
+
+def _partition_dir(root: str, city: str, year: int) -> str:
+    return os.path.join(root, 'city={}'.format(city), 'year={}'.format(year))
+
+
+def write_partitioned(df: pd.DataFrame, root: str, city: str, format: str = 'parquet',
+                      compression: Optional[str] = None) -> None:
+    """
+    Write a prepared (date-indexed) frame under `root` as one file per year, in `city=<code>/year=<yyyy>/`
+    directories. `city` is the city code, e.g. `City.SANTA_CRUZ.value`.
+    """
+    if format == 'csv':
+        raise ValueError('partitions are written in a columnar format')
+
+    years = pd.to_datetime(df.index.get_level_values('fecha')).year
+
+    for year, part in df.groupby(years):
+        directory = _partition_dir(root, city, year)
+        os.makedirs(directory, exist_ok=True)
+        write_market_prices(part, os.path.join(directory, make_filename('part', format)), format=format,
+                            compression=compression)
+
+
+def load_partitioned(root: str, city: str, years: Optional[Iterable[int]] = None) -> pd.DataFrame:
+    """Load the partitions of a city written by `write_partitioned`, all years unless given."""
+    pa = _import_pyarrow()
+
+    city_dir = os.path.join(root, 'city={}'.format(city))
+    if years is None:
+        years = sorted(int(name[len('year='):]) for name in os.listdir(city_dir) if name.startswith('year='))
+
+    tables = []
+    for year in years:
+        directory = _partition_dir(root, city, year)
+        for name in sorted(os.listdir(directory)):
+            tables.append(_read_table(os.path.join(directory, name)))
+
+    if not tables:
+        raise FileNotFoundError(city_dir)
+
+    # Concatenate in Arrow first so that the pandas conversion happens once
+    return pa.concat_tables(_unify_tables(tables)).to_pandas()
+
+
+def _common_type(pa, a, b):
+    if a == b or pa.types.is_null(b):
+        return a
+    if pa.types.is_null(a):
+        return b
+    # pandas makes an integer column float as soon as one value is missing, so years written apart differ
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in (a, b)):
+        return pa.float64()
+    raise ValueError('incompatible partition types: {} and {}'.format(a, b))
+
+
+def _unify_tables(tables: list) -> list:
+    """Cast tables written separately to one schema, with the columns of all of them in order of appearance."""
+    pa = _import_pyarrow()
+
+    types = OrderedDict()
+    for table in tables:
+        for field in table.schema:
+            types[field.name] = _common_type(pa, types[field.name], field.type) if field.name in types else field.type
+
+    # The pandas metadata (index columns, column order) of the first table restores the frame
+    schema = pa.schema([pa.field(name, t) for name, t in types.items()], metadata=tables[0].schema.metadata)
+
+    unified = []
+    for table in tables:
+        columns = []
+        for field in schema:
+            if field.name not in table.schema.names:
+                columns.append(pa.nulls(table.num_rows, field.type))
+                continue
+
+            column = table.column(field.name)
+            if pa.types.is_null(column.type):
+                column = pa.nulls(table.num_rows, field.type)
+            elif column.type != field.type:
+                column = column.cast(field.type)
+            columns.append(column)
+
+        unified.append(pa.Table.from_arrays(columns, schema=schema))
+
+    return unified
@@ -0,0 +1,115 @@
+from typing import Optional
+
+import numpy as np
+
+# Mean Earth radius, in meters
+EARTH_RADIUS = 6371008.8
+
+
+def project(coords: np.ndarray, origin: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Project (lng, lat) degrees to planar (x, y) meters around `origin` (the first point by default), using an
+    equirectangular approximation. Accurate enough for distances within a city.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    if origin is None:
+        origin = coords[0] if len(coords) else np.zeros(2)
+
+    lng0, lat0 = origin
+    rad = np.pi / 180.0
+
+    xy = np.empty_like(coords)
+    xy[:, 0] = (coords[:, 0] - lng0) * rad * EARTH_RADIUS * np.cos(lat0 * rad)
+    xy[:, 1] = (coords[:, 1] - lat0) * rad * EARTH_RADIUS
+    return xy
+
+
+def segment_distances(points: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Distance from each of `points` to the segment(s) `a`-`b`, which broadcast against the points."""
+    ab = b - a
+    ap = points - a
+
+    length2 = np.einsum('...i,...i->...', ab, ab)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.einsum('...i,...i->...', ap, ab) / length2
+    t = np.clip(np.nan_to_num(t), 0.0, 1.0)
+
+    diff = points - (a + t[..., np.newaxis] * ab)
+    return np.hypot(diff[..., 0], diff[..., 1])
+
+
+def douglas_peucker_thresholds(xy: np.ndarray, min_tolerance: float = 0.0) -> np.ndarray:
+    """
+    Rank the vertices of a planar polyline by Douglas-Peucker significance.
+
+    Vertex i survives simplification with tolerance t exactly when `thresholds[i] > t`, so one call serves
+    every tolerance at or above `min_tolerance`. The end points are always kept.
+    """
+    n = len(xy)
+    thresholds = np.zeros(n)
+    if n == 0:
+        return thresholds
+
+    thresholds[0] = thresholds[-1] = np.inf
+
+    stack = [(0, n - 1, np.inf)]
+
+    while stack:
+        start, end, parent = stack.pop()
+        if end - start < 2:
+            continue
+
+        d = segment_distances(xy[start + 1:end], xy[start], xy[end])
+        k = int(np.argmax(d))
+        dmax = d[k]
+
+        if dmax <= min_tolerance:
+            continue
+
+        # A vertex is only ever reached if every split above it was kept too
+        threshold = min(dmax, parent)
+        k += start + 1
+        thresholds[k] = threshold
+
+        stack.append((start, k, threshold))
+        stack.append((k, end, threshold))
+
+    return thresholds
+
+
+def simplify(coords: np.ndarray, tolerance: float) -> np.ndarray:
+    """Simplify a (lng, lat) polyline with Douglas-Peucker, `tolerance` being in meters."""
+    if len(coords) < 3:
+        return coords
+
+    thresholds = douglas_peucker_thresholds(project(coords), min_tolerance=tolerance)
+    return coords[thresholds > tolerance]
+
+
+def clip_segments(a: np.ndarray, b: np.ndarray, lo, hi) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Liang-Barsky clipping of the segments `a`-`b` against the axis-aligned box [lo, hi].
+
+    Returns (t0, t1, inside): the clipped part of segment i runs from a + t0 * (b - a) to a + t1 * (b - a), and
+    `inside[i]` tells whether any part of it lies in the box at all.
+    """
+    d = b - a
+    t0 = np.zeros(len(a))
+    t1 = np.ones(len(a))
+    inside = np.ones(len(a), dtype=bool)
+
+    for axis in (0, 1):
+        for p, q in ((-d[:, axis], a[:, axis] - lo[axis]), (d[:, axis], hi[axis] - a[:, axis])):
+            parallel = p == 0
+            inside &= ~(parallel & (q < 0))
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                r = q / p
+            entering = ~parallel & (p < 0)
+            leaving = ~parallel & (p > 0)
+
+            t0 = np.where(entering, np.maximum(t0, r), t0)
+            t1 = np.where(leaving, np.minimum(t1, r), t1)
+
+    inside &= t0 <= t1
+    return t0, t1, inside
@@ -0,0 +1,152 @@
+"""
+k-way merge of sorted market price partitions into one sorted dataset, a chunk at a time.
+
+Every (City, Year) partition of a `PartitionStore` is a CSV already sorted by (fecha, producto, variedad).
+Merging them streams the rows straight to the output in key order, holding at most one chunk per partition
+in memory instead of the whole history of a city, and never sorting more than those chunks.
+"""
+import warnings
+from typing import Optional, Sequence, List
+
+import numpy as np
+import pandas as pd
+
+from opendatabo import metrics
+from opendatabo.sic import INDEX_COLUMNS
+
+
+class UnsortedPartitionError(ValueError):
+    def __init__(self, path: str):
+        self.path = path
+        super(UnsortedPartitionError, self).__init__('partition is not sorted by a unique key: {!r}'.format(path))
+
+
+class MergeStats:
+    def __init__(self, rows: int = 0, duplicates: int = 0):
+        self.rows = rows
+        self.duplicates = duplicates
+
+    def __repr__(self):
+        return 'MergeStats(rows={}, duplicates={})'.format(self.rows, self.duplicates)
+
+
+def _sort_keys(df: pd.DataFrame) -> np.ndarray:
+    """
+    One string per row that sorts like the (fecha, producto, variedad) index of the prepared frame: ISO dates,
+    strings by code point, and missing values last.
+    """
+    key = df['fecha'].values.astype(object)
+    for c in INDEX_COLUMNS[1:]:
+        values = df[c].values.astype(object)
+        # '\x01' ends each part, so a string sorts before its own extensions as in a tuple comparison, and the
+        # next character puts missing values after every other
+        key = key + np.where(values == '', '\x01\x03', '\x01\x02').astype(object) + values
+    return key
+
+
+class _Source:
+    """The sorted rows of one partition, a chunk at a time."""
+
+    def __init__(self, path: str, chunksize: int):
+        self.path = path
+        # Everything stays text, so values are written back exactly as they were read
+        self._reader = pd.read_csv(path, dtype=str, keep_default_na=False, chunksize=chunksize)
+        self.columns = None
+        self.chunk = None
+        self.keys = None
+        self._last_key = None
+        self.advance()
+
+    def advance(self) -> None:
+        try:
+            chunk = next(self._reader)
+        except StopIteration:
+            self.chunk = self.keys = None
+            return
+
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+
+        keys = _sort_keys(chunk)
+        last = self._last_key
+        if (keys[1:] <= keys[:-1]).any() or (last is not None and len(keys) and keys[0] <= last):
+            raise UnsortedPartitionError(self.path)
+
+        self.chunk = chunk
+        self.keys = keys
+        self._last_key = keys[-1] if len(keys) else self._last_key
+
+        if not len(keys):
+            self.advance()
+
+    def take(self, n: int) -> (pd.DataFrame, np.ndarray):
+        """Remove and return the first `n` rows of the current chunk, loading the next chunk once it runs out."""
+        rows, keys = self.chunk.iloc[:n], self.keys[:n]
+
+        if n == len(self.keys):
+            self.advance()
+        else:
+            self.chunk, self.keys = self.chunk.iloc[n:], self.keys[n:]
+
+        return rows, keys
+
+
+def merge_partitions(paths: Sequence[str], fp, chunksize: int = 10000,
+                     columns: Optional[List[str]] = None) -> MergeStats:
+    """
+    Merge sorted partition CSVs into the text file `fp` as one sorted CSV, with a header.
+
+    Rows sharing a key in several partitions are resolved as `prepare_raw_market_prices` resolves them in one
+    export: the row of the last partition in `paths` wins, and a warning is issued. `columns` defaults to the
+    columns of all the partitions, in order of appearance; a partition lacking one leaves it empty.
+    """
+    sources = [_Source(path, chunksize) for path in paths]
+
+    if columns is None:
+        columns = []
+        for source in sources:
+            for c in source.columns or []:
+                if c not in columns:
+                    columns.append(c)
+
+    fp.write(pd.DataFrame(columns=columns).to_csv(index=False))
+
+    stats = MergeStats()
+
+    with metrics.stage('merge.partitions'):
+        while True:
+            active = [source for source in sources if source.keys is not None]
+            if not active:
+                break
+
+            # Every row up to the smallest of the chunks' last keys can be written: no later chunk goes below it
+            bound = min(source.keys[-1] for source in active)
+
+            blocks = []
+            keys = []
+            for source in active:
+                n = int(np.searchsorted(source.keys, bound, side='right'))
+                if n:
+                    rows, row_keys = source.take(n)
+                    blocks.append(rows.reindex(columns=columns, fill_value=''))
+                    keys.append(row_keys)
+
+            keys = np.concatenate(keys)
+            block = pd.concat(blocks, ignore_index=True)
+
+            # Stable, so rows sharing a key stay in partition order and the last one is kept
+            order = np.argsort(keys, kind='mergesort')
+            keys = keys[order]
+            keep = np.append(keys[1:] != keys[:-1], True)
+
+            stats.duplicates += int((~keep).sum())
+
+            block = block.iloc[order[keep]]
+            block.to_csv(fp, header=False, index=False)
+            stats.rows += block.shape[0]
+
+    if stats.duplicates:
+        warnings.warn('duplicates were found when building the dataset index. duplicates were DROPPED')
+
+    metrics.incr('merge.rows', stats.rows)
+    return stats
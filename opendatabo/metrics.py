@@ -0,0 +1,125 @@
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+
+class Metrics:
+    """
+    Per-stage durations and counters (bytes transferred, rows parsed, retries, ...) of one run.
+
+    Stage timings are also logged as structlog events when a logger is given.
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                calls, seconds = self._stages.get(name, (0, 0.0))
+                self._stages[name] = (calls + 1, seconds + elapsed)
+            if self.logger is not None:
+                self.logger.debug('stage', stage=name, seconds=elapsed)
+
+    def incr(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {'stages': {name: {'calls': calls, 'seconds': seconds}
+                               for name, (calls, seconds) in sorted(self._stages.items())},
+                    'counters': dict(sorted(self._counters.items())),
+                    }
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self, prefix: str = 'opendatabo') -> str:
+        summary = self.summary()
+        lines = []
+
+        lines.append('# TYPE {}_stage_seconds_total counter'.format(prefix))
+        for name, stage in summary['stages'].items():
+            lines.append('{}_stage_seconds_total{{stage="{}"}} {!r}'.format(prefix, name, stage['seconds']))
+
+        lines.append('# TYPE {}_stage_calls_total counter'.format(prefix))
+        for name, stage in summary['stages'].items():
+            lines.append('{}_stage_calls_total{{stage="{}"}} {}'.format(prefix, name, stage['calls']))
+
+        for name, value in summary['counters'].items():
+            metric = '{}_{}_total'.format(prefix, re.sub(r'[^a-zA-Z0-9_]', '_', name))
+            lines.append('# TYPE {} counter'.format(metric))
+            lines.append('{} {!r}'.format(metric, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str, prefix: str = 'opendatabo') -> None:
+        """Write the metrics for node_exporter's textfile collector, replacing the file atomically."""
+        # Imported here since opendatabo.common itself reports retries through this module
+        from opendatabo.common import atomic_write
+        atomic_write(path, self.to_prometheus(prefix).encode('utf-8'))
+
+    def write_json(self, path: str) -> None:
+        from opendatabo.common import atomic_write
+        atomic_write(path, self.to_json().encode('utf-8'))
+
+    def log_summary(self, logger) -> None:
+        summary = self.summary()
+        for name, stage in summary['stages'].items():
+            logger.info('stage summary', stage=name, calls=stage['calls'], seconds=stage['seconds'])
+        logger.info('counters summary', **summary['counters'])
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+_active: Optional[Metrics] = None
+
+
+def enable(metrics: Optional[Metrics] = None) -> Metrics:
+    """Start recording into `metrics` (a new one if omitted). Recording is off until this is called."""
+    global _active
+    _active = Metrics() if metrics is None else metrics
+    return _active
+
+
+def disable() -> None:
+    global _active
+    _active = None
+
+
+def current() -> Optional[Metrics]:
+    return _active
+
+
+def stage(name: str):
+    """Time a block as stage `name`. A shared no-op context manager while recording is off."""
+    metrics = _active
+    if metrics is None:
+        return _NULL_STAGE
+    return metrics.stage(name)
+
+
+def incr(name: str, value: float = 1) -> None:
+    metrics = _active
+    if metrics is not None:
+        metrics.incr(name, value)
@@ -0,0 +1,154 @@
+"""
+Parsing of SIC exports on a pool of processes.
+
+`pd.read_csv` and `prepare_raw_market_prices` hold the GIL for most of their work, so threads do not help
+once downloads are concurrent. `MarketPricesParser` splits each payload into chunks of whole rows, prepares
+every chunk in a worker process and ships the result back as an Arrow IPC stream, a few flat buffers
+instead of a pickled frame. The frames put together are the same as preparing the whole payload at once.
+"""
+import io
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+from opendatabo import metrics
+from opendatabo.sic import INDEX_COLUMNS, drop_duplicate_index, prepare_raw_market_prices
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('parallel parsing needs pyarrow installed')
+    return pyarrow
+
+
+def split_csv(payload: bytes, chunk_size: int) -> List[bytes]:
+    """
+    Split a CSV payload into chunks of about `chunk_size` bytes, each a valid CSV with the header repeated.
+
+    Chunks only end on line breaks outside of quoted fields, so no row is ever cut in two. Each chunk infers
+    its column types on its own, so a column mixing numbers and text may read differently than in one piece;
+    the SIC columns are either always text or always prices.
+    """
+    if chunk_size < 1:
+        raise ValueError('chunk_size >= 1')
+
+    header_end = payload.find(b'\n') + 1
+    if header_end == 0 or len(payload) - header_end <= chunk_size:
+        return [payload]
+
+    header = payload[:header_end]
+    chunks = []
+    start = header_end
+
+    while start < len(payload):
+        end = payload.find(b'\n', start + chunk_size - 1)
+
+        # A line break with an odd number of quotes before it lies inside a quoted field
+        while end != -1:
+            quotes = payload.count(b'"', start, end)
+            if quotes % 2 == 0:
+                break
+            end = payload.find(b'\n', end + 1)
+
+        if end == -1:
+            chunks.append(header + payload[start:])
+            break
+
+        chunks.append(header + payload[start:end + 1])
+        start = end + 1
+
+    return chunks
+
+
+def _prepare_chunk(args) -> bytes:
+    """Worker side: parse and prepare one chunk, keeping duplicates, and return it as an Arrow IPC stream."""
+    chunk, compact = args
+    pa = _import_pyarrow()
+
+    raw_df = pd.read_csv(io.BytesIO(chunk), encoding='utf-8')
+    df = prepare_raw_market_prices(raw_df, compact=compact, drop_duplicates=False)
+
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _read_chunk(data: bytes) -> pd.DataFrame:
+    pa = _import_pyarrow()
+
+    df = pa.ipc.open_stream(pa.py_buffer(data)).read_all().to_pandas()
+
+    # Arrow brings missing strings back as None, where `read_csv` gives NaN
+    for c in df.columns:
+        if df[c].dtype == object:
+            df[c] = df[c].where(df[c].notnull(), np.nan)
+
+    return df
+
+
+def _merge_chunks(frames: List[pd.DataFrame], compact: bool) -> pd.DataFrame:
+    df = frames[0] if len(frames) == 1 else pd.concat(frames)
+
+    if compact and len(frames) > 1:
+        # Chunks have categories of their own, the whole payload gets them from all of its rows
+        fecha, producto, variedad = (df.index.get_level_values(name) for name in INDEX_COLUMNS)
+        df.index = pd.MultiIndex.from_arrays([fecha, pd.Categorical(np.asarray(producto)),
+                                              pd.Categorical(np.asarray(variedad))], names=INDEX_COLUMNS)
+
+        categorical = {c: pd.Categorical(np.asarray(df[c])) for c in frames[0].columns
+                       if frames[0][c].dtype.name == 'category'}
+        df = df.assign(**categorical)
+
+    return drop_duplicate_index(df)
+
+
+class MarketPricesParser:
+    """
+    A pool of `processes` workers (one per CPU by default) preparing SIC exports, see `parse` and `parse_many`.
+
+    Payloads larger than `chunk_size` bytes are split, so even a single multi-year export uses every worker.
+    The parser is thread-safe: the threads of `fetch_market_prices` can all feed the same pool.
+    """
+
+    def __init__(self, processes: Optional[int] = None, chunk_size: int = 4 * 2 ** 20, compact: bool = False):
+        _import_pyarrow()
+
+        self.chunk_size = chunk_size
+        self.compact = compact
+        self._executor = ProcessPoolExecutor(max_workers=processes)
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def parse_many(self, payloads: Iterable[bytes]) -> List[pd.DataFrame]:
+        """
+        Prepare several CSV payloads, e.g. the years of a city, with the chunks of all of them in flight at
+        once. Each frame is the same as `prepare_raw_market_prices(pd.read_csv(payload))` would give.
+        """
+        with metrics.stage('sic.parallel_parse'):
+            futures = []
+            for payload in payloads:
+                futures.append([self._executor.submit(_prepare_chunk, (chunk, self.compact))
+                                for chunk in split_csv(payload, self.chunk_size)])
+
+            frames = []
+            for chunk_futures in futures:
+                frames.append(_merge_chunks([_read_chunk(f.result()) for f in chunk_futures], self.compact))
+
+        metrics.incr('sic.rows', sum(df.shape[0] for df in frames))
+        return frames
+
+    def parse(self, payload: bytes) -> pd.DataFrame:
+        return self.parse_many([payload])[0]
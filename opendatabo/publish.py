@@ -0,0 +1,185 @@
+import gzip
+import hashlib
+import io
+import tempfile
+from typing import Callable, Optional, IO
+
+import ckanapi
+import requests
+
+from opendatabo import metrics
+from opendatabo.common import make_session
+
+
+class AmbiguousResourceError(Exception):
+    def __init__(self, name: str, count: int):
+        super().__init__('{} resources are named {!r}'.format(count, name))
+        self.name = name
+        self.count = count
+
+
+class _HashingWriter(io.RawIOBase):
+    """Write-only sink that hashes what it is given and forwards it to `target`."""
+
+    def __init__(self, target: IO[bytes]):
+        super().__init__()
+        self._target = target
+        self.hasher = hashlib.sha256()
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.hasher.update(b)
+        self._target.write(b)
+        self.size += len(b)
+        return len(b)
+
+
+class Artifact:
+    """
+    A rendered resource, spooled to a temporary file rather than held in memory.
+
+    `hash` is the sha256 of the uncompressed content, so it only changes when the data does. Close the
+    artifact (or use it as a context manager) to delete the file.
+    """
+
+    def __init__(self, file: IO[bytes], filename: str, format: str, hash: str, size: int,
+                 compressed_size: int):
+        self.file = file
+        self.filename = filename
+        self.format = format
+        self.hash = hash
+        self.size = size
+        self.compressed_size = compressed_size
+
+    @classmethod
+    def render(cls, write: Callable[[IO[str]], None], filename: str, format: str,
+               compress: bool = False) -> 'Artifact':
+        """
+        Spool what `write` writes into the given text stream to a temporary file, hashing it on the way.
+
+        With `compress` the file is gzipped and '.gz' is appended to `filename`.
+        """
+        file = tempfile.TemporaryFile()
+        try:
+            with metrics.stage('publish.render'):
+                if compress:
+                    # A fixed mtime keeps the compressed bytes identical for identical content
+                    sink = gzip.GzipFile(filename=filename, mode='wb', fileobj=file, mtime=0)
+                    filename += '.gz'
+                else:
+                    sink = file
+
+                hashing = _HashingWriter(sink)
+                text = io.TextIOWrapper(io.BufferedWriter(hashing), encoding='utf-8', newline='')
+                write(text)
+                text.flush()
+                text.detach()
+
+                if compress:
+                    sink.close()
+
+            compressed_size = file.tell()
+            file.seek(0)
+        except BaseException:
+            file.close()
+            raise
+
+        return cls(file, filename, format, hashing.hasher.hexdigest(), hashing.size, compressed_size)
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __repr__(self):
+        return 'Artifact({!r}, hash={!r}, size={}, compressed_size={})'.format(
+            self.filename, self.hash, self.size, self.compressed_size)
+
+
+class PublishResult:
+    CREATED = 'created'
+    UPDATED = 'updated'
+    UNCHANGED = 'unchanged'
+
+    def __init__(self, name: str, action: str, resource: dict):
+        self.name = name
+        self.action = action
+        self.resource = resource
+
+    def __repr__(self):
+        return 'PublishResult({!r}, {!r}, id={!r})'.format(self.name, self.action, self.resource.get('id'))
+
+
+def make_ckan(host: str, key: Optional[str] = None, session: Optional[requests.Session] = None) -> ckanapi.RemoteCKAN:
+    """Client for the CKAN node at `host` that keeps its connections alive between calls."""
+    if '://' not in host:
+        host = 'http://' + host
+    return ckanapi.RemoteCKAN(host, apikey=key, session=session or make_session(pool_size=1))
+
+
+class Publisher:
+    """
+    Creates or updates the resources of one CKAN package, skipping uploads whose content is unchanged.
+
+    The resources are compared by the `hash` field, which is set to `Artifact.hash` on every upload.
+    The package is only read once; the publisher keeps its view of the resources up to date itself.
+    """
+
+    def __init__(self, ckan: ckanapi.RemoteCKAN, package_id: str):
+        self.ckan = ckan
+        self.package_id = package_id
+        self._resources = None
+
+    def _find(self, name: str) -> Optional[dict]:
+        if self._resources is None:
+            package = self.ckan.action.package_show(id=self.package_id)
+            self._resources = package['resources']
+
+        resources = [r for r in self._resources if r['name'] == name]
+
+        if len(resources) > 1:
+            raise AmbiguousResourceError(name, len(resources))
+
+        return resources[0] if resources else None
+
+    def _remember(self, resource: dict) -> None:
+        self._resources = [r for r in self._resources if r['id'] != resource['id']] + [resource]
+
+    def publish(self, name: str, artifact: Artifact, force: bool = False) -> PublishResult:
+        existing = self._find(name)
+
+        if existing is not None and existing.get('hash') == artifact.hash and not force:
+            metrics.incr('publish.unchanged')
+            return PublishResult(name, PublishResult.UNCHANGED, existing)
+
+        artifact.file.seek(0)
+
+        with metrics.stage('ckan.upload'):
+            if existing is None:
+                resource = self.ckan.action.resource_create(package_id=self.package_id,
+                                                            name=name,
+                                                            format=artifact.format,
+                                                            hash=artifact.hash,
+                                                            upload=(artifact.filename, artifact.file),
+                                                            )
+                action = PublishResult.CREATED
+            else:
+                resource = self.ckan.action.resource_update(id=existing['id'],
+                                                            name=name,
+                                                            format=artifact.format,
+                                                            hash=artifact.hash,
+                                                            upload=(artifact.filename, artifact.file),
+                                                            )
+                action = PublishResult.UPDATED
+
+        metrics.incr('publish.bytes', artifact.compressed_size)
+        self._remember(resource)
+
+        return PublishResult(name, action, resource)
@@ -0,0 +1,237 @@
+import datetime
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+from typing import Optional, Iterable, List, Dict
+
+import numpy as np
+import requests
+
+from opendatabo import cruzero
+from opendatabo.common import DataNotAvailableException, HostLimiter, atomic_write, make_session
+from opendatabo.cruzero import BusLine, BusLineFailure, get_all_bus_line_ids, get_bus_line_if_modified
+
+
+class RouteDiff:
+    def __init__(self, added: List[int], removed: List[int], modified: List[int], unchanged: List[int]):
+        self.added = added
+        self.removed = removed
+        self.modified = modified
+        self.unchanged = unchanged
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.added or self.removed or self.modified)
+
+    def __repr__(self):
+        return 'RouteDiff(added={!r}, removed={!r}, modified={!r}, unchanged={})'.format(
+            self.added, self.removed, self.modified, len(self.unchanged))
+
+
+def diff_fingerprints(old: Dict[int, str], new: Dict[int, str]) -> RouteDiff:
+    """Compare two {line_id: fingerprint} mappings, e.g. of the previous run and of this one."""
+    return RouteDiff(added=sorted(set(new) - set(old)),
+                     removed=sorted(set(old) - set(new)),
+                     modified=sorted(i for i in set(old) & set(new) if old[i] != new[i]),
+                     unchanged=sorted(i for i in set(old) & set(new) if old[i] == new[i]),
+                     )
+
+
+class RouteSyncResult:
+    def __init__(self, lines: List[BusLine], failures: List[BusLineFailure], diff: RouteDiff, not_modified: int,
+                 validators: Optional[Dict[int, dict]] = None):
+        self.lines = lines
+        self.failures = failures
+        self.diff = diff
+        self.not_modified = not_modified
+        self.validators = validators or {}
+
+    def __repr__(self):
+        return 'RouteSyncResult(lines={}, failures={!r}, diff={!r}, not_modified={})'.format(
+            len(self.lines), self.failures, self.diff, self.not_modified)
+
+
+def _line_to_record(line: BusLine) -> dict:
+    # Decimals as strings and coordinates as floats both round-trip exactly, so the fingerprint does too
+    return {'line_id': line.line_id,
+            'name': line.name,
+            'speed': str(line.speed),
+            'distance': str(line.distance),
+            'total_time': str(line.total_time),
+            'coordinates': line.coords.tolist(),
+            }
+
+
+def _line_from_record(record: dict) -> BusLine:
+    return BusLine(line_id=record['line_id'],
+                   name=record['name'],
+                   speed=Decimal(record['speed']),
+                   distance=Decimal(record['distance']),
+                   total_time=Decimal(record['total_time']),
+                   coords=np.array(record['coordinates'], dtype=np.float64).reshape(-1, 2),
+                   )
+
+
+class RouteSnapshot:
+    """
+    The bus lines as of the last run, kept to tell which routes changed since.
+
+    Every line is stored in its own file along with its fingerprint and the HTTP validators (ETag,
+    Last-Modified) of the response it came from. Updating the snapshot only rewrites the lines that
+    changed, and appends one entry per added, removed or modified line to the `changes.jsonl` audit log.
+    """
+
+    MANIFEST_NAME = 'snapshot.json'
+    CHANGES_NAME = 'changes.jsonl'
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(os.path.join(root, 'lines'), exist_ok=True)
+
+        try:
+            with open(os.path.join(root, RouteSnapshot.MANIFEST_NAME)) as f:
+                self.manifest = {int(k): v for k, v in json.load(f).items()}
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def _line_path(self, line_id: int) -> str:
+        return os.path.join(self.root, 'lines', '{}.json'.format(line_id))
+
+    def _save_manifest(self) -> None:
+        atomic_write(os.path.join(self.root, RouteSnapshot.MANIFEST_NAME),
+                     json.dumps({str(k): v for k, v in self.manifest.items()}, indent=2, sort_keys=True)
+                     .encode('utf-8'))
+
+    def fingerprints(self) -> Dict[int, str]:
+        return {line_id: entry['fingerprint'] for line_id, entry in self.manifest.items()}
+
+    def load_line(self, line_id: int) -> BusLine:
+        with open(self._line_path(line_id)) as f:
+            return _line_from_record(json.load(f))
+
+    def load_lines(self) -> List[BusLine]:
+        return [self.load_line(line_id) for line_id in sorted(self.manifest)]
+
+    def changes(self) -> List[dict]:
+        """The audit log of every route change recorded so far, oldest first."""
+        try:
+            with open(os.path.join(self.root, RouteSnapshot.CHANGES_NAME)) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def update(self, lines: Iterable[BusLine], validators: Optional[Dict[int, dict]] = None) -> RouteDiff:
+        """
+        Make `lines` the new snapshot and return how it differs from the previous one.
+
+        `validators` holds the HTTP validators per line id to send with the next conditional request.
+        """
+        validators = validators or {}
+
+        lines = {line.line_id: line for line in lines}
+        new = {line_id: line.fingerprint() for line_id, line in lines.items()}
+        old = self.fingerprints()
+
+        diff = diff_fingerprints(old, new)
+        now = time.time()
+        at = datetime.datetime.utcfromtimestamp(now).strftime('%Y-%m-%dT%H:%M:%SZ')
+        log = []
+
+        for change, line_ids in (('added', diff.added), ('modified', diff.modified)):
+            for line_id in line_ids:
+                line = lines[line_id]
+                atomic_write(self._line_path(line_id), json.dumps(_line_to_record(line)).encode('utf-8'))
+                log.append({'at': at, 'change': change, 'line_id': line_id, 'name': line.name,
+                            'fingerprint': new[line_id], 'previous': old.get(line_id)})
+
+        for line_id in diff.removed:
+            log.append({'at': at, 'change': 'removed', 'line_id': line_id,
+                        'name': self.manifest[line_id].get('name'), 'fingerprint': None,
+                        'previous': old[line_id]})
+            del self.manifest[line_id]
+            os.remove(self._line_path(line_id))
+
+        for line_id, line in lines.items():
+            entry = {'fingerprint': new[line_id], 'name': line.name, 'checked_at': now}
+            entry.update(validators.get(line_id, {}))
+            self.manifest[line_id] = entry
+
+        self._save_manifest()
+
+        if log:
+            with open(os.path.join(self.root, RouteSnapshot.CHANGES_NAME), 'a', encoding='utf-8') as f:
+                for record in log:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+
+        return diff
+
+    def sync(self, line_ids: Optional[Iterable[int]] = None, workers: int = 8, per_host: int = 4,
+             session: Optional[requests.Session] = None, timeout: Optional[float] = 30.0) -> RouteSyncResult:
+        """Fetch the current bus lines and update the snapshot right away, see `fetch` and `commit`."""
+        result = self.fetch(line_ids, workers=workers, per_host=per_host, session=session, timeout=timeout)
+        self.commit(result)
+        return result
+
+    def commit(self, result: RouteSyncResult) -> RouteDiff:
+        """Make the lines of a `fetch` the new snapshot, e.g. once they have been published."""
+        return self.update(result.lines, result.validators)
+
+    def fetch(self, line_ids: Optional[Iterable[int]] = None, workers: int = 8, per_host: int = 4,
+              session: Optional[requests.Session] = None, timeout: Optional[float] = 30.0) -> RouteSyncResult:
+        """
+        Fetch the current bus lines and tell how they differ from the snapshot, leaving it as it is until
+        the result is passed to `commit`.
+
+        Lines are requested conditionally with the validators stored last time; a line the server reports
+        as not modified is loaded from the snapshot instead of downloaded and parsed again. Lines that
+        fail to fetch are reported, and come back in their previous version when there is one.
+        """
+        if workers < 1:
+            raise ValueError('workers >= 1')
+
+        if session is None:
+            session = make_session(pool_size=min(workers, per_host))
+
+        if line_ids is None:
+            line_ids = get_all_bus_line_ids(session=session, timeout=timeout)
+
+        limiter = HostLimiter(per_host)
+
+        def fetch(line_id: int):
+            entry = self.manifest.get(line_id, {})
+            with limiter.limit(cruzero.CRUZERO_URL):
+                line, validators = get_bus_line_if_modified(line_id, etag=entry.get('etag'),
+                                                            last_modified=entry.get('last_modified'),
+                                                            session=session, timeout=timeout)
+            if line is None:
+                return self.load_line(line_id), validators, True
+            return line, validators, False
+
+        lines = []
+        failures = []
+        validators = {}
+        not_modified = 0
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(line_id, executor.submit(fetch, line_id)) for line_id in line_ids]
+
+            for line_id, future in futures:
+                try:
+                    line, validators[line_id], skipped = future.result()
+                except (DataNotAvailableException, requests.RequestException, OSError,
+                        KeyError, TypeError, ValueError, InvalidOperation) as e:
+                    failures.append(BusLineFailure(line_id, e))
+                    # Publish the previous version rather than drop the line
+                    if line_id in self.manifest:
+                        lines.append(self.load_line(line_id))
+                        validators[line_id] = {k: self.manifest[line_id].get(k) for k in ('etag', 'last_modified')}
+                    continue
+
+                lines.append(line)
+                not_modified += skipped
+
+        diff = diff_fingerprints(self.fingerprints(), {line.line_id: line.fingerprint() for line in lines})
+
+        return RouteSyncResult(lines, failures, diff, not_modified, validators)
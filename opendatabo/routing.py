@@ -0,0 +1,387 @@
+"""
+Journey planning over the bus lines: "how do I get from A to B by bus".
+
+`TransferGraph.build` samples every route into stops a fixed distance apart and links them into one
+directed graph:
+
+- a stop node (standing in the street) and a ride node (on the bus) per sample;
+- ride edges between consecutive samples of a line, timed from the line's `total_time` and `distance`
+  (or its `speed` when those are missing);
+- boarding edges from stop to ride node, costing the expected wait, and free alighting edges back;
+- walking edges from each stop to the nearest stop of every other line within `transfer_radius` meters.
+
+Adjacency is kept as flat CSR arrays, so a built graph saves to a single `.npz` file and loads instantly.
+"""
+import heapq
+import math
+from decimal import Decimal
+from typing import Optional, Sequence, List, Tuple, Dict
+
+import numpy as np
+
+from opendatabo.cruzero import BusLine
+from opendatabo.geometry import project
+from opendatabo.spatial import pairs_within
+
+# Used for lines published without a usable time, distance or speed, in km/h
+DEFAULT_BUS_SPEED = 15.0
+
+RIDE, BOARD, ALIGHT, WALK = 0, 1, 2, 3
+
+
+def seconds_per_meter(line: BusLine) -> float:
+    """Riding pace of a line: its `total_time` (minutes) over its `distance` (km), or else its `speed` (km/h)."""
+    total_time, distance, speed = (float(v or Decimal(0)) for v in (line.total_time, line.distance, line.speed))
+
+    if total_time > 0 and distance > 0:
+        return total_time * 60.0 / (distance * 1000.0)
+    if speed > 0:
+        return 3.6 / speed
+    return 3.6 / DEFAULT_BUS_SPEED
+
+
+def _resample(coords: np.ndarray, xy: np.ndarray, spacing: float) -> (np.ndarray, np.ndarray):
+    """
+    Points every `spacing` meters along a polyline, plus its end, as (lng, lat) coordinates and their distance
+    from the start. `xy` is the polyline projected to meters.
+    """
+    steps = np.hypot(*np.diff(xy, axis=0).T) if len(xy) > 1 else np.zeros(0)
+    along = np.concatenate([[0.0], np.cumsum(steps)])
+    length = along[-1]
+
+    positions = np.append(np.arange(0.0, length, spacing), length) if length > 0 else np.zeros(1)
+
+    points = np.column_stack([np.interp(positions, along, coords[:, 0]), np.interp(positions, along, coords[:, 1])])
+    return points, positions
+
+
+def _transfers(xy: np.ndarray, line: np.ndarray, n_lines: int, radius: float, block: int = 1024) \
+        -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Walking transfers as (stop, stop, distance) arrays: from every stop to the nearest stop of each other line
+    within `radius`. Along the same line the bus is there already, and the rest of another line is reached by
+    riding it. Stops go `block` at a time, as dense city centres have a great many pairs.
+    """
+    result = []
+    for start in range(0, len(xy), block):
+        a, b, d = pairs_within(xy[start:start + block], xy, radius)
+        other = line[start + a] != line[b]
+        a, b, d = a[other], b[other], d[other]
+
+        # Sorted by (stop, other line, distance), the first pair of each (stop, other line) is the nearest
+        order = np.lexsort((d, line[b], a))
+        _, first = np.unique(a[order] * n_lines + line[b[order]], return_index=True)
+        nearest = order[first]
+
+        result.append((start + a[nearest], b[nearest], d[nearest]))
+
+    return tuple(np.concatenate(arrays) for arrays in zip(*result))
+
+
+class Leg:
+    def __init__(self, mode: str, start: Tuple[float, float], end: Tuple[float, float], seconds: float,
+                 line_id: Optional[int] = None):
+        self.mode = mode
+        self.start = start
+        self.end = end
+        self.seconds = seconds
+        self.line_id = line_id
+
+    def __repr__(self):
+        line = '' if self.line_id is None else ' line={}'.format(self.line_id)
+        return 'Leg({}{}, {:.0f} s)'.format(self.mode, line, self.seconds)
+
+
+class Journey:
+    """The fastest way found between two points: walking and bus legs, with (lat, lng) end points."""
+
+    def __init__(self, seconds: float, legs: List[Leg]):
+        self.seconds = seconds
+        self.legs = legs
+
+    @property
+    def line_ids(self) -> List[int]:
+        return [leg.line_id for leg in self.legs if leg.mode == 'bus']
+
+    def __repr__(self):
+        return 'Journey({:.0f} s, {!r})'.format(self.seconds, self.legs)
+
+
+class TransferGraph:
+    """
+    Stops sampled along the bus lines and the ride, boarding, alighting and walking edges between them.
+
+    Node i < n is the stop of sample i, node n + i its ride node. Use `build` to make one from harvested
+    lines and `plan_many` to query it.
+    """
+
+    PARAMETERS = ('stop_spacing', 'transfer_radius', 'walk_speed', 'detour', 'wait')
+
+    def __init__(self, origin: np.ndarray, line_ids: np.ndarray, sample_line: np.ndarray,
+                 sample_coords: np.ndarray, indptr: np.ndarray, indices: np.ndarray, weights: np.ndarray,
+                 kinds: np.ndarray, params: Dict[str, float]):
+        self.origin = origin
+        self.line_ids = line_ids
+        self.sample_line = sample_line
+        self.sample_coords = sample_coords
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.kinds = kinds
+        self.params = params
+
+        self.sample_xy = project(sample_coords, origin)
+
+        # Plain lists are much faster than NumPy scalars in the search loop
+        self._indptr = indptr.tolist()
+        self._indices = indices.tolist()
+        self._weights = weights.tolist()
+
+    @property
+    def n_stops(self) -> int:
+        return len(self.sample_line)
+
+    @property
+    def n_edges(self) -> int:
+        return len(self.indices)
+
+    def __repr__(self):
+        return 'TransferGraph(lines={}, stops={}, edges={})'.format(len(self.line_ids), self.n_stops, self.n_edges)
+
+    @classmethod
+    def build(cls, lines: Sequence[BusLine], stop_spacing: float = 200.0, transfer_radius: float = 300.0,
+              walk_speed: float = 1.3, detour: float = 1.3, wait: float = 300.0) -> 'TransferGraph':
+        """
+        Build the graph of `lines`, with a stop every `stop_spacing` meters of each route.
+
+        Walking takes `detour` times the straight distance at `walk_speed` m/s; boarding costs `wait` seconds.
+        """
+        if stop_spacing <= 0:
+            raise ValueError('stop_spacing > 0')
+
+        lines = [line for line in lines if len(line.coords)]
+        if not lines:
+            raise ValueError('lines')
+
+        all_coords = np.concatenate([line.coords for line in lines]).astype(np.float64)
+        origin = (all_coords.min(axis=0) + all_coords.max(axis=0)) / 2
+
+        sample_coords, sample_line, ride_src, ride_time = [], [], [], []
+        offset = 0
+        for i, line in enumerate(lines):
+            coords = np.asarray(line.coords, dtype=np.float64)
+            points, positions = _resample(coords, project(coords, origin), stop_spacing)
+
+            sample_coords.append(points)
+            sample_line.append(np.full(len(points), i, dtype=np.int32))
+            ride_src.append(offset + np.arange(len(points) - 1))
+            ride_time.append(np.diff(positions) * seconds_per_meter(line))
+            offset += len(points)
+
+        sample_coords = np.concatenate(sample_coords)
+        sample_xy = project(sample_coords, origin)
+        sample_line = np.concatenate(sample_line)
+        ride_src = np.concatenate(ride_src).astype(np.int64)
+        ride_time = np.concatenate(ride_time)
+
+        n = len(sample_xy)
+        stops = np.arange(n)
+
+        a, b, d = _transfers(sample_xy, sample_line, len(lines), transfer_radius)
+
+        src = np.concatenate([n + ride_src, stops, n + stops, a])
+        dst = np.concatenate([n + ride_src + 1, n + stops, stops, b])
+        weights = np.concatenate([ride_time, np.full(n, float(wait)), np.zeros(n), d * detour / walk_speed])
+        kinds = np.concatenate([np.full(len(ride_src), RIDE), np.full(n, BOARD), np.full(n, ALIGHT),
+                                np.full(len(a), WALK)]).astype(np.int8)
+
+        order = np.argsort(src, kind='mergesort')
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=2 * n))])
+
+        params = {'stop_spacing': stop_spacing, 'transfer_radius': transfer_radius, 'walk_speed': walk_speed,
+                  'detour': detour, 'wait': wait}
+
+        return cls(origin, np.array([line.line_id for line in lines], dtype=np.int64), sample_line,
+                   sample_coords, indptr.astype(np.int64), dst[order].astype(np.int64), weights[order],
+                   kinds[order], params)
+
+    def save(self, path: str) -> None:
+        # Through a file, as np.savez would add '.npz' to a path without it and `load` then not find it
+        with open(path, 'wb') as fp:
+            np.savez(fp, origin=self.origin, line_ids=self.line_ids, sample_line=self.sample_line,
+                     sample_coords=self.sample_coords, indptr=self.indptr, indices=self.indices,
+                     weights=self.weights, kinds=self.kinds,
+                     params=np.array([self.params[k] for k in TransferGraph.PARAMETERS]))
+
+    @classmethod
+    def load(cls, path: str) -> 'TransferGraph':
+        with np.load(path) as data:
+            params = dict(zip(TransferGraph.PARAMETERS, data['params'].tolist()))
+            return cls(data['origin'], data['line_ids'], data['sample_line'], data['sample_coords'], data['indptr'],
+                       data['indices'], data['weights'], data['kinds'], params)
+
+    def _walk_seconds(self, d):
+        return d * self.params['detour'] / self.params['walk_speed']
+
+    def _search(self, sources: Dict[int, float], targets: List[Dict[int, float]]) -> (List[float], List[int]):
+        """
+        Dijkstra from several sources at once (stop -> initial cost) until the best arrival at every target is
+        known, each target being a set of stops with the cost of walking on from them.
+        """
+        n = 2 * self.n_stops
+        indptr, indices, weights = self._indptr, self._indices, self._weights
+
+        dist = [math.inf] * n
+        pred = [-1] * n
+
+        heap = []
+        for node, cost in sources.items():
+            dist[node] = cost
+            heap.append((cost, node))
+        heapq.heapify(heap)
+
+        egress = {}
+        for k, target in enumerate(targets):
+            for node, cost in target.items():
+                egress.setdefault(node, []).append((k, cost))
+
+        best = [math.inf] * len(targets)
+        bound = math.inf if targets else -math.inf
+
+        while heap:
+            d, node = heapq.heappop(heap)
+            if d > dist[node]:
+                continue
+            # Nothing reached from here on can improve any target
+            if d >= bound:
+                break
+
+            if node in egress:
+                for k, cost in egress[node]:
+                    best[k] = min(best[k], d + cost)
+                bound = max(best)
+
+            for e in range(indptr[node], indptr[node + 1]):
+                nd = d + weights[e]
+                v = indices[e]
+                if nd < dist[v]:
+                    dist[v] = nd
+                    pred[v] = node
+                    heapq.heappush(heap, (nd, v))
+
+        return dist, pred
+
+    def _legs(self, pred: List[int], start: Tuple[float, float], first: int, last: int, end: Tuple[float, float],
+              access: float, egress: float) -> List[Leg]:
+        n = self.n_stops
+
+        nodes = [last]
+        while nodes[-1] != first:
+            nodes.append(pred[nodes[-1]])
+        nodes.reverse()
+
+        def point(node):
+            lng, lat = self.sample_coords[node % n].tolist()
+            return lat, lng
+
+        legs = [Leg('walk', start, point(first), access)]
+
+        for u, v in zip(nodes, nodes[1:]):
+            e = self._indptr[u] + self._indices[self._indptr[u]:self._indptr[u + 1]].index(v)
+            kind, seconds = int(self.kinds[e]), self._weights[e]
+
+            if kind == RIDE:
+                line_id = int(self.line_ids[self.sample_line[u - n]])
+                if legs[-1].mode == 'bus' and legs[-1].line_id == line_id:
+                    legs[-1].end = point(v)
+                    legs[-1].seconds += seconds
+                else:
+                    legs.append(Leg('bus', point(u), point(v), seconds, line_id=line_id))
+            elif kind == WALK:
+                if legs[-1].mode == 'walk':
+                    legs[-1].end = point(v)
+                    legs[-1].seconds += seconds
+                else:
+                    legs.append(Leg('walk', point(u), point(v), seconds))
+            elif kind == BOARD:
+                legs.append(Leg('wait', point(u), point(v), seconds))
+
+        if legs[-1].mode == 'walk':
+            legs[-1].end = end
+            legs[-1].seconds += egress
+        else:
+            legs.append(Leg('walk', point(last), end, egress))
+
+        return [leg for leg in legs if leg.mode != 'walk' or leg.seconds > 0 or leg.start != leg.end]
+
+    def plan_many(self, origins: Sequence[Tuple[float, float]], destinations: Sequence[Tuple[float, float]],
+                  access_radius: float = 500.0) -> List[Journey]:
+        """
+        The fastest journey for every (origin, destination) pair of (lat, lng) points, walking at most
+        `access_radius` meters to the first stop and from the last one.
+
+        Pairs sharing an origin share one search. Walking all the way is always an option, so every pair gets
+        a journey: a single walking leg when no stop is near either end or no bus ride is faster.
+        """
+        if len(origins) != len(destinations):
+            raise ValueError('origins and destinations differ in length')
+
+        if not len(origins):
+            return []
+
+        def to_xy(points):
+            points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+            return project(points[:, ::-1], self.origin)
+
+        origin_xy = to_xy(origins)
+        destination_xy = to_xy(destinations)
+
+        # Access and egress walks of every point at once, on the grid of stops
+        oi, os_, od = pairs_within(origin_xy, self.sample_xy, access_radius)
+        di, ds, dd = pairs_within(destination_xy, self.sample_xy, access_radius)
+
+        access = [{} for _ in origins]
+        for i, stop, d in zip(oi.tolist(), os_.tolist(), self._walk_seconds(od).tolist()):
+            access[i][stop] = d
+
+        egress = [{} for _ in destinations]
+        for i, stop, d in zip(di.tolist(), ds.tolist(), self._walk_seconds(dd).tolist()):
+            egress[i][stop] = d
+
+        direct = self._walk_seconds(np.hypot(*(destination_xy - origin_xy).T)).tolist()
+
+        by_origin = {}
+        for k, point in enumerate(origins):
+            by_origin.setdefault(tuple(point), []).append(k)
+
+        result = [None] * len(origins)
+
+        for point, pairs in by_origin.items():
+            sources = access[pairs[0]]
+            targets = [egress[k] for k in pairs]
+
+            dist, pred = self._search(sources, targets) if sources else ([], [])
+
+            for k in pairs:
+                start, end = tuple(origins[k]), tuple(destinations[k])
+                journey = Journey(direct[k], [Leg('walk', start, end, direct[k])])
+
+                if sources:
+                    arrivals = [(dist[stop] + cost, stop) for stop, cost in egress[k].items()]
+                    if arrivals:
+                        seconds, last = min(arrivals)
+                        if seconds < journey.seconds:
+                            first = last
+                            while pred[first] != -1:
+                                first = pred[first]
+                            legs = self._legs(pred, start, first, last, end, sources[first], egress[k][last])
+                            journey = Journey(seconds, legs)
+
+                result[k] = journey
+
+        return result
+
+    def plan(self, from_lat: float, from_lng: float, to_lat: float, to_lng: float,
+             access_radius: float = 500.0) -> Journey:
+        return self.plan_many([(from_lat, from_lng)], [(to_lat, to_lng)], access_radius=access_radius)[0]
+
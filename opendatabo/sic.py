@@ -1,15 +1,26 @@
 import datetime
 import io
+import time
 import warnings
 from abc import ABCMeta, abstractmethod
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import Enum, unique
-from itertools import islice
-from typing import Optional
+from itertools import count
+from typing import Optional, Iterable, Iterator, Tuple
+from urllib.parse import urlsplit
 
+import numpy as np
 import pandas as pd
 import requests
 
-from opendatabo.common import retry_on, DataNotAvailableException
+from opendatabo import metrics
+from opendatabo.cache import ResponseCache, cached_request
+from opendatabo.common import DataNotAvailableException, HostLimiter, make_session, RetryPolicy, RetryBudget, \
+    CircuitBreaker, CircuitOpenError
+from opendatabo.export import CATEGORICAL_COLUMNS, make_filename, write_market_prices
+
+SIC_URL = 'http://www.sicsantacruz.com/sic/sic2014'
 
 
 @unique
@@ -37,21 +48,40 @@ class Timeframe(metaclass=ABCMeta):
     def to_filename_suffix(self) -> str:
         pass
 
+    @abstractmethod
+    def cache_ttl(self) -> Optional[float]:
+        """Seconds a downloaded dataset stays valid, or None if it can never change."""
+        pass
+
 
 class Today(Timeframe):
+    CACHE_TTL = 10 * 60
+
     def to_url_part(self) -> str:
         return 'hoy'
 
     def to_filename_suffix(self) -> str:
         return datetime.datetime.today().strftime('%Y%m%d')
 
+    def cache_ttl(self) -> Optional[float]:
+        return Today.CACHE_TTL
+
+    def __eq__(self, other):
+        return isinstance(other, Today)
+
+    def __hash__(self):
+        return hash(Today)
+
+    def __repr__(self):
+        return 'Today()'
+
 
 class Year(Timeframe):
     MIN_VALUE = 2008
-    MAX_VALUE = datetime.datetime.now().year
+    CURRENT_CACHE_TTL = 60 * 60
 
     def __init__(self, value: int):
-        if value < Year.MIN_VALUE or value > Year.MAX_VALUE:
+        if value < Year.MIN_VALUE or value > Year.max_value():
             raise ValueError('value')
 
         self._value = value
@@ -66,12 +96,33 @@ class Year(Timeframe):
     def to_filename_suffix(self) -> str:
         return '{}'.format(self._value)
 
+    def cache_ttl(self) -> Optional[float]:
+        # Past years are closed; only the running year still gets new rows
+        if self._value < Year.max_value():
+            return None
+        return Year.CURRENT_CACHE_TTL
+
+    def __eq__(self, other):
+        return isinstance(other, Year) and other._value == self._value
+
+    def __hash__(self):
+        return hash((Year, self._value))
+
     def __repr__(self):
         return 'Year({})'.format(self._value)
 
+    @staticmethod
+    def max_value() -> int:
+        """The running year, read from the clock on every call so a long-lived process sees the new year."""
+        return datetime.datetime.now().year
+
+    @staticmethod
+    def current() -> 'Year':
+        return Year(Year.max_value())
+
     @staticmethod
     def all_valid():
-        for y in range(Year.MIN_VALUE, Year.MAX_VALUE + 1):
+        for y in range(Year.MIN_VALUE, Year.max_value() + 1):
             yield Year(y)
 
 
@@ -80,107 +131,369 @@ class RemoteErrorException(Exception):
 
 
 def make_market_prices_url(city: City, timeframe: Timeframe) -> str:
-    return 'http://www.sicsantacruz.com/sic/sic2014/pref_{}_{}_export.php'.format(city.to_url_part(),
-                                                                                  timeframe.to_url_part())
+    return '{}/pref_{}_{}_export.php'.format(SIC_URL, city.to_url_part(), timeframe.to_url_part())
+
+
+# Raw SIC column names and the names they are prepared under
+RAW_COLUMN_NAMES = {'Precio Mayorista': 'precio_mayorista',
+                    'Precio Minorista': 'precio_minorista',
+                    'Nom_Procedencia': 'procedencia',
+                    'Procedencia': 'procedencia',
+                    'Mercado': 'mercado',
+                    }
+
+INDEX_COLUMNS = ['fecha', 'producto', 'variedad']
+
+PRICE_SIDES = ['precio_mayorista', 'precio_minorista']
+
 
+def prepare_raw_market_prices(raw_df: pd.DataFrame, compact: bool = False,
+                              drop_duplicates: bool = True) -> pd.DataFrame:
+    """
+    Index the raw SIC frame by (fecha, producto, variedad) and parse its prices and units.
 
-def prepare_raw_market_prices(raw_df: pd.DataFrame) -> pd.DataFrame:
-    df = raw_df.rename(columns={'Precio Mayorista': 'precio_mayorista',
-                                'Precio Minorista': 'precio_minorista',
-                                'Nom_Procedencia': 'procedencia',
-                                'Procedencia': 'procedencia',
-                                'Mercado': 'mercado',
-                                })
+    With `compact` the result holds the same values in leaner dtypes: `fecha` stays datetime64 instead of
+    `datetime.date` objects and the repeated strings are categoricals. It is also built in one pass,
+    without the intermediate copies of the default path.
+
+    Rows sharing an index key are dropped but for the last one, with a warning. Without `drop_duplicates`
+    they are all kept, for callers that prepare a dataset in pieces and call `drop_duplicate_index` on the
+    whole of it.
+    """
+    with metrics.stage('sic.prepare'):
+        if compact:
+            return _prepare_compact_market_prices(raw_df, drop_duplicates)
+        return _prepare_raw_market_prices(raw_df, drop_duplicates)
+
+
+def drop_duplicate_index(df: pd.DataFrame) -> pd.DataFrame:
+    """Drop the rows of a prepared frame that share an index key with a later row, as preparing it does."""
+    duplicated = df.index.duplicated(keep='last')
+    if not duplicated.any():
+        return df
+
+    warnings.warn('duplicates were found when building the dataset index. duplicates were DROPPED')
+    df = df[~duplicated]
+
+    # Categories of the value columns only cover the rows kept, like those of a compact frame prepared whole
+    categorical = {c: pd.Categorical(np.asarray(df[c])) for c in df.columns if df[c].dtype.name == 'category'}
+    if categorical:
+        df = df.assign(**categorical)
+
+    return df
+
+
+def _prepare_compact_market_prices(raw_df: pd.DataFrame, drop_duplicates: bool) -> pd.DataFrame:
+    columns = {RAW_COLUMN_NAMES.get(c, c): raw_df[c] for c in raw_df.columns}
+
+    index = pd.MultiIndex.from_arrays([pd.to_datetime(columns.pop('fecha'), format='%d/%m/%Y'),
+                                       pd.Categorical(columns.pop('producto')),
+                                       pd.Categorical(columns.pop('variedad')),
+                                       ], names=INDEX_COLUMNS)
+
+    # Duplicates are found on the index itself, which is then known to be unique without verifying it again
+    duplicated = index.duplicated(keep='last') if drop_duplicates else None
+    if duplicated is not None and duplicated.any():
+        warnings.warn('duplicates were found when building the dataset index. duplicates were DROPPED')
+        keep = ~duplicated
+        index = index[keep]
+        columns = {c: values[keep] for c, values in columns.items()}
+
+    data = {}
+    order = []
+
+    for c, values in columns.items():
+        if c in PRICE_SIDES:
+            continue
+        data[c] = pd.Categorical(values) if c in CATEGORICAL_COLUMNS else values.values
+        order.append(c)
+
+    for side in PRICE_SIDES:
+        val, unit_val, unit_name = parse_column_units(columns[side])
+        per_kg, per_unit = normalize_unit_prices(val, unit_val, unit_name)
+        data[side + '_val'] = val.values
+        data[side + '_unit_val'] = unit_val.values
+        data[side + '_unit_name'] = pd.Categorical(unit_name)
+        data[side + '_per_kg'] = per_kg.values
+        data[side + '_per_unit'] = per_unit.values
+        order.extend(side + suffix for suffix in ['_val', '_unit_val', '_unit_name', '_per_kg', '_per_unit'])
+
+    return pd.DataFrame(data, index=index, columns=order)
+
+
+def _prepare_raw_market_prices(raw_df: pd.DataFrame, drop_duplicates: bool) -> pd.DataFrame:
+    df = raw_df.rename(columns=RAW_COLUMN_NAMES)
 
     # Parse string dates with format 'DD/MM/YYYY' into datetime.date objects, and replace the column data
     df.loc[:, 'fecha'] = pd.to_datetime(df['fecha'], format='%d/%m/%Y').dt.date
 
     # Define the multi-index, making sure there are no index-duplicates with different data
-    index_cols = ['fecha', 'producto', 'variedad']
+    index_cols = INDEX_COLUMNS
 
-    if df.duplicated(subset=index_cols).sum() > 0:
+    if drop_duplicates and df.duplicated(subset=index_cols).sum() > 0:
         warnings.warn('duplicates were found when building the dataset index. duplicates were DROPPED')
         df.drop_duplicates(subset=index_cols, keep='last', inplace=True)
 
-    df.set_index(index_cols, inplace=True, verify_integrity=True)
+    df.set_index(index_cols, inplace=True, verify_integrity=drop_duplicates)
 
     # Parse values and units
     val, unit_val, unit_name = parse_column_units(df['precio_mayorista'])
+    per_kg, per_unit = normalize_unit_prices(val, unit_val, unit_name)
     df.loc[:, 'precio_mayorista_val'] = val
     df.loc[:, 'precio_mayorista_unit_val'] = unit_val
     df.loc[:, 'precio_mayorista_unit_name'] = unit_name
+    df.loc[:, 'precio_mayorista_per_kg'] = per_kg
+    df.loc[:, 'precio_mayorista_per_unit'] = per_unit
     del df['precio_mayorista']
 
     val, unit_val, unit_name = parse_column_units(df['precio_minorista'])
+    per_kg, per_unit = normalize_unit_prices(val, unit_val, unit_name)
     df.loc[:, 'precio_minorista_val'] = val
     df.loc[:, 'precio_minorista_unit_val'] = unit_val
     df.loc[:, 'precio_minorista_unit_name'] = unit_name
+    df.loc[:, 'precio_minorista_per_kg'] = per_kg
+    df.loc[:, 'precio_minorista_per_unit'] = per_unit
     del df['precio_minorista']
 
     return df
 
 
+def _pounds(x: int) -> (int, str):
+    return x, 'lb'
+
+
+def _arrobas(x: int) -> (int, str):
+    return _pounds(25 * x)
+
+
+# Unit suffixes used by the SIC exports, as (amount, unit name)
+UNITS = {'Kilo':           (1,     'kg'),
+         'Arroba (@)':     _arrobas(1),
+         'Amarro':         (1,     '<amarro>'),
+         'Canasta':        (1,     '<canasta>'),
+         'Caja de 150U.':  (150,   'unit'),
+         '100 U.':         (100,   'unit'),
+         'Bolsa (2@)':     _arrobas(2),
+         'Bolsa Grande':   (1,     '<bolsa grande>'),
+         '25 U.':          (25,    'unit'),
+         'Docena':         (12,    'unit'),
+         'qq':             (112,   'lb'),
+         'Caja de 18 Kg':  (18,    'kg'),
+         'Bolsa (10@)':    _arrobas(10),
+         'Caja de 23 Kg':  (23,    'kg'),
+         'Unidad':         (1,     'unit'),
+         'Libra':          (1,     'lb'),
+         'Bolsa (8@)':     _arrobas(8),
+         'Bolsa (4@)':     _arrobas(4),
+         '3 Libras':       (3,     'lb'),
+         }
+
+# Kilograms in one unit of each weight unit name
+KG_PER_UNIT_NAME = {'kg': 1.0,
+                    'lb': 0.45359237,
+                    }
+
+
+class UnknownUnitError(ValueError):
+    def __init__(self, units):
+        self.units = sorted(units)
+        super(UnknownUnitError, self).__init__('unknown units: {!r}'.format(self.units))
+
+    def __reduce__(self):
+        # Keeps the units intact when the error crosses a process boundary
+        return UnknownUnitError, (self.units,)
+
+
+def _broadcast(values: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    """Expand per-unique `values` back to one per row, with NaN where the code is missing (-1)."""
+    if (codes < 0).any():
+        if values.dtype.kind in 'iu':
+            values = values.astype(np.float64)
+        return np.append(values, np.array([np.nan], dtype=values.dtype))[codes]
+    return values[codes]
+
+
 def parse_column_units(s: pd.Series) -> (pd.Series, pd.Series, pd.Series):
-    parsed = s.str.extract(r'^(?P<value>\d+)\s*Bs.-/(?P<unit_raw>.*)$', expand=True)
+    # Prices repeat a lot, so every distinct string is parsed once and the results broadcast back to the rows
+    codes, uniques = pd.factorize(s)
+    parsed = pd.Series(np.asarray(uniques, dtype=object)).str.extract(r'^(?P<value>\d+)\s*Bs.-/(?P<unit_raw>.*)$',
+                                                                      expand=True)
 
-    vals = pd.to_numeric(parsed['value'])
-    unit = parsed['unit_raw'].map(parse_unit, na_action='ignore')
+    vals = pd.to_numeric(parsed['value']).values
 
-    unit_val = unit.map(lambda u: u[0], na_action='ignore')
-    unit_key = unit.map(lambda u: u[1], na_action='ignore')
+    # Likewise, look every distinct unit up once
+    unit_codes, unit_uniques = pd.factorize(parsed['unit_raw'])
 
-    return vals, unit_val, unit_key
+    unknown = [u for u in unit_uniques if u not in UNITS]
+    if unknown:
+        raise UnknownUnitError(unknown)
 
+    amounts = np.array([UNITS[u][0] for u in unit_uniques], dtype=np.int64)
+    names = np.array([UNITS[u][1] for u in unit_uniques], dtype=object)
 
-def parse_unit(s: str) -> (int, str):
-    pound = lambda x: (x, 'lb')
-    arroba = lambda x: pound(25 * x)
-
-    static = {'Kilo':           (1,     'kg'),
-              'Arroba (@)':     arroba(1),
-              'Amarro':         (1,     '<amarro>'),
-              'Canasta':        (1,     '<canasta>'),
-              'Caja de 150U.':  (150,   'unit'),
-              '100 U.':         (100,   'unit'),
-              'Bolsa (2@)':     arroba(2),
-              'Bolsa Grande':   (1,     '<bolsa grande>'),
-              '25 U.':          (25,    'unit'),
-              'Docena':         (12,    'unit'),
-              'qq':             (112,   'lb'),
-              'Caja de 18 Kg':  (18,    'kg'),
-              'Bolsa (10@)':    arroba(10),
-              'Caja de 23 Kg':  (23,    'kg'),
-              'Unidad':         (1,     'unit'),
-              'Libra':          (1,     'lb'),
-              'Bolsa (8@)':     arroba(8),
-              'Bolsa (4@)':     arroba(4),
-              '3 Libras':       (3,     'lb'),
-              }
+    unit_val = _broadcast(_broadcast(amounts, unit_codes), codes)
+    unit_key = _broadcast(_broadcast(names, unit_codes), codes)
+
+    return (pd.Series(_broadcast(vals, codes), index=s.index, name=parsed['value'].name),
+            pd.Series(unit_val, index=s.index),
+            pd.Series(unit_key, index=s.index))
 
+
+def normalize_unit_prices(vals: pd.Series, unit_val: pd.Series, unit_name: pd.Series) -> (pd.Series, pd.Series):
+    """
+    Express parsed prices per kilogram (for weight units) and per single unit (for counted units),
+    so that prices quoted in different units can be compared directly. Other units give NaN.
+    """
+    kg = unit_val * unit_name.map(KG_PER_UNIT_NAME)
+    units = unit_val.where(unit_name == 'unit')
+
+    return vals / kg, vals / units
+
+
+def parse_unit(s: str) -> (int, str):
     try:
-        return static[s]
+        return UNITS[s]
     except KeyError:
         raise ValueError('unknown unit: {!r}'.format(s))
 
 
-@retry_on(RemoteErrorException, retries=6, delay=lambda i: 2.0 ** i)
-def get_market_prices(city: City, timeframe: Timeframe, limit: Optional[int] = None, raw: bool = False) -> pd.DataFrame:
+class _FatalErrorGuard(io.RawIOBase):
+    """
+    Pass-through reader over a response body that raises `RemoteErrorException` as soon as the PHP
+    'Fatal error' marker goes by, without holding more than one chunk of the body in memory.
+    """
+
+    MARKER = b'Fatal error'
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._tail = b''
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        data = self._stream.read(len(b))
+        if not data:
+            return 0
+
+        # Keep the end of the previous chunk around, in case the marker straddles two chunks
+        if _FatalErrorGuard.MARKER in self._tail + data:
+            raise RemoteErrorException()
+        self._tail = data[-(len(_FatalErrorGuard.MARKER) - 1):]
+
+        n = len(data)
+        b[:n] = data
+        self.bytes_read += n
+        return n
+
+
+def _is_complete(content: bytes) -> bool:
+    return _FatalErrorGuard.MARKER not in content
+
+
+def _open_market_prices(city: City, timeframe: Timeframe, session: Optional[requests.Session],
+                        timeout: Optional[float], cache: Optional[ResponseCache], refresh: bool):
     url = make_market_prices_url(city, timeframe)
 
-    r = requests.post(url, data={'type': 'csv', 'records': 'all'}, stream=limit is not None, allow_redirects=False)
+    with metrics.stage('sic.request'):
+        r = cached_request('POST', url, data={'type': 'csv', 'records': 'all'}, cache=cache,
+                           ttl=timeframe.cache_ttl(), refresh=refresh, session=session, stream=True,
+                           allow_redirects=False, timeout=timeout, validate=_is_complete)
+    metrics.incr('sic.requests')
 
     if r.status_code != 200:
-        raise DataNotAvailableException()
+        r.close()
+        raise DataNotAvailableException(r.status_code)
 
-    if limit is None:
-        data = r.content.decode('utf-8')
+    if cache is None:
+        r.raw.decode_content = True
+        body = r.raw
     else:
-        data = '\n'.join(b.decode('utf-8') for b in islice(r.iter_lines(), 0, 1 + limit))
-
-    if 'Fatal error' in data:
-        raise RemoteErrorException()
-
-    raw_df = pd.read_csv(io.StringIO(data))
+        body = io.BytesIO(r.content)
+
+    return r, _FatalErrorGuard(body)
+
+
+def _host_failure(e: BaseException) -> bool:
+    # A 'Fatal error' is one export failing, e.g. a year too large for the site, not the site being down
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return isinstance(e, DataNotAvailableException) and (e.status_code or 0) >= 500
+
+
+def make_retry_policy(budget: Optional[RetryBudget] = None) -> RetryPolicy:
+    """
+    The retries of `get_market_prices`, with a circuit breaker on the SIC host. Build one per run and pass it
+    to every call, so that a dead host stops costing each job its own retries; `budget` bounds the total
+    retry wait of the run.
+    """
+    return RetryPolicy((RemoteErrorException, requests.ConnectionError), attempts=6, base_delay=1.0,
+                       max_delay=16.0, deadline=60.0, budget=budget,
+                       breaker=CircuitBreaker(threshold=10, reset_after=60.0),
+                       key=lambda *args, **kwargs: urlsplit(SIC_URL).netloc, trips=_host_failure)
+
+
+# Used by the calls not given a policy of their own
+RETRY_POLICY = make_retry_policy()
+
+
+def get_market_prices(city: City, timeframe: Timeframe, limit: Optional[int] = None, raw: bool = False,
+                      session: Optional[requests.Session] = None, timeout: Optional[float] = None,
+                      cache: Optional[ResponseCache] = None, refresh: bool = False, parser=None,
+                      retry_policy: Optional[RetryPolicy] = None,
+                      limiter: Optional[HostLimiter] = None) -> pd.DataFrame:
+    """
+    Download and prepare the market prices of a city for a timeframe, retrying as `retry_policy` (see
+    `make_retry_policy`) or else the module's `RETRY_POLICY` allows. With a `limiter`, each attempt takes a
+    slot at the host for its download only, so the waits between retries leave it to other requests.
+
+    With a `parser` (an `opendatabo.parallel.MarketPricesParser`) the export is downloaded whole and then
+    prepared on its process pool, with the same result.
+    """
+    policy = retry_policy or RETRY_POLICY
+    attempts = count()
+
+    @policy
+    def attempt() -> pd.DataFrame:
+        # Retries go back to the site instead of reading the same answer from the cache again
+        return _get_market_prices(city, timeframe, limit, raw, session, timeout, cache,
+                                  refresh or next(attempts) > 0, parser, limiter)
+
+    return attempt()
+
+
+def _get_market_prices(city: City, timeframe: Timeframe, limit: Optional[int], raw: bool,
+                       session: Optional[requests.Session], timeout: Optional[float],
+                       cache: Optional[ResponseCache], refresh: bool, parser,
+                       limiter: Optional[HostLimiter] = None) -> pd.DataFrame:
+    slot = nullcontext() if limiter is None else limiter.limit(make_market_prices_url(city, timeframe))
+
+    with slot:
+        r, body = _open_market_prices(city, timeframe, session, timeout, cache, refresh)
+
+        if parser is not None and not raw and limit is None:
+            try:
+                with metrics.stage('sic.download'):
+                    payload = body.read()
+            finally:
+                r.close()
+                metrics.incr('sic.bytes', body.bytes_read)
+        else:
+            payload = None
+            try:
+                # The body downloads while it is parsed, so this stage covers both
+                with metrics.stage('sic.parse'):
+                    raw_df = pd.read_csv(body, nrows=limit, encoding='utf-8')
+            finally:
+                r.close()
+                metrics.incr('sic.bytes', body.bytes_read)
+
+    if payload is not None:
+        return parser.parse(payload)
+
+    metrics.incr('sic.rows', raw_df.shape[0])
 
     if raw:
         return raw_df
@@ -188,11 +501,106 @@ def get_market_prices(city: City, timeframe: Timeframe, limit: Optional[int] = N
         return prepare_raw_market_prices(raw_df)
 
 
-def save_market_prices(city: City, timeframe: Timeframe, raw: bool = True, output: Optional[str] = None) -> None:
+def iter_market_prices(city: City, timeframe: Timeframe, chunksize: int = 10000, raw: bool = False,
+                       session: Optional[requests.Session] = None, timeout: Optional[float] = None,
+                       cache: Optional[ResponseCache] = None, refresh: bool = False) -> Iterator[pd.DataFrame]:
+    """
+    Stream the market prices as frames of at most `chunksize` rows, parsing the response while it downloads.
+
+    Unlike `get_market_prices` there is no retry: a remote error raises `RemoteErrorException` from the
+    iteration. When `raw` is False every chunk is prepared on its own, so duplicate rows are only dropped
+    within a chunk.
+    """
+    r, body = _open_market_prices(city, timeframe, session, timeout, cache, refresh)
+
+    try:
+        for raw_df in pd.read_csv(body, chunksize=chunksize, encoding='utf-8'):
+            metrics.incr('sic.rows', raw_df.shape[0])
+            if raw:
+                yield raw_df
+            else:
+                yield prepare_raw_market_prices(raw_df)
+    finally:
+        r.close()
+        metrics.incr('sic.bytes', body.bytes_read)
+
+
+def read_market_prices_csv(filepath_or_buffer) -> pd.DataFrame:
+    """Load a CSV written from a `prepare_raw_market_prices` frame back into the same indexed frame."""
+    df = pd.read_csv(filepath_or_buffer)
+
+    df['fecha'] = pd.to_datetime(df['fecha'], format='%Y-%m-%d').dt.date
+    df.set_index(['fecha', 'producto', 'variedad'], inplace=True)
+
+    return df
+
+
+class FetchOutcome:
+    def __init__(self, city: City, timeframe: Timeframe, df: Optional[pd.DataFrame] = None,
+                 error: Optional[Exception] = None, elapsed: float = 0.0):
+        self.city = city
+        self.timeframe = timeframe
+        self.df = df
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self):
+        return 'FetchOutcome({!r}, {!r}, rows={}, error={!r}, elapsed={:.3f})'.format(
+            self.city, self.timeframe, None if self.df is None else self.df.shape[0], self.error, self.elapsed)
+
+
+def fetch_market_prices(jobs: Iterable[Tuple[City, Timeframe]], workers: int = 8, per_host: int = 4,
+                        raw: bool = False, session: Optional[requests.Session] = None,
+                        timeout: Optional[float] = 60.0, cache: Optional[ResponseCache] = None,
+                        refresh: bool = False, parser=None,
+                        retry_policy: Optional[RetryPolicy] = None) -> Iterator[FetchOutcome]:
+    """
+    Fetch the market prices for many (city, timeframe) jobs concurrently over one pooled session.
+
+    Outcomes are yielded as soon as each job finishes, so a slow or failing job does not hold back the
+    others. Failed jobs are reported through `FetchOutcome.error` instead of being raised. A `parser`
+    prepares the downloads on its process pool and `retry_policy` is shared by every job, see
+    `get_market_prices`.
+    """
+    if workers < 1:
+        raise ValueError('workers >= 1')
+
+    if session is None:
+        session = make_session(pool_size=min(workers, per_host))
+
+    limiter = HostLimiter(per_host)
+
+    def fetch(city: City, timeframe: Timeframe) -> FetchOutcome:
+        start = time.perf_counter()
+        try:
+            df = get_market_prices(city, timeframe, raw=raw, session=session, timeout=timeout, cache=cache,
+                                   refresh=refresh, parser=parser, retry_policy=retry_policy, limiter=limiter)
+            return FetchOutcome(city, timeframe, df=df, elapsed=time.perf_counter() - start)
+        except (DataNotAvailableException, RemoteErrorException, CircuitOpenError, requests.RequestException,
+                ValueError) as e:
+            return FetchOutcome(city, timeframe, error=e, elapsed=time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch, city, timeframe) for city, timeframe in jobs]
+
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def save_market_prices(city: City, timeframe: Timeframe, raw: bool = True, output: Optional[str] = None,
+                       format: str = 'csv', compression: Optional[str] = None) -> None:
     df = get_market_prices(city, timeframe, raw=raw)
     if output is None:
-        output_file = 'precios_' + city.value + '_' + timeframe.to_filename_suffix() + '.csv'
+        output_file = make_filename('precios_' + city.value + '_' + timeframe.to_filename_suffix(), format, compression)
     else:
         output_file = output
-    df.to_csv(output_file)
+    write_market_prices(df, output_file, format=format, compression=compression)
 
@@ -0,0 +1,237 @@
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from opendatabo.cruzero import BusLine
+from opendatabo.geometry import project, segment_distances, clip_segments
+
+_KEY_RADIX = 2 ** 31
+
+
+class RouteIndex:
+    """
+    Uniform grid over the segments of a set of bus routes, for "which lines pass near here" queries.
+
+    Routes are projected to meters around a common origin, and each segment is registered in every grid cell
+    its bounding box touches. A query only measures the segments registered in the cells it overlaps. The
+    grid is stored as flat sorted arrays, so an index can be saved once per refresh and loaded instantly.
+    """
+
+    def __init__(self, origin: np.ndarray, cell_size: float, line_ids: np.ndarray, seg_a: np.ndarray,
+                 seg_b: np.ndarray, seg_line: np.ndarray, cell_keys: np.ndarray, cell_offsets: np.ndarray,
+                 cell_segments: np.ndarray):
+        self.origin = origin
+        self.cell_size = float(cell_size)
+        self.line_ids = line_ids
+        self.seg_a = seg_a
+        self.seg_b = seg_b
+        self.seg_line = seg_line
+        self.cell_keys = cell_keys
+        self.cell_offsets = cell_offsets
+        self.cell_segments = cell_segments
+
+    @classmethod
+    def build(cls, lines: Sequence[BusLine], cell_size: float = 250.0) -> 'RouteIndex':
+        if cell_size <= 0:
+            raise ValueError('cell_size > 0')
+
+        lines = [line for line in lines if len(line.coords)]
+        if not lines:
+            raise ValueError('lines')
+
+        all_coords = np.concatenate([line.coords for line in lines]).astype(np.float64)
+        origin = (all_coords.min(axis=0) + all_coords.max(axis=0)) / 2
+
+        seg_a, seg_b, seg_line = [], [], []
+        for i, line in enumerate(lines):
+            xy = project(line.coords, origin)
+            if len(xy) == 1:
+                xy = np.repeat(xy, 2, axis=0)
+            seg_a.append(xy[:-1])
+            seg_b.append(xy[1:])
+            seg_line.append(np.full(len(xy) - 1, i, dtype=np.int32))
+
+        seg_a = np.concatenate(seg_a)
+        seg_b = np.concatenate(seg_b)
+        seg_line = np.concatenate(seg_line)
+
+        # Expand every segment into the cells covered by its bounding box
+        lo = np.floor(np.minimum(seg_a, seg_b) / cell_size).astype(np.int64)
+        hi = np.floor(np.maximum(seg_a, seg_b) / cell_size).astype(np.int64)
+        span = hi - lo + 1
+        counts = span[:, 0] * span[:, 1]
+
+        segments = np.repeat(np.arange(len(seg_a)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        ix = lo[segments, 0] + k // span[segments, 1]
+        iy = lo[segments, 1] + k % span[segments, 1]
+
+        keys = _cell_key(ix, iy)
+        order = np.argsort(keys, kind='mergesort')
+        keys = keys[order]
+
+        cell_keys, starts = np.unique(keys, return_index=True)
+        cell_offsets = np.append(starts, len(keys))
+
+        line_ids = np.array([line.line_id for line in lines], dtype=np.int64)
+
+        return cls(origin, cell_size, line_ids, seg_a, seg_b, seg_line, cell_keys, cell_offsets,
+                   segments[order].astype(np.int32))
+
+    def save(self, path: str) -> None:
+        # Through a file, as np.savez would add '.npz' to a path without it and `load` then not find it
+        with open(path, 'wb') as fp:
+            np.savez(fp, origin=self.origin, cell_size=self.cell_size, line_ids=self.line_ids, seg_a=self.seg_a,
+                     seg_b=self.seg_b, seg_line=self.seg_line, cell_keys=self.cell_keys,
+                     cell_offsets=self.cell_offsets, cell_segments=self.cell_segments)
+
+    @classmethod
+    def load(cls, path: str) -> 'RouteIndex':
+        with np.load(path) as data:
+            return cls(data['origin'], float(data['cell_size']), data['line_ids'], data['seg_a'], data['seg_b'],
+                       data['seg_line'], data['cell_keys'], data['cell_offsets'], data['cell_segments'])
+
+    def _project(self, lats, lngs) -> np.ndarray:
+        return project(np.column_stack([np.atleast_1d(lngs), np.atleast_1d(lats)]), self.origin)
+
+    def _candidates(self, ix: np.ndarray, iy: np.ndarray) -> (np.ndarray, np.ndarray):
+        """Segments registered in the given cells, as (cell position, segment) pairs."""
+        keys = _cell_key(ix, iy)
+        pos = np.searchsorted(self.cell_keys, keys)
+        pos = np.minimum(pos, len(self.cell_keys) - 1)
+        found = self.cell_keys[pos] == keys
+
+        start = np.where(found, self.cell_offsets[pos], 0)
+        count = np.where(found, self.cell_offsets[pos + 1] - start, 0)
+
+        owner = np.repeat(np.arange(len(keys)), count)
+        k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        return owner, self.cell_segments[np.repeat(start, count) + k]
+
+    def query_radius_many(self, lats, lngs, radius: float, block: int = 256) -> List[List[Tuple[int, float]]]:
+        """
+        For every point, the lines passing within `radius` meters, as (line_id, distance) pairs sorted by
+        distance. Points are resolved together with array operations, `block` points at a time.
+        """
+        xy = self._project(lats, lngs)
+
+        result = []
+        for start in range(0, len(xy), block):
+            result.extend(self._query_radius_block(xy[start:start + block], radius))
+        return result
+
+    def _query_radius_block(self, xy: np.ndarray, radius: float) -> List[List[Tuple[int, float]]]:
+        n = len(xy)
+
+        # Every point looks at the same square block of cells around its own cell
+        reach = int(np.ceil(radius / self.cell_size))
+        dx, dy = np.meshgrid(np.arange(-reach, reach + 1), np.arange(-reach, reach + 1))
+        dx, dy = dx.ravel(), dy.ravel()
+
+        base = np.floor(xy / self.cell_size).astype(np.int64)
+        ix = (base[:, 0, np.newaxis] + dx).ravel()
+        iy = (base[:, 1, np.newaxis] + dy).ravel()
+
+        cell, seg = self._candidates(ix, iy)
+        point = cell // len(dx)
+
+        d = segment_distances(xy[point], self.seg_a[seg], self.seg_b[seg])
+        near = d <= radius
+        point, line, d = point[near], self.seg_line[seg[near]], d[near]
+
+        # Keep the closest segment of every (point, line) pair
+        order = np.lexsort((d, line, point))
+        point, line, d = point[order], line[order], d[order]
+        first = np.ones(len(point), dtype=bool)
+        first[1:] = (point[1:] != point[:-1]) | (line[1:] != line[:-1])
+        point, line, d = point[first], line[first], d[first]
+
+        order = np.lexsort((d, point))
+        point, line, d = point[order], line[order], d[order]
+
+        result = [[] for _ in range(n)]
+        for p, l, dist in zip(point.tolist(), self.line_ids[line].tolist(), d.tolist()):
+            result[p].append((l, dist))
+        return result
+
+    def query_radius(self, lat: float, lng: float, radius: float) -> List[Tuple[int, float]]:
+        return self.query_radius_many([lat], [lng], radius)[0]
+
+    def lines_near(self, lat: float, lng: float, radius: float) -> List[int]:
+        return [line_id for line_id, _ in self.query_radius(lat, lng, radius)]
+
+    def lines_in_bbox(self, min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> List[int]:
+        lo, hi = self._project([min_lat, max_lat], [min_lng, max_lng])
+
+        lo_cell = np.floor(lo / self.cell_size).astype(np.int64)
+        hi_cell = np.floor(hi / self.cell_size).astype(np.int64)
+        ix, iy = np.meshgrid(np.arange(lo_cell[0], hi_cell[0] + 1), np.arange(lo_cell[1], hi_cell[1] + 1))
+
+        _, seg = self._candidates(ix.ravel(), iy.ravel())
+        seg = np.unique(seg)
+
+        _, _, inside = clip_segments(self.seg_a[seg], self.seg_b[seg], lo, hi)
+        return sorted(self.line_ids[np.unique(self.seg_line[seg[inside]])].tolist())
+
+    def nearest_line(self, lat: float, lng: float, max_radius: Optional[float] = None) -> Optional[Tuple[int, float]]:
+        """The closest line as (line_id, distance), searching rings of growing radius."""
+        radius = self.cell_size
+
+        # Beyond this many cells per query it is cheaper to measure every segment
+        while (2 * np.ceil(radius / self.cell_size) + 1) ** 2 <= len(self.cell_keys):
+            if max_radius is not None and radius >= max_radius:
+                radius = max_radius
+            found = self.query_radius(lat, lng, radius)
+            if found:
+                return found[0]
+            if radius == max_radius:
+                return None
+            radius *= 2
+
+        d = segment_distances(self._project(lat, lng), self.seg_a, self.seg_b)
+        i = int(np.argmin(d))
+        if max_radius is not None and d[i] > max_radius:
+            return None
+        return int(self.line_ids[self.seg_line[i]]), float(d[i])
+
+
+def pairs_within(a: np.ndarray, b: np.ndarray, radius: float) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Every pair of planar points a[i], b[j] at most `radius` apart, as (i, j, distance) arrays.
+
+    The points of `b` are bucketed in a grid of `radius`-sized cells, so each point of `a` is only measured
+    against the points of the 3 x 3 cells around its own.
+    """
+    if radius <= 0:
+        raise ValueError('radius > 0')
+
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 2)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 2)
+
+    b_cells = np.floor(b / radius).astype(np.int64)
+    order = np.argsort(_cell_key(b_cells[:, 0], b_cells[:, 1]), kind='mergesort')
+    b_keys = _cell_key(b_cells[order, 0], b_cells[order, 1])
+
+    a_cells = np.floor(a / radius).astype(np.int64)
+
+    ii, jj = [], []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            keys = _cell_key(a_cells[:, 0] + dx, a_cells[:, 1] + dy)
+            start = np.searchsorted(b_keys, keys, side='left')
+            count = np.searchsorted(b_keys, keys, side='right') - start
+
+            k = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+            ii.append(np.repeat(np.arange(len(a)), count))
+            jj.append(order[np.repeat(start, count) + k])
+
+    i = np.concatenate(ii)
+    j = np.concatenate(jj)
+    d = np.hypot(*(a[i] - b[j]).T)
+
+    near = d <= radius
+    return i[near], j[near], d[near]
+
+
+def _cell_key(ix: np.ndarray, iy: np.ndarray) -> np.ndarray:
+    return np.asarray(ix, dtype=np.int64) * _KEY_RADIX + np.asarray(iy, dtype=np.int64)
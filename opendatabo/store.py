@@ -0,0 +1,210 @@
+import datetime
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Optional, Iterable, List
+
+import numpy as np
+import pandas as pd
+
+from opendatabo import metrics
+from opendatabo.sic import City
+
+TEXT_COLUMNS = ['procedencia', 'mercado', 'observaciones',
+                'precio_mayorista_unit_name', 'precio_minorista_unit_name',
+                ]
+
+NUMERIC_COLUMNS = ['precio_mayorista_val', 'precio_mayorista_unit_val',
+                   'precio_mayorista_per_kg', 'precio_mayorista_per_unit',
+                   'precio_minorista_val', 'precio_minorista_unit_val',
+                   'precio_minorista_per_kg', 'precio_minorista_per_unit',
+                   ]
+
+VALUE_COLUMNS = TEXT_COLUMNS + NUMERIC_COLUMNS
+
+KEY_COLUMNS = ['city', 'fecha', 'producto', 'variedad']
+
+# Rows without a variety keep it as NaN in the frames; in the key of the table it is stored as ''
+MISSING_VARIEDAD = ''
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS prices (
+    producto TEXT NOT NULL,
+    variedad TEXT NOT NULL,
+    city TEXT NOT NULL,
+    fecha TEXT NOT NULL,
+    {values},
+    PRIMARY KEY (producto, variedad, city, fecha)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS prices_by_city ON prices (city, producto, variedad, fecha);
+CREATE INDEX IF NOT EXISTS prices_by_fecha ON prices (fecha);
+'''.format(values=',\n    '.join(['{} TEXT'.format(c) for c in TEXT_COLUMNS] +
+                                  ['{} REAL'.format(c) for c in NUMERIC_COLUMNS]))
+
+
+def _codes(cities: Optional[Iterable[City]]) -> Optional[List[str]]:
+    return None if cities is None else [city.value for city in cities]
+
+
+def _to_variedad(values) -> np.ndarray:
+    values = np.asarray(values, dtype=object)
+    return np.where(pd.isnull(values), MISSING_VARIEDAD, values)
+
+
+def restore_variedad(df: pd.DataFrame) -> pd.DataFrame:
+    """Turn the stored '' varieties of a frame read from the tables back into NaN, in place."""
+    df['variedad'] = df['variedad'].where(df['variedad'] != MISSING_VARIEDAD, np.nan)
+    return df
+
+
+def _to_iso(d) -> Optional[str]:
+    if d is None:
+        return None
+    if isinstance(d, (datetime.date, datetime.datetime, pd.Timestamp)):
+        return d.strftime('%Y-%m-%d')
+    return str(d)
+
+
+class PriceStore:
+    """
+    Local SQLite store of prepared market prices (see `prepare_raw_market_prices`), one row per
+    (city, fecha, producto, variedad).
+
+    Rows are clustered by (producto, variedad, city, fecha) so the history of a product is one range
+    scan, and a second index serves per-city lookups such as the latest prices.
+    """
+
+    def __init__(self, path: str = ':memory:'):
+        self.path = path
+        # The connection is shared between threads, every use of it goes through the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def upsert(self, city: City, df: pd.DataFrame) -> int:
+        """Insert the rows of a prepared frame for `city`, replacing rows with the same key. Returns the count."""
+        flat = df.reset_index()
+        n = flat.shape[0]
+
+        columns = [np.full(n, city.value, dtype=object),
+                   np.array([_to_iso(d) for d in flat['fecha']], dtype=object),
+                   flat['producto'].values,
+                   _to_variedad(flat['variedad']),
+                   ]
+        for c in VALUE_COLUMNS:
+            if c in flat.columns:
+                # NaN becomes NULL, and numpy scalars become plain Python values sqlite3 can bind
+                columns.append(flat[c].astype(object).where(flat[c].notnull(), None).values)
+            else:
+                columns.append(np.full(n, None, dtype=object))
+
+        sql = 'INSERT OR REPLACE INTO prices ({}) VALUES ({})'.format(
+            ', '.join(KEY_COLUMNS + VALUE_COLUMNS), ', '.join('?' * (len(KEY_COLUMNS) + len(VALUE_COLUMNS))))
+
+        rows = (tuple(v.item() if isinstance(v, np.generic) else v for v in row) for row in zip(*columns))
+
+        with metrics.stage('store.upsert'):
+            with self._lock, self._conn:
+                self._conn.executemany(sql, rows)
+
+        metrics.incr('store.rows', n)
+        return n
+
+    @contextmanager
+    def transaction(self):
+        """The connection, held exclusively and committed on success, for modules building on the store."""
+        with self._lock, self._conn:
+            yield self._conn
+
+    def read_sql(self, sql: str, params: list = ()) -> pd.DataFrame:
+        with self._lock:
+            return pd.read_sql_query(sql, self._conn, params=list(params))
+
+    def _query(self, sql: str, params: list) -> pd.DataFrame:
+        df = self.read_sql(sql, params)
+
+        df['fecha'] = pd.to_datetime(df['fecha'], format='%Y-%m-%d').dt.date
+        restore_variedad(df)
+        df.set_index(KEY_COLUMNS, inplace=True)
+        return df
+
+    def price_history(self, producto: str, variedad: Optional[str] = None,
+                      cities: Optional[Iterable[City]] = None, start: Optional[datetime.date] = None,
+                      end: Optional[datetime.date] = None) -> pd.DataFrame:
+        """Prices of a product (and variety) between `start` and `end` inclusive, indexed like `KEY_COLUMNS`."""
+        where = ['producto = ?']
+        params = [producto]
+
+        if variedad is not None:
+            where.append('variedad = ?')
+            params.append(variedad)
+
+        codes = _codes(cities)
+        if codes is not None:
+            where.append('city IN ({})'.format(', '.join('?' * len(codes))))
+            params.extend(codes)
+
+        if start is not None:
+            where.append('fecha >= ?')
+            params.append(_to_iso(start))
+
+        if end is not None:
+            where.append('fecha <= ?')
+            params.append(_to_iso(end))
+
+        sql = 'SELECT {} FROM prices WHERE {} ORDER BY city, fecha, producto, variedad'.format(
+            ', '.join(KEY_COLUMNS + VALUE_COLUMNS), ' AND '.join(where))
+
+        return self._query(sql, params)
+
+    def latest_prices(self, cities: Optional[Iterable[City]] = None,
+                      producto: Optional[str] = None) -> pd.DataFrame:
+        """The most recent row of every (city, producto, variedad)."""
+        where = []
+        params = []
+
+        codes = _codes(cities)
+        if codes is not None:
+            where.append('city IN ({})'.format(', '.join('?' * len(codes))))
+            params.extend(codes)
+
+        if producto is not None:
+            where.append('producto = ?')
+            params.append(producto)
+
+        condition = 'WHERE ' + ' AND '.join(where) if where else ''
+
+        sql = '''
+            SELECT {columns}
+            FROM prices p
+            JOIN (SELECT city, producto, variedad, MAX(fecha) AS fecha
+                  FROM prices {condition}
+                  GROUP BY city, producto, variedad) latest
+            USING (city, producto, variedad, fecha)
+            ORDER BY city, producto, variedad
+        '''.format(columns=', '.join(KEY_COLUMNS + ['p.{0} AS {0}'.format(c) for c in VALUE_COLUMNS]),
+                   condition=condition)
+
+        return self._query(sql, params)
+
+    def cities(self) -> List[City]:
+        with self._lock:
+            codes = {row[0] for row in self._conn.execute('SELECT DISTINCT city FROM prices')}
+        return [city for city in City.all() if city.value in codes]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM prices').fetchone()[0]
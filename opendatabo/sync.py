@@ -0,0 +1,192 @@
+import datetime
+import io
+import json
+import os
+import time
+from typing import Optional, Iterable, List, Tuple
+
+import pandas as pd
+import requests
+
+from opendatabo.cache import ResponseCache, hash_content
+from opendatabo.common import DataNotAvailableException, RetryPolicy, atomic_write
+from opendatabo.merge import MergeStats, merge_partitions
+from opendatabo.sic import City, Year, drop_duplicate_index, fetch_market_prices, read_market_prices_csv
+
+
+def _year_end(year: Year) -> float:
+    """Timestamp of the start of the following year, in local time like `Year.max_value`."""
+    return time.mktime(datetime.datetime(year.value + 1, 1, 1).timetuple())
+
+
+def _no_data(error: Exception) -> bool:
+    """Whether the site answered that it has no such export, rather than failing to give it."""
+    return isinstance(error, DataNotAvailableException) and (error.status_code or 0) < 500
+
+
+class SyncReport:
+    def __init__(self):
+        self.changed: List[Tuple[City, Year]] = []
+        self.unchanged: List[Tuple[City, Year]] = []
+        self.skipped: List[Tuple[City, Year]] = []
+        self.unavailable: List[Tuple[City, Year]] = []
+        self.failed: List[Tuple[City, Year, Exception]] = []
+
+    @property
+    def changed_cities(self) -> List[City]:
+        return [city for city in City.all() if any(c == city for c, _ in self.changed)]
+
+    def __repr__(self):
+        return 'SyncReport(changed={}, unchanged={}, skipped={}, unavailable={}, failed={})'.format(
+            len(self.changed), len(self.unchanged), len(self.skipped), len(self.unavailable), len(self.failed))
+
+
+class PartitionStore:
+    """
+    Local copy of the SIC market prices, kept as one immutable CSV partition per (City, Year).
+
+    A manifest records the content hash, row count and fetch time of every partition. Syncing only
+    downloads partitions that are missing or whose timeframe may still change (see `Timeframe.cache_ttl`),
+    so a year is fetched for the last time once it has closed. A year the site has no export of is marked
+    unavailable and retried after `UNAVAILABLE_RETRY_TTL` seconds; a failed fetch (a 5xx included) never
+    replaces a partition already stored.
+    """
+
+    MANIFEST_NAME = 'manifest.json'
+    UNAVAILABLE_RETRY_TTL = 24 * 60 * 60
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+        try:
+            with open(self._manifest_path()) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.root, PartitionStore.MANIFEST_NAME)
+
+    def _save_manifest(self) -> None:
+        atomic_write(self._manifest_path(), json.dumps(self.manifest, indent=2, sort_keys=True).encode('utf-8'))
+
+    def partition_path(self, city: City, year: Year) -> str:
+        return os.path.join(self.root, city.value, '{}.csv'.format(year.value))
+
+    def entry(self, city: City, year: Year) -> Optional[dict]:
+        return self.manifest.get(city.value, {}).get(str(year.value))
+
+    def needs_refresh(self, city: City, year: Year, now: Optional[float] = None) -> bool:
+        entry = self.entry(city, year)
+        if entry is None:
+            return True
+
+        age = (time.time() if now is None else now) - entry['fetched_at']
+
+        # The site may only have been down, so missing years are asked for again now and then
+        if entry['status'] == 'unavailable':
+            return age >= PartitionStore.UNAVAILABLE_RETRY_TTL
+
+        if entry['fetched_at'] >= _year_end(year):
+            return False
+
+        # A year that closed since it was last fetched is fetched once more, for its final rows
+        ttl = year.cache_ttl()
+        return age >= (Year.CURRENT_CACHE_TTL if ttl is None else ttl)
+
+    def store(self, city: City, year: Year, df: pd.DataFrame) -> bool:
+        """Persist a prepared frame as the partition for (city, year). Returns whether its content changed."""
+        buf = io.StringIO()
+        df.sort_index().to_csv(buf)
+        data = buf.getvalue().encode('utf-8')
+        digest = hash_content(data)
+
+        previous = self.entry(city, year)
+        changed = previous is None or previous.get('sha256') != digest
+
+        if changed:
+            path = self.partition_path(city, year)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write(path, data)
+
+        self._set_entry(city, year, {'status': 'ok', 'sha256': digest, 'rows': df.shape[0],
+                                     'fetched_at': time.time()})
+        return changed
+
+    def has_partition(self, city: City, year: Year) -> bool:
+        entry = self.entry(city, year)
+        return entry is not None and entry['status'] == 'ok'
+
+    def mark_unavailable(self, city: City, year: Year) -> None:
+        self._set_entry(city, year, {'status': 'unavailable', 'fetched_at': time.time()})
+
+    def _set_entry(self, city: City, year: Year, entry: dict) -> None:
+        self.manifest.setdefault(city.value, {})[str(year.value)] = entry
+        self._save_manifest()
+
+    def sync(self, cities: Optional[Iterable[City]] = None, years: Optional[Iterable[Year]] = None,
+             force: bool = False, workers: int = 8, per_host: int = 4, session: Optional[requests.Session] = None,
+             timeout: Optional[float] = 60.0, cache: Optional[ResponseCache] = None, parser=None,
+             retry_policy: Optional[RetryPolicy] = None) -> SyncReport:
+        cities = list(City.all()) if cities is None else list(cities)
+        years = list(Year.all_valid()) if years is None else list(years)
+
+        report = SyncReport()
+        jobs = []
+
+        for city in cities:
+            for year in years:
+                if force or self.needs_refresh(city, year):
+                    jobs.append((city, year))
+                else:
+                    report.skipped.append((city, year))
+
+        for outcome in fetch_market_prices(jobs, workers=workers, per_host=per_host, session=session,
+                                           timeout=timeout, cache=cache, refresh=force, parser=parser,
+                                           retry_policy=retry_policy):
+            job = (outcome.city, outcome.timeframe)
+
+            if outcome.ok:
+                if self.store(outcome.city, outcome.timeframe, outcome.df):
+                    report.changed.append(job)
+                else:
+                    report.unchanged.append(job)
+            elif _no_data(outcome.error) and not self.has_partition(outcome.city, outcome.timeframe):
+                self.mark_unavailable(outcome.city, outcome.timeframe)
+                report.unavailable.append(job)
+            else:
+                # A partition already stored is kept, so the year is still published
+                report.failed.append(job + (outcome.error,))
+
+        return report
+
+    def load_partition(self, city: City, year: Year) -> pd.DataFrame:
+        return read_market_prices_csv(self.partition_path(city, year))
+
+    def years(self, city: City) -> List[Year]:
+        entries = self.manifest.get(city.value, {})
+        return [Year(int(y)) for y in sorted(entries, key=int) if entries[y]['status'] == 'ok']
+
+    def load_city(self, city: City) -> pd.DataFrame:
+        """Rebuild the combined, sorted multi-year dataset of a city from its stored partitions."""
+        parts = [self.load_partition(city, year) for year in self.years(city)]
+
+        if not parts:
+            raise DataNotAvailableException()
+
+        full_df = drop_duplicate_index(pd.concat(parts))
+        full_df.sort_index(inplace=True)
+        return full_df
+
+    def write_city(self, city: City, fp, chunksize: int = 10000) -> MergeStats:
+        """
+        Write the same dataset as `load_city` to the text file `fp` as CSV, merging the sorted partitions
+        `chunksize` rows at a time instead of loading them all.
+        """
+        years = self.years(city)
+
+        if not years:
+            raise DataNotAvailableException()
+
+        return merge_partitions([self.partition_path(city, year) for year in years], fp, chunksize=chunksize)
@@ -0,0 +1,321 @@
+"""
+z/x/y tile pyramids of the bus network, so web maps only download the routes in view, at the detail of
+the zoom level they show.
+
+Tiles are GeoJSON FeatureCollections in the usual slippy map (Web Mercator, XYZ) scheme. Every route is
+simplified for each zoom level and clipped to each tile it crosses, keeping its id and properties.
+"""
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import zipfile
+from decimal import Decimal
+from typing import Optional, Iterable, Iterator, List, Dict, Tuple
+
+import numpy as np
+
+from opendatabo import metrics
+from opendatabo.common import atomic_write
+from opendatabo.cruzero import BusLine
+from opendatabo.geometry import EARTH_RADIUS, project, douglas_peucker_thresholds, clip_segments
+
+TILE_SIZE = 256
+
+# Past this latitude Web Mercator runs off to infinity
+MAX_LATITUDE = 85.0511287798
+
+
+def lnglat_to_world(coords: np.ndarray) -> np.ndarray:
+    """(lng, lat) degrees to Web Mercator world coordinates in [0, 1], y growing southwards."""
+    coords = np.asarray(coords, dtype=np.float64)
+    lat = np.radians(np.clip(coords[:, 1], -MAX_LATITUDE, MAX_LATITUDE))
+
+    world = np.empty_like(coords)
+    world[:, 0] = (coords[:, 0] + 180.0) / 360.0
+    world[:, 1] = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi) / 2.0
+    return world
+
+
+def world_to_lnglat(world: np.ndarray) -> np.ndarray:
+    coords = np.empty_like(world)
+    coords[:, 0] = world[:, 0] * 360.0 - 180.0
+    coords[:, 1] = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * world[:, 1]))))
+    return coords
+
+
+def meters_per_pixel(zoom: int, latitude: float) -> float:
+    """Ground resolution of a tile pixel at `zoom`, around `latitude`."""
+    return 2 * np.pi * EARTH_RADIUS * math.cos(math.radians(latitude)) / (TILE_SIZE * 2 ** zoom)
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """(west, south, east, north) of a tile, in degrees."""
+    corners = world_to_lnglat(np.array([[x, y + 1], [x + 1, y]], dtype=np.float64) / 2 ** z)
+    return corners[0, 0], corners[0, 1], corners[1, 0], corners[1, 1]
+
+
+class TileStats:
+    def __init__(self, tiles: Dict[int, int], features: int, size: int):
+        self.tiles = tiles
+        self.features = features
+        self.size = size
+
+    def __repr__(self):
+        return 'TileStats(tiles={}, features={}, size={})'.format(
+            ', '.join('z{}: {}'.format(z, n) for z, n in sorted(self.tiles.items())), self.features, self.size)
+
+
+def clip_polyline(xy: np.ndarray, lo, hi) -> List[np.ndarray]:
+    """The parts of a planar polyline inside the box [lo, hi], each as its own array of points."""
+    if len(xy) == 1:
+        xy = np.repeat(xy, 2, axis=0)
+
+    a, b = xy[:-1], xy[1:]
+    t0, t1, inside = clip_segments(a, b, lo, hi)
+
+    idx = np.flatnonzero(inside)
+    if not len(idx):
+        return []
+
+    d = b[idx] - a[idx]
+    start = a[idx] + t0[idx, np.newaxis] * d
+    end = a[idx] + t1[idx, np.newaxis] * d
+
+    # Consecutive segments stay in the same part unless the route leaves the box in between
+    breaks = ~((np.diff(idx) == 1) & (t1[idx[:-1]] == 1) & (t0[idx[1:]] == 0))
+    last = np.append(np.flatnonzero(breaks), len(idx) - 1)
+
+    parts = []
+    first = 0
+    for k in last:
+        parts.append(np.concatenate([start[first:k + 1], end[k:k + 1]]))
+        first = k + 1
+    return parts
+
+
+def _properties(line: BusLine) -> dict:
+    return {k: float(v) if isinstance(v, Decimal) else v for k, v in line.properties.items()}
+
+
+# Set in every worker process by `_init_worker`: {zoom: [(line_id, properties, world coords)]}
+_LEVELS = None
+
+
+def _init_worker(levels) -> None:
+    global _LEVELS
+    _LEVELS = levels
+
+
+def _render_tiles(args) -> List[Tuple[int, int, int, bytes, int]]:
+    """Render a batch of tiles of one zoom level as (z, x, y, GeoJSON bytes, features); empty ones are dropped."""
+    z, tiles, buffer, precision = args
+    scale = 2 ** z
+    lines = _LEVELS[z]
+
+    rendered = []
+    for x, y, line_indices in tiles:
+        lo = (x - buffer, y - buffer)
+        hi = (x + 1 + buffer, y + 1 + buffer)
+
+        features = []
+        for i in line_indices:
+            line_id, properties, world = lines[i]
+            parts = [np.round(world_to_lnglat(part / scale), precision).tolist()
+                     for part in clip_polyline(world * scale, lo, hi)]
+            if not parts:
+                continue
+
+            if len(parts) == 1:
+                geometry = {'type': 'LineString', 'coordinates': parts[0]}
+            else:
+                geometry = {'type': 'MultiLineString', 'coordinates': parts}
+
+            features.append({'type': 'Feature', 'id': line_id, 'geometry': geometry, 'properties': properties})
+
+        if features:
+            data = json.dumps({'type': 'FeatureCollection', 'features': features}, allow_nan=False)
+            rendered.append((z, x, y, data.encode('utf-8'), len(features)))
+
+    return rendered
+
+
+def _covered_tiles(world: np.ndarray, z: int, buffer: float) -> Iterator[Tuple[int, int]]:
+    """Tiles touched by the bounding boxes of the segments of a route, at least every tile the route crosses."""
+    n = 2 ** z
+    xy = world * n
+    if len(xy) == 1:
+        xy = np.repeat(xy, 2, axis=0)
+
+    lo = np.clip(np.floor(np.minimum(xy[:-1], xy[1:]) - buffer).astype(np.int64), 0, n - 1)
+    hi = np.clip(np.floor(np.maximum(xy[:-1], xy[1:]) + buffer).astype(np.int64), 0, n - 1)
+
+    seen = set()
+    for (x0, y0), (x1, y1) in zip(lo.tolist(), hi.tolist()):
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                if (x, y) not in seen:
+                    seen.add((x, y))
+                    yield x, y
+
+
+def _simplify_line(args) -> Tuple[int, dict, Dict[int, np.ndarray]]:
+    """The route of a line in world coordinates, simplified for each zoom level."""
+    line, zooms, pixel_tolerance = args
+
+    latitude = float(np.mean(line.coords[:, 1]))
+    tolerances = {z: pixel_tolerance * meters_per_pixel(z, latitude) for z in zooms}
+
+    # One Douglas-Peucker ranking serves every zoom level, as in `simplify_bus_lines`
+    if len(line.coords) < 3:
+        thresholds = np.full(len(line.coords), np.inf)
+    else:
+        thresholds = douglas_peucker_thresholds(project(line.coords), min_tolerance=min(tolerances.values()))
+
+    world = lnglat_to_world(line.coords)
+    return line.line_id, _properties(line), {z: world[thresholds > tolerances[z]] for z in zooms}
+
+
+def _render(lines: List[BusLine], min_zoom: int, max_zoom: int, pixel_tolerance: float, buffer: int,
+            precision: int, processes: Optional[int], batch_size: int) -> Iterator[Tuple[int, int, int, bytes, int]]:
+    if not 0 <= min_zoom <= max_zoom:
+        raise ValueError('0 <= min_zoom <= max_zoom')
+
+    zooms = list(range(min_zoom, max_zoom + 1))
+    margin = buffer / TILE_SIZE
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    tasks = [(line, zooms, pixel_tolerance) for line in lines]
+
+    with metrics.stage('tiles.simplify'):
+        if processes <= 1 or len(tasks) <= 1:
+            simplified = list(map(_simplify_line, tasks))
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                simplified = pool.map(_simplify_line, tasks)
+
+    levels = {z: [(line_id, properties, worlds[z]) for line_id, properties, worlds in simplified] for z in zooms}
+
+    batches = []
+    for z in zooms:
+        tiles = {}
+        for i, (_, _, world) in enumerate(levels[z]):
+            for tile in _covered_tiles(world, z, margin):
+                tiles.setdefault(tile, []).append(i)
+
+        ordered = [(x, y, tiles[x, y]) for x, y in sorted(tiles)]
+        for k in range(0, len(ordered), batch_size):
+            batches.append((z, ordered[k:k + batch_size], margin, precision))
+
+    with metrics.stage('tiles.render'):
+        if processes <= 1 or len(batches) <= 1:
+            _init_worker(levels)
+            try:
+                for batch in map(_render_tiles, batches):
+                    yield from batch
+            finally:
+                _init_worker(None)
+        else:
+            with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(levels,)) as pool:
+                for batch in pool.imap(_render_tiles, batches):
+                    yield from batch
+
+
+def render_tiles(lines: Iterable[BusLine], min_zoom: int = 10, max_zoom: int = 16, pixel_tolerance: float = 1.0,
+                 buffer: int = 8, precision: int = 6, processes: Optional[int] = None,
+                 batch_size: int = 64) -> Iterator[Tuple[int, int, int, bytes]]:
+    """
+    Render the tile pyramid of the routes, yielding (z, x, y, GeoJSON bytes) for every non-empty tile.
+
+    Routes are simplified to `pixel_tolerance` pixels of each zoom level, and clipped to their tiles plus a
+    margin of `buffer` pixels so lines join up across tile edges. Routes are simplified, and batches of tiles
+    rendered, by a pool of `processes` workers (one per CPU by default); the tiles come out in the same order
+    either way.
+    """
+    lines = [line for line in lines if len(line.coords)]
+
+    for z, x, y, data, _ in _render(lines, min_zoom, max_zoom, pixel_tolerance, buffer, precision, processes,
+                                    batch_size):
+        yield z, x, y, data
+
+
+def tile_path(z: int, x: int, y: int) -> str:
+    return '{}/{}/{}.geojson'.format(z, x, y)
+
+
+def _tilejson(lines: List[BusLine], min_zoom: int, max_zoom: int) -> bytes:
+    coords = np.concatenate([line.coords for line in lines]) if lines else np.zeros((1, 2))
+    west, south = coords.min(axis=0).tolist()
+    east, north = coords.max(axis=0).tolist()
+
+    return json.dumps({'tilejson': '2.2.0',
+                       'name': 'lineas-de-buses',
+                       'format': 'geojson',
+                       'scheme': 'xyz',
+                       'tiles': ['{z}/{x}/{y}.geojson'],
+                       'minzoom': min_zoom,
+                       'maxzoom': max_zoom,
+                       'bounds': [west, south, east, north],
+                       }, indent=2).encode('utf-8')
+
+
+def _swap_directory(src: str, dst: str) -> None:
+    """Move the directory `src` to `dst`, replacing whatever `dst` held."""
+    if not os.path.exists(dst):
+        os.rename(src, dst)
+        return
+
+    old_path = dst + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    os.rename(dst, old_path)
+    os.rename(src, dst)
+    shutil.rmtree(old_path)
+
+
+def write_tiles(lines: Iterable[BusLine], path: str, min_zoom: int = 10, max_zoom: int = 16,
+                pixel_tolerance: float = 1.0, buffer: int = 8, precision: int = 6, processes: Optional[int] = None,
+                batch_size: int = 64) -> TileStats:
+    """
+    Render the tile pyramid (see `render_tiles`) to `path`: a `.zip` archive, or else a directory laid out as
+    `z/x/y.geojson`. A `tiles.json` (TileJSON) next to the tiles describes the pyramid.
+    """
+    lines = [line for line in lines if len(line.coords)]
+    stats = TileStats({}, 0, 0)
+
+    def rendered():
+        for z, x, y, data, features in _render(lines, min_zoom, max_zoom, pixel_tolerance, buffer, precision,
+                                               processes, batch_size):
+            stats.tiles[z] = stats.tiles.get(z, 0) + 1
+            stats.features += features
+            stats.size += len(data)
+            yield tile_path(z, x, y), data
+
+    tilejson = _tilejson(lines, min_zoom, max_zoom)
+
+    if path.endswith('.zip'):
+        # Written aside and moved into place, so a failed run never leaves a truncated archive behind
+        tmp_path = path + '.tmp'
+        with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for name, data in rendered():
+                archive.writestr(name, data)
+            archive.writestr('tiles.json', tilejson)
+        os.replace(tmp_path, path)
+    else:
+        # Likewise rendered into a fresh directory and swapped in, so tiles of an earlier run are dropped
+        path = os.path.normpath(path)
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        for name, data in rendered():
+            tile_file = os.path.join(tmp_path, *name.split('/'))
+            os.makedirs(os.path.dirname(tile_file), exist_ok=True)
+            with open(tile_file, 'wb') as f:
+                f.write(data)
+        os.makedirs(tmp_path, exist_ok=True)
+        atomic_write(os.path.join(tmp_path, 'tiles.json'), tilejson)
+        _swap_directory(tmp_path, path)
+
+    metrics.incr('tiles.count', sum(stats.tiles.values()))
+    return stats
@@ -0,0 +1,47 @@
+import pytest
+
+from opendatabo import sic, cruzero
+
+from fixture_server import CkanStub, FixtureServer
+
+
+@pytest.fixture(autouse=True)
+def sic_retry_policy(monkeypatch):
+    # A fresh circuit breaker for every test, so that failures of one test never open it for the next
+    monkeypatch.setattr(sic, 'RETRY_POLICY', sic.make_retry_policy())
+
+
+@pytest.fixture
+def stub_server():
+    with FixtureServer() as server:
+        yield server
+
+
+MARKET_PRICES_CSV = '''fecha,producto,variedad,Precio Mayorista,Precio Minorista,Procedencia,observaciones
+02/01/2008,Papa,Holandesa,100 Bs.-/qq,2 Bs.-/Libra,Cochabamba,
+02/01/2008,Tomate,Perita,50 Bs.-/Caja de 18 Kg,4 Bs.-/Kilo,Santa Cruz,
+03/01/2008,Papa,Holandesa,105 Bs.-/qq,2 Bs.-/Libra,Cochabamba,
+03/01/2008,Huevo,Blanco,25 Bs.-/100 U.,1 Bs.-/Unidad,Santa Cruz,sin stock
+'''
+
+
+def sic_stub_path(city, timeframe) -> str:
+    return '/sic/pref_{}_{}_export.php'.format(city.to_url_part(), timeframe.to_url_part())
+
+
+@pytest.fixture
+def sic_stub(stub_server, monkeypatch):
+    monkeypatch.setattr(sic, 'SIC_URL', stub_server.url + '/sic')
+    return stub_server
+
+
+@pytest.fixture
+def cruzero_stub(stub_server, monkeypatch):
+    monkeypatch.setattr(cruzero, 'CRUZERO_URL', stub_server.url + '/cruzero')
+    return stub_server
+
+
+@pytest.fixture
+def ckan_stub():
+    with CkanStub() as server:
+        yield server
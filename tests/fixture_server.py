@@ -0,0 +1,267 @@
+import datetime
+import json
+import os
+import random
+import re
+import threading
+import time
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Optional
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FixtureServer:
+    """
+    Local stand-in for sicsantacruz.com and cruzero.net. Responses are registered per path (query string
+    included), optionally slowed down or failing, and the server records every request and the highest
+    number of requests it had in flight at the same time.
+    """
+
+    def __init__(self):
+        self._routes = {}
+        self._lock = threading.Lock()
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _serve(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+
+                with stub._lock:
+                    stub.requests.append((self.command, self.path, body))
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+
+                try:
+                    status, payload, content_type, delay, etag = stub._routes.get(
+                        self.path, (404, b'', 'text/plain', 0.0, None))
+                    if delay:
+                        time.sleep(delay)
+
+                    if etag is not None and self.headers.get('If-None-Match') == etag:
+                        status, payload = 304, b''
+
+                    self.send_response(status)
+                    self.send_header('Content-Type', content_type)
+                    if etag is not None:
+                        self.send_header('ETag', etag)
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+
+            do_GET = _serve
+            do_POST = _serve
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def add(self, path: str, payload, status: int = 200, content_type: str = 'text/html', delay: float = 0.0,
+            etag: Optional[str] = None):
+        """Serve `payload` at `path`. With an `etag`, requests that send it back get 304 Not Modified."""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self._routes[path] = (status, payload, content_type, delay, etag)
+
+    def add_fixture(self, path: str, name: str, **kwargs):
+        with open(os.path.join(FIXTURES_DIR, name), 'rb') as f:
+            self.add(path, f.read(), **kwargs)
+
+    def replay_sic(self):
+        """Serve the recorded SIC exports under /sic, the way `make_market_prices_url` lays them out."""
+        for name in os.listdir(os.path.join(FIXTURES_DIR, 'sic')):
+            stem, ext = os.path.splitext(name)
+            if ext == '.csv':
+                self.add_fixture('/sic/{}.php'.format(stem), os.path.join('sic', name), content_type='text/csv')
+
+    def replay_cruzero(self):
+        """Serve the recorded Cruzero line list and routes under /cruzero."""
+        self.add_fixture('/cruzero/lineasbuses', os.path.join('cruzero', 'lineasbuses.html'))
+
+        for name in os.listdir(os.path.join(FIXTURES_DIR, 'cruzero')):
+            match = re.match(r'^json_rutas_(\d+)\.json$', name)
+            if match:
+                self.add_fixture('/cruzero/lineasbuses/json_rutas?lbsId={}'.format(match.group(1)),
+                                 os.path.join('cruzero', name), content_type='application/json')
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class CkanStub:
+    """
+    Local stand-in for the CKAN action API, covering what the publisher uses: package_show,
+    resource_create and resource_update of a single package. Uploaded files are kept in `uploads`, and
+    `connections` records the client ports the calls came from.
+    """
+
+    def __init__(self, package_id: str = 'sic'):
+        self.package_id = package_id
+        self.resources = []
+        self.uploads = {}
+        self.calls = []
+        self.connections = set()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                action = self.path.rsplit('/', 1)[-1]
+
+                stub.calls.append(action)
+                stub.connections.add(self.client_address[1])
+
+                if self.headers.get('Content-Type', '').startswith('multipart/form-data'):
+                    data, files = _parse_multipart(self.headers['Content-Type'], body)
+                else:
+                    data, files = json.loads(body.decode('utf-8')), {}
+
+                status, result = stub._handle(action, data, files)
+                payload = json.dumps({'success': status == 200, 'result' if status == 200 else 'error': result})
+                payload = payload.encode('utf-8')
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def _handle(self, action: str, data: dict, files: dict):
+        if action == 'package_show':
+            if data.get('id') != self.package_id:
+                return 404, {'__type': 'Not Found Error', 'message': 'Not found'}
+            return 200, {'id': self.package_id, 'resources': list(self.resources)}
+
+        if action == 'resource_create':
+            resource = {'id': 'res-{}'.format(len(self.resources) + 1), 'package_id': data['package_id']}
+            self.resources.append(resource)
+        elif action == 'resource_update':
+            matching = [r for r in self.resources if r['id'] == data['id']]
+            if not matching:
+                return 404, {'__type': 'Not Found Error', 'message': 'Not found'}
+            resource = matching[0]
+        else:
+            return 400, {'__type': 'Validation Error', 'message': 'unsupported action'}
+
+        resource.update((k, v) for k, v in data.items() if k not in ('id', 'package_id'))
+        if 'upload' in files:
+            self.uploads[resource['id']] = files['upload']
+        return 200, dict(resource)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _parse_multipart(content_type: str, body: bytes):
+    message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode('ascii') + b'\r\n\r\n' + body)
+
+    data, files = {}, {}
+    for part in message.get_payload():
+        name = part.get_param('name', header='content-disposition')
+        if part.get_filename() is None:
+            data[name] = part.get_payload(decode=True).decode('utf-8')
+        else:
+            files[name] = (part.get_filename(), part.get_payload(decode=True))
+    return data, files
+
+
+_PRODUCTS = [('Papa', 'Holandesa', 'qq', 'Libra'),
+             ('Papa', 'Imilla', 'Arroba (@)', 'Libra'),
+             ('Tomate', 'Perita', 'Caja de 18 Kg', 'Kilo'),
+             ('Cebolla', 'Roja', 'Bolsa (4@)', 'Libra'),
+             ('Huevo', 'Blanco', '100 U.', 'Unidad'),
+             ('Platano', 'Postre', 'Docena', 'Unidad'),
+             ('Arroz', 'Grano de Oro', 'qq', 'Libra'),
+             ('Yuca', 'Blanca', 'Amarro', 'Unidad'),
+             ]
+
+_ORIGINS = ['Cochabamba', 'Santa Cruz', 'La Paz', 'Tarija', 'Chuquisaca']
+
+
+def synthetic_market_prices_csv(rows: int, year: int = 2010, seed: int = 0) -> str:
+    """A SIC export of `rows` rows, `len(_PRODUCTS)` products a day starting on January 1st of `year`."""
+    rng = random.Random(seed)
+
+    lines = ['fecha,producto,variedad,Precio Mayorista,Precio Minorista,Nom_Procedencia,observaciones']
+    for i in range(rows):
+        day, k = divmod(i, len(_PRODUCTS))
+        producto, variedad, wholesale, retail = _PRODUCTS[k]
+        fecha = (datetime.date(year, 1, 1) + datetime.timedelta(days=day)).strftime('%d/%m/%Y')
+        lines.append('{},{},{},{} Bs.-/{},{} Bs.-/{},{},'.format(fecha, producto, variedad, rng.randint(20, 400),
+                                                                 wholesale, rng.randint(1, 12), retail,
+                                                                 rng.choice(_ORIGINS)))
+    return '\n'.join(lines) + '\n'
+
+
+def synthetic_bus_line_json(line_id: int, points: int, seed: int = 0) -> str:
+    """A Cruzero `json_rutas` payload for a random-walk route of `points` points around Santa Cruz."""
+    rng = random.Random(seed + line_id)
+
+    lat, lng = -17.78 + rng.uniform(-0.05, 0.05), -63.18 + rng.uniform(-0.05, 0.05)
+    route = []
+    for k in range(points):
+        lat += rng.uniform(-0.0005, 0.0005)
+        lng += rng.uniform(-0.0005, 0.0005)
+        route.append({'lbrId': str(k), 'lbsId': str(line_id),
+                      'lbrLatitud': '{:.7f}'.format(lat), 'lbrLongitud': '{:.7f}'.format(lng)})
+
+    return json.dumps({'infoLinea': {'lbsId': str(line_id),
+                                     'lbsNombre': 'Linea {}'.format(line_id),
+                                     'lbsVelocidad': '{:.2f}'.format(rng.uniform(14, 24)),
+                                     'lbsDistancia': '{:.2f}'.format(rng.uniform(15, 35)),
+                                     'lbsTiempo': str(rng.randint(50, 110))},
+                       'lineasbusesruta': route})
@@ -0,0 +1,95 @@
+import datetime
+import io
+
+import pandas as pd
+import pytest
+
+from opendatabo.aggregates import PriceAggregates
+from opendatabo.sic import City, prepare_raw_market_prices
+from opendatabo.store import PriceStore
+
+from conftest import MARKET_PRICES_CSV
+from fixture_server import synthetic_market_prices_csv
+
+
+def prepared(csv: str) -> pd.DataFrame:
+    return prepare_raw_market_prices(pd.read_csv(io.StringIO(csv)))
+
+
+def test_weekly_and_monthly_aggregates():
+    aggregates = PriceAggregates(PriceStore())
+    aggregates.ingest(City.SANTA_CRUZ, prepared(MARKET_PRICES_CSV))
+
+    monthly = aggregates.series('Papa', 'Holandesa')
+    assert list(monthly.index) == [('M', 'sc', 'Papa', 'Holandesa', 'mayorista', 'kg', datetime.date(2008, 1, 1))]
+
+    row = monthly.iloc[0]
+    per_kg = [p / (112 * 0.45359237) for p in (100, 105)]
+    assert row['count'] == 2
+    assert row['mean'] == pytest.approx(sum(per_kg) / 2)
+    assert row['min'] == pytest.approx(per_kg[0])
+    assert row['max'] == pytest.approx(per_kg[1])
+    assert row['rolling_mean'] == pytest.approx(row['mean'])
+
+    # 2008-01-02 was a Wednesday
+    weekly = aggregates.series('Huevo', period='W', side='minorista')
+    assert weekly.index[0][-2:] == ('unit', datetime.date(2007, 12, 31))
+    assert weekly['mean'].tolist() == [1.0]
+
+
+def test_incremental_matches_rebuild():
+    csv = synthetic_market_prices_csv(8 * 120, year=2010)
+    header, rows = csv.split('\n', 1)
+    rows = rows.strip().split('\n')
+
+    aggregates = PriceAggregates(PriceStore())
+
+    # Feed the data in daily-ish batches, the way `Today` and current-year updates arrive
+    for i in range(0, len(rows), 40):
+        aggregates.ingest(City.SANTA_CRUZ, prepared('\n'.join([header] + rows[i:i + 40]) + '\n'))
+
+    views = [(period, side) for period in ('W', 'M') for side in ('mayorista', 'minorista')]
+    incremental = {(p, s): aggregates.series('Papa', period=p, side=s) for p, s in views}
+
+    aggregates.rebuild()
+
+    for (p, s), df in incremental.items():
+        pd.testing.assert_frame_equal(df, aggregates.series('Papa', period=p, side=s))
+
+
+def test_rolling_mean_and_latest():
+    csv = synthetic_market_prices_csv(8 * 100, year=2010, seed=3)
+    aggregates = PriceAggregates(PriceStore())
+    aggregates.ingest(City.CAMIRI, prepared(csv))
+
+    monthly = aggregates.series('Arroz', 'Grano de Oro', side='mayorista')
+    counts = monthly['count'].values
+    sums = monthly['mean'].values * counts
+    expected = [sums[max(0, i - 2):i + 1].sum() / counts[max(0, i - 2):i + 1].sum() for i in range(len(counts))]
+    assert monthly['rolling_mean'].tolist() == pytest.approx(expected)
+
+    latest = aggregates.latest(period='M', cities=[City.CAMIRI])
+    assert latest.shape[0] == 8
+    assert set(latest.index.get_level_values('period_start')) == {datetime.date(2010, 4, 1)}
+
+
+def test_ingest_skips_unchanged_sources(tmpdir):
+    path = str(tmpdir.join('prices.db'))
+    df = prepared(MARKET_PRICES_CSV)
+
+    with PriceStore(path) as store:
+        aggregates = PriceAggregates(store)
+        assert aggregates.ingest(City.SANTA_CRUZ, df, source='2008') == 4
+        assert aggregates.ingest(City.SANTA_CRUZ, df, source='2008') == 0
+        # Another city, or no source at all, is ingested as before
+        assert aggregates.ingest(City.CAMIRI, df, source='2008') == 4
+        assert aggregates.ingest(City.SANTA_CRUZ, df) == 4
+
+    # The digests are kept with the prices, for the next run
+    with PriceStore(path) as store:
+        aggregates = PriceAggregates(store)
+        assert aggregates.ingest(City.SANTA_CRUZ, df, source='2008') == 0
+
+        changed = prepared(MARKET_PRICES_CSV.replace('100 Bs.-/qq', '110 Bs.-/qq'))
+        assert aggregates.ingest(City.SANTA_CRUZ, changed, source='2008') == 4
+        assert aggregates.series('Papa', 'Holandesa', cities=[City.SANTA_CRUZ])['min'].iloc[0] == pytest.approx(105 / (112 * 0.45359237))
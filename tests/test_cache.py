@@ -0,0 +1,90 @@
+import os
+import time
+
+from opendatabo.cache import CacheEntry, DiskCache, MemoryCache, cached_request, make_cache_key
+
+
+def test_make_cache_key():
+    assert make_cache_key('post', 'http://a/b', {'x': '1', 'y': '2'}) \
+           == make_cache_key('POST', 'http://a/b', {'y': '2', 'x': '1'})
+    assert make_cache_key('POST', 'http://a/b', {'x': '1'}) != make_cache_key('POST', 'http://a/b', {'x': '2'})
+    assert make_cache_key('GET', 'http://a/b') != make_cache_key('GET', 'http://a/c')
+
+
+def test_cache_entry_freshness():
+    assert CacheEntry(b'x', ttl=None, stored_at=0).is_fresh()
+    assert not CacheEntry(b'x', ttl=60, stored_at=0).is_fresh(now=61)
+    assert CacheEntry(b'x', ttl=60, stored_at=0).is_fresh(now=59)
+
+
+def test_memory_cache_lru_eviction():
+    cache = MemoryCache(max_bytes=10)
+
+    cache.set('a', CacheEntry(b'1234'))
+    cache.set('b', CacheEntry(b'1234'))
+    assert cache.get('a') is not None
+    cache.set('c', CacheEntry(b'1234'))
+
+    assert cache.get('b') is None
+    assert cache.get('a').content == b'1234'
+    assert cache.size == 8
+
+
+def test_disk_cache_persistence_and_eviction(tmpdir):
+    directory = str(tmpdir)
+
+    cache = DiskCache(directory, max_bytes=10)
+    cache.set('a', CacheEntry(b'1234', ttl=5))
+    cache.set('b', CacheEntry(b'1234'))
+
+    # Make 'a' the most recently used entry
+    os.utime(os.path.join(directory, 'b.json'), (time.time() - 10, time.time() - 10))
+    assert cache.get('a') is not None
+
+    cache = DiskCache(directory, max_bytes=10)
+    cache.set('c', CacheEntry(b'1234'))
+
+    assert cache.get('b') is None
+    assert cache.get('a').content == b'1234'
+    assert cache.get('a').ttl == 5
+
+
+def test_disk_cache_rejects_corrupted_payload(tmpdir):
+    cache = DiskCache(str(tmpdir))
+    cache.set('a', CacheEntry(b'1234'))
+
+    with open(os.path.join(str(tmpdir), 'a.bin'), 'wb') as f:
+        f.write(b'4321')
+
+    assert cache.get('a') is None
+
+
+def test_cached_request(stub_server):
+    stub_server.add('/data', 'hello')
+    stub_server.add('/missing', '', status=404)
+    cache = MemoryCache()
+
+    r = cached_request('POST', stub_server.url + '/data', data={'type': 'csv'}, cache=cache)
+    assert not r.from_cache and r.content == b'hello'
+
+    r = cached_request('POST', stub_server.url + '/data', data={'type': 'csv'}, cache=cache)
+    assert r.from_cache and r.text == 'hello'
+
+    r = cached_request('POST', stub_server.url + '/data', data={'type': 'csv'}, cache=cache, refresh=True)
+    assert not r.from_cache
+
+    cached_request('GET', stub_server.url + '/missing', cache=cache)
+    cached_request('GET', stub_server.url + '/missing', cache=cache)
+
+    assert len(stub_server.requests) == 4
+
+
+def test_cached_request_validate(stub_server):
+    stub_server.add('/data', 'Fatal error')
+    cache = MemoryCache()
+
+    for _ in range(2):
+        r = cached_request('GET', stub_server.url + '/data', cache=cache, validate=lambda c: b'Fatal' not in c)
+        assert not r.from_cache
+
+    assert len(stub_server.requests) == 2
@@ -0,0 +1,115 @@
+import io
+import os
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+from opendatabo.cli import _write_years, build_parser, main
+from opendatabo.routes import RouteSnapshot
+from opendatabo.sic import City, Year, prepare_raw_market_prices, read_market_prices_csv
+
+from conftest import MARKET_PRICES_CSV, sic_stub_path
+from test_routes import serve_lines
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def _run(code: str) -> str:
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                          env=env).stdout.decode()
+
+
+def test_cli_imports_lazily():
+    loaded = _run('import sys\n'
+                  'from opendatabo.cli import build_parser\n'
+                  'build_parser().parse_args(["export-sic", "-w", "2008"])\n'
+                  'print(" ".join(m for m in ["pandas", "numpy", "requests", "ckanapi", "structlog"]'
+                  ' if m in sys.modules))')
+
+    assert loaded.split() == []
+
+
+def test_cli_help():
+    for argv in [['--help'], ['upload-sic', '--help'], ['upload-cruzero', '--help']]:
+        with pytest.raises(SystemExit) as e:
+            main(argv)
+        assert e.value.code == 0
+
+    with pytest.raises(SystemExit):
+        build_parser().parse_args([])
+
+
+def test_cli_export_sic(sic_stub, tmpdir):
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2008)), MARKET_PRICES_CSV)
+    output = str(tmpdir.join('precios.csv'))
+
+    main(['export-sic', '-c', '-l', 'sc', '-w', '2008', '-o', output])
+
+    df = pd.read_csv(output)
+    assert list(df.columns[:3]) == ['fecha', 'producto', 'variedad']
+    assert df.shape[0] == MARKET_PRICES_CSV.strip().count('\n')
+
+
+def test_cli_upload_cruzero_commits_after_publishing(cruzero_stub, ckan_stub, tmpdir):
+    serve_lines(cruzero_stub, [1, 2])
+    snapshot_dir = str(tmpdir.join('snapshot'))
+
+    def upload(package):
+        main(['upload-cruzero', '--host', ckan_stub.url, '-p', package, '-r', 'Buses', '--snapshot-dir', snapshot_dir])
+
+    # The upload fails, and the snapshot is left as it was
+    with pytest.raises(SystemExit):
+        upload('missing')
+    assert RouteSnapshot(snapshot_dir).fingerprints() == {}
+
+    upload('sic')
+    assert ckan_stub.calls.count('resource_create') == 1
+    assert sorted(RouteSnapshot(snapshot_dir).fingerprints()) == [1, 2]
+
+    # Nothing changed since it was published
+    upload('sic')
+    assert ckan_stub.calls.count('resource_create') == 1
+
+
+def test_write_years_with_different_columns():
+    fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'sic')
+    parts = [prepare_raw_market_prices(pd.read_csv(os.path.join(fixtures, name)))
+             for name in ('pref_sc_2008_ano_export.csv', 'pref_cbba_2010_ano_export.csv')]
+    assert 'mercado' not in parts[0].columns and 'mercado' in parts[1].columns
+
+    buf = io.StringIO()
+    _write_years(parts, buf)
+    buf.seek(0)
+    written = read_market_prices_csv(buf)
+
+    # Every value stays under its own header, and the year without a market leaves it empty
+    expected = pd.concat(parts).sort_index()
+    assert written.shape[0] == expected.shape[0]
+    for c in ('mercado', 'observaciones', 'procedencia'):
+        assert written[c].fillna('').astype(str).tolist() == expected[c].fillna('').astype(str).tolist()
+    in_2008 = pd.to_datetime(written.index.get_level_values('fecha')).year == 2008
+    assert in_2008.any() and written.mercado[in_2008].isnull().all()
+
+
+def test_cli_upload_sic_sync_retries_failed_uploads(sic_stub, ckan_stub, tmpdir):
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2008)), MARKET_PRICES_CSV)
+    sync_dir = str(tmpdir.join('partitions'))
+
+    def upload(package):
+        main(['upload-sic', '--host', ckan_stub.url, '-p', package, '-r', 'Precios', '--sync-dir', sync_dir])
+
+    # The upload fails after the partitions are stored
+    with pytest.raises(SystemExit):
+        upload('missing')
+
+    # Nothing changes at the site, but the city was never published
+    upload('sic')
+    assert ckan_stub.calls.count('resource_create') == 1
+    assert [r['name'] for r in ckan_stub.resources] == ['Precios SANTA_CRUZ']
+
+    upload('sic')
+    assert ckan_stub.calls.count('resource_create') == 1
+    assert 'resource_update' not in ckan_stub.calls
@@ -1,8 +1,11 @@
+import asyncio
+import time
 from itertools import count
 
 import pytest
 
-from opendatabo.common import retry_on
+from opendatabo.common import retry_on, RetryPolicy, RetryBudget, CircuitBreaker, CircuitOpenError, HostRateLimiter, \
+    make_session
 
 
 def test_retry_on_basic():
@@ -34,3 +37,176 @@ def test_retry_on_different_type():
         subject()
 
     assert next(raise_count) == 1
+
+
+def test_retry_on_zero_retries_calls_once():
+    calls = count()
+
+    @retry_on(KeyError, retries=0)
+    def subject():
+        next(calls)
+        raise KeyError()
+
+    with pytest.raises(KeyError):
+        subject()
+
+    assert next(calls) == 1
+
+
+def test_retry_policy_backoff_jitter():
+    policy = RetryPolicy(base_delay=1.0, max_delay=5.0)
+
+    for i, cap in enumerate([1.0, 2.0, 4.0, 5.0, 5.0]):
+        assert cap / 2 <= policy.backoff(i) <= cap
+
+    assert RetryPolicy(base_delay=1.0, jitter=False).backoff(2) == 4.0
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_retry_policy_statuses(monkeypatch):
+    monkeypatch.setattr('opendatabo.common.time.sleep', lambda t: None)
+    responses = [FakeResponse(503), FakeResponse(503), FakeResponse(200)]
+
+    @RetryPolicy(statuses=[503], attempts=3)
+    def subject():
+        return responses.pop(0)
+
+    r = subject()
+
+    assert r.status_code == 200 and not responses
+
+    @RetryPolicy(statuses=[503], attempts=2)
+    def always_down():
+        return FakeResponse(503)
+
+    assert always_down().status_code == 503
+
+
+def test_retry_policy_deadline_and_budget():
+    calls = count()
+
+    @RetryPolicy(KeyError, attempts=10, base_delay=5.0, deadline=1.0)
+    def subject():
+        next(calls)
+        raise KeyError()
+
+    start = time.monotonic()
+    with pytest.raises(KeyError):
+        subject()
+
+    assert next(calls) == 1
+    assert time.monotonic() - start < 1.0
+
+    budget = RetryBudget(0.05)
+    calls = count()
+
+    @RetryPolicy(KeyError, attempts=10, base_delay=0.02, jitter=False, budget=budget)
+    def budgeted():
+        next(calls)
+        raise KeyError()
+
+    with pytest.raises(KeyError):
+        budgeted()
+
+    # Sleeps of 0.02 then 0.04 would exceed the budget, so only one retry happens
+    assert next(calls) == 2
+    assert budget.remaining == pytest.approx(0.03)
+
+
+def test_circuit_breaker_fails_fast():
+    breaker = CircuitBreaker(threshold=2, reset_after=0.1)
+    calls = count()
+
+    @RetryPolicy(KeyError, attempts=1, breaker=breaker, key=lambda host: host)
+    def subject(host):
+        next(calls)
+        raise KeyError()
+
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            subject('a')
+
+    with pytest.raises(CircuitOpenError):
+        subject('a')
+    with pytest.raises(KeyError):
+        subject('b')
+
+    assert next(calls) == 3
+
+    time.sleep(0.1)
+    with pytest.raises(KeyError):
+        subject('a')
+    assert breaker.is_open('a')
+
+    breaker.record_success('a')
+    assert not breaker.is_open('a')
+
+
+def test_retry_policy_trips():
+    breaker = CircuitBreaker(threshold=1, reset_after=60)
+
+    @RetryPolicy((KeyError, ValueError), attempts=2, delay=lambda i: 0.0, breaker=breaker,
+                 trips=lambda e: isinstance(e, (ValueError, OSError)))
+    def subject(error):
+        raise error
+
+    # Retried, but not a failure of the host
+    with pytest.raises(KeyError):
+        subject(KeyError())
+    assert not breaker.is_open(subject.__wrapped__.__qualname__)
+
+    # Not retried, but a failure of the host all the same
+    with pytest.raises(OSError):
+        subject(OSError())
+    assert breaker.is_open(subject.__wrapped__.__qualname__)
+
+
+def test_retry_policy_async():
+    calls = count()
+
+    @RetryPolicy(KeyError, attempts=3, base_delay=0.01)
+    async def subject():
+        if next(calls) < 2:
+            raise KeyError()
+        return 'ok'
+
+    assert asyncio.run(subject()) == 'ok'
+    assert next(calls) == 3
+
+
+def test_host_rate_limiter():
+    now = [0.0]
+    sleeps = []
+
+    def sleep(t):
+        sleeps.append(t)
+
+    limiter = HostRateLimiter(2.0, clock=lambda: now[0], sleep=sleep)
+
+    waits = [limiter.wait('http://a.example/x') for _ in range(3)]
+    assert waits == [0.0, 0.5, 1.0]
+    # Another host has its own slots
+    assert limiter.wait('http://b.example/x') == 0.0
+
+    now[0] = 5.0
+    assert limiter.wait('http://a.example/y') == 0.0
+    assert sleeps == [0.5, 1.0]
+
+
+def test_make_session_rate_limited(stub_server):
+    stub_server.add('/x', 'ok')
+    session = make_session(pool_size=2, rate_limiter=HostRateLimiter(20.0))
+
+    start = time.monotonic()
+    for _ in range(4):
+        assert session.get(stub_server.url + '/x').text == 'ok'
+
+    assert time.monotonic() - start >= 3 / 20.0
@@ -1,7 +1,19 @@
-from opendatabo.cruzero import get_bus_line, get_all_bus_line_ids
+import io
+import json
+from decimal import Decimal
 
+import geojson
+import numpy as np
+import pytest
 
-def test_get_bus_line():
+from opendatabo.cache import MemoryCache
+from opendatabo.common import DataNotAvailableException
+from opendatabo.cruzero import get_bus_line, get_all_bus_line_ids, get_all_bus_lines, harvest_bus_lines, \
+    BusLine, LatLng, bus_lines_to_geojson, write_geojson, GeoJSONEncoderWithDecimal, simplify_bus_lines
+
+
+def test_get_bus_line(cruzero_stub):
+    cruzero_stub.replay_cruzero()
     line1 = get_bus_line(1)
 
     assert line1.line_id == 1
@@ -11,8 +23,149 @@ def test_get_bus_line():
     assert line1.total_time
 
 
-def test_get_all_bus_line_ids():
+def test_get_all_bus_line_ids(cruzero_stub):
+    cruzero_stub.replay_cruzero()
     line_ids = get_all_bus_line_ids()
 
-    assert line_ids
+    assert line_ids == [1, 2, 5, 9, 17]
+
+
+def _bus_line_json(line_id, points=3):
+    return json.dumps({'infoLinea': {'lbsNombre': 'Linea {}'.format(line_id),
+                                     'lbsVelocidad': '20.5',
+                                     'lbsDistancia': '12.3',
+                                     'lbsTiempo': '45'},
+                       'lineasbusesruta': [{'lbrLatitud': '-17.78{}'.format(i),
+                                            'lbrLongitud': '-63.18{}'.format(i)} for i in range(points)],
+                       })
+
+
+def test_harvest_bus_lines_order_and_failures(cruzero_stub):
+    # Earlier lines answer slower, so they complete out of order
+    for line_id in range(1, 9):
+        cruzero_stub.add('/cruzero/lineasbuses/json_rutas?lbsId={}'.format(line_id), _bus_line_json(line_id),
+                         content_type='application/json', delay=0.05 * (8 - line_id))
+    cruzero_stub.add('/cruzero/lineasbuses/json_rutas?lbsId=5', 'not json')
+    cruzero_stub.add('/cruzero/lineasbuses', ''.join('mostrarLinea({}, 1)'.format(i) for i in range(1, 9)))
+
+    result = harvest_bus_lines(workers=8, per_host=3)
+
+    assert [line.line_id for line in result.lines] == [1, 2, 3, 4, 6, 7, 8]
+    assert result.lines[0].name == 'Linea 1'
+    assert len(result.lines[0].points) == 3
+
+    assert [f.line_id for f in result.failures] == [5]
+    assert isinstance(result.failures[0].error, DataNotAvailableException)
+
+    assert 1 < cruzero_stub.max_in_flight <= 3
+
+
+def test_get_all_bus_lines_raises_on_failure(cruzero_stub):
+    cruzero_stub.add('/cruzero/lineasbuses', 'mostrarLinea(1, 1)')
+
+    with pytest.raises(DataNotAvailableException):
+        get_all_bus_lines()
+
+
+def test_get_bus_line_coords(cruzero_stub):
+    cruzero_stub.add('/cruzero/lineasbuses/json_rutas?lbsId=7', _bus_line_json(7, points=4),
+                     content_type='application/json')
+
+    line = get_bus_line(7)
+
+    assert line.coords.dtype == np.float64
+    assert line.coords.shape == (4, 2)
+    assert line.coords[1].tolist() == [-63.181, -17.781]
+    assert line.speed == Decimal('20.5')
+
+    assert get_bus_line(7, dtype=np.float32).coords.dtype == np.float32
+
+
+def test_maintenance_pages_not_cached(cruzero_stub):
+    line_path = '/cruzero/lineasbuses/json_rutas?lbsId=7'
+    cruzero_stub.add(line_path, '<html>En mantenimiento</html>')
+    cruzero_stub.add('/cruzero/lineasbuses', '<html>En mantenimiento</html>')
+    cache = MemoryCache()
+
+    with pytest.raises(DataNotAvailableException):
+        get_bus_line(7, cache=cache)
+    assert get_all_bus_line_ids(cache=cache) == []
+
+    # Once the site is back, the next run gets the real answers instead of the cached maintenance pages
+    cruzero_stub.add(line_path, _bus_line_json(7), content_type='application/json')
+    cruzero_stub.add('/cruzero/lineasbuses', 'mostrarLinea(7, 1)')
+
+    assert get_bus_line(7, cache=cache).name == 'Linea 7'
+    assert get_all_bus_line_ids(cache=cache) == [7]
+    assert len(cruzero_stub.requests) == 4
+
+    # And those are cached
+    assert get_bus_line(7, cache=cache).name == 'Linea 7'
+    assert get_all_bus_line_ids(cache=cache) == [7]
+    assert len(cruzero_stub.requests) == 4
+
+
+def test_bus_line_points_view():
+    line = BusLine(3, 'L3', Decimal('20.5'), Decimal('12.3'), Decimal('45'),
+                   points=[LatLng(Decimal('-17.783452'), Decimal('-63.181234')), LatLng(Decimal('-17.79'), Decimal('-63.2'))])
+
+    assert line.coords.tolist() == [[-63.181234, -17.783452], [-63.2, -17.79]]
+    assert [(p.lat, p.lng) for p in line.points] == [(Decimal('-17.783452'), Decimal('-63.181234')),
+                                                     (Decimal('-17.79'), Decimal('-63.2'))]
+    assert not hasattr(line, '__dict__')
+
+    feature = line.__geo_interface__
+    assert feature['geometry']['coordinates'] == [[-63.181234, -17.783452], [-63.2, -17.79]]
+    assert feature['properties'] == {'line_id': 3, 'name': 'L3', 'speed': Decimal('20.5'),
+                                     'distance': Decimal('12.3'), 'total_time': Decimal('45')}
+
+
+def _sample_lines():
+    return [BusLine(line_id, 'Linea {}'.format(line_id), Decimal('20.5'), Decimal('12.3'), Decimal('45'),
+                    coords=np.array([[-63.181234, -17.783452], [-63.2, -17.79], [-63.21, -17.8001]]))
+            for line_id in (1, 2)]
+
+
+def test_write_geojson_matches_geojson_dumps():
+    lines = _sample_lines()
+
+    buf = io.StringIO()
+    write_geojson(lines, buf)
+
+    assert buf.getvalue() == geojson.dumps(geojson.FeatureCollection(lines), cls=GeoJSONEncoderWithDecimal)
+    assert bus_lines_to_geojson(lines) == buf.getvalue()
+
+
+def test_write_geojson_precision():
+    data = json.loads(bus_lines_to_geojson(_sample_lines(), precision=2))
+
+    assert data['features'][0]['geometry']['coordinates'] == [[-63.18, -17.78], [-63.2, -17.79], [-63.21, -17.8]]
+    assert data['features'][1]['properties']['total_time'] == 45.0
+
+
+def test_simplify_bus_lines():
+    line = BusLine(1, 'L1', Decimal('20'), Decimal('10'), Decimal('30'),
+                   coords=np.array([[-63.18, -17.78], [-63.17999, -17.77], [-63.18, -17.76], [-63.19, -17.75]]))
+
+    levels, stats = simplify_bus_lines([line], [1.0, 5000.0])
+
+    assert len(levels[1.0][0].coords) == 4
+    assert levels[5000.0][0].coords.tolist() == [[-63.18, -17.78], [-63.19, -17.75]]
+    assert levels[5000.0][0].name == 'L1'
+    assert stats.vertices == 4
+    assert stats.kept == {1.0: 4, 5000.0: 2}
+    assert stats.reduction(5000.0) == 0.5
+
+    data = json.loads(bus_lines_to_geojson([line], tolerance=5000.0))
+    assert len(data['features'][0]['geometry']['coordinates']) == 2
+
+
+def test_harvest_bus_lines_replay(cruzero_stub):
+    cruzero_stub.replay_cruzero()
+
+    result = harvest_bus_lines()
 
+    assert [line.line_id for line in result.lines] == [1, 2, 5, 9, 17]
+    assert result.lines[3].name == 'Linea 9 Plan 3000'
+    assert all(len(line.coords) == 40 for line in result.lines)
+    assert not result.failures
@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from opendatabo.aggregates import PriceAggregates
+from opendatabo.common import HostLimiter, make_session
+from opendatabo.daemon import Job, Scheduler, SingleFlight, StatusServer, current_year_job, market_prices_job, \
+    refresh_jobs
+from opendatabo.routes import RouteSnapshot
+from opendatabo.sic import City, Today, Year
+from opendatabo.store import PriceStore
+
+from conftest import MARKET_PRICES_CSV, sic_stub_path
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_single_flight():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def slow(x):
+        calls.append(x)
+        release.wait()
+        return x
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first, started = flights.submit('k', executor, slow, 1)
+        second, started_again = flights.submit('k', executor, slow, 2)
+
+        assert (started, started_again) == (True, False)
+        assert first is second
+        assert len(flights) == 1
+
+        release.set()
+        assert first.result() == 1
+
+        _wait_for(lambda: len(flights) == 0)
+        third, started = flights.submit('k', executor, slow, 3)
+        assert started and third.result() == 3
+
+    assert calls == [1, 3]
+
+
+def test_scheduler_runs_and_skips():
+    release = threading.Event()
+    quick_runs = []
+
+    def fail():
+        raise ValueError('nope')
+
+    with Scheduler(workers=2) as scheduler:
+        scheduler.add(Job('quick', 0.02, lambda: quick_runs.append(1)))
+        scheduler.add(Job('slow', 0.02, release.wait))
+        scheduler.add(Job('fail', 60, fail))
+        scheduler.start()
+
+        # The slow job stays in flight, so its later runs are skipped rather than queued
+        _wait_for(lambda: scheduler.status()['jobs']['slow']['skipped'] >= 2 and len(quick_runs) >= 3)
+
+        status = scheduler.status()
+        assert status['running'] == 1
+        assert status['queued'] == 0
+        assert status['jobs']['slow']['runs'] == 0
+        assert status['jobs']['quick']['last_latency'] is not None
+        assert status['jobs']['fail']['failures'] == 1
+        assert status['jobs']['fail']['last_error'] == "ValueError('nope')"
+
+        release.set()
+        _wait_for(lambda: scheduler.status()['jobs']['slow']['runs'] >= 1)
+
+    assert scheduler.status()['stopping']
+    with pytest.raises(RuntimeError):
+        scheduler.trigger('quick')
+
+
+def test_scheduler_stop_waits_for_running_jobs():
+    started = threading.Event()
+    finished = []
+
+    def job():
+        started.set()
+        time.sleep(0.2)
+        finished.append(1)
+
+    scheduler = Scheduler(workers=1)
+    scheduler.add(Job('job', 60, job))
+    scheduler.start()
+
+    started.wait(5)
+    scheduler.stop()
+
+    assert finished == [1]
+    assert scheduler.status()['running'] == 0
+
+
+def test_status_server():
+    with Scheduler() as scheduler:
+        scheduler.add(Job('job', 60, lambda: 42))
+        scheduler.trigger('job').result()
+
+        with StatusServer(scheduler) as server:
+            with urllib.request.urlopen(server.url) as r:
+                status = json.loads(r.read().decode('utf-8'))
+
+    assert status['jobs']['job']['runs'] == 1
+    assert status['jobs']['job']['last_result'] == '42'
+    assert status['queued'] == 0
+
+
+def test_market_prices_job(sic_stub):
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Today()), MARKET_PRICES_CSV)
+
+    aggregates = PriceAggregates(PriceStore())
+    job = market_prices_job(City.SANTA_CRUZ, Today(), 60, aggregates, make_session(), HostLimiter(1))
+
+    assert job.key == ('sic', City.SANTA_CRUZ, Today())
+    assert job.func() == 4
+    assert aggregates.store.count() == 4
+
+
+def test_current_year_job(sic_stub, monkeypatch):
+    aggregates = PriceAggregates(PriceStore())
+    job = current_year_job(City.SANTA_CRUZ, 60, aggregates, make_session(), HostLimiter(1))
+    year = Year.current()
+
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, year), MARKET_PRICES_CSV)
+    assert job.func() == 4
+    assert sic_stub.requests[-1][1] == sic_stub_path(City.SANTA_CRUZ, year)
+
+    # The year is worked out on each run, so the job moves on to the new year without being rebuilt
+    monkeypatch.setattr(Year, 'max_value', staticmethod(lambda: year.value + 1))
+    next_year = Year(year.value + 1)
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, next_year), MARKET_PRICES_CSV)
+    job.func()
+    assert sic_stub.requests[-1][1] == sic_stub_path(City.SANTA_CRUZ, next_year)
+
+
+def test_refresh_jobs(tmpdir):
+    aggregates = PriceAggregates(PriceStore())
+    jobs = refresh_jobs(aggregates, RouteSnapshot(str(tmpdir)), make_session(), cities=[City.SANTA_CRUZ])
+
+    assert [(job.name, job.interval) for job in jobs] == [
+        ('sic-sc-hoy', 15 * 60),
+        ('sic-sc-ano', 60 * 60),
+        ('cruzero-routes', 24 * 60 * 60),
+    ]
+    assert len(refresh_jobs(aggregates, None, make_session())) == 2 * len(list(City.all()))
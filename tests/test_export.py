@@ -0,0 +1,81 @@
+import gzip
+import io
+import os
+
+import pandas as pd
+import pytest
+import zstandard
+
+from opendatabo.export import make_filename, write_market_prices, load_market_prices, write_partitioned, \
+    load_partitioned
+from opendatabo.sic import prepare_raw_market_prices
+
+from conftest import MARKET_PRICES_CSV
+
+
+@pytest.fixture
+def prices():
+    raw_df = pd.read_csv(io.StringIO(MARKET_PRICES_CSV + MARKET_PRICES_CSV.split('\n', 1)[1].replace('/2008', '/2009')))
+    return prepare_raw_market_prices(raw_df)
+
+
+def test_make_filename():
+    assert make_filename('precios_sc_2010') == 'precios_sc_2010.csv'
+    assert make_filename('precios_sc_2010', 'csv', 'zstd') == 'precios_sc_2010.csv.zst'
+    assert make_filename('precios_sc_2010', 'parquet') == 'precios_sc_2010.parquet'
+
+    with pytest.raises(ValueError):
+        make_filename('precios_sc_2010', 'xls')
+
+
+@pytest.mark.parametrize('format', ['parquet', 'feather'])
+def test_columnar_round_trip(prices, tmpdir, format):
+    path = str(tmpdir.join(make_filename('prices', format)))
+    write_market_prices(prices, path, format=format)
+
+    df = load_market_prices(path)
+
+    assert df.index.names == ['fecha', 'producto', 'variedad']
+    assert df['procedencia'].dtype.name == 'category'
+    pd.testing.assert_frame_equal(df.astype({'procedencia': object}), prices)
+
+
+@pytest.mark.parametrize('compression,opener', [(None, open), ('gzip', gzip.open),
+                                                ('zstd', lambda p, m: zstandard.open(p, m))])
+def test_csv_compression(prices, tmpdir, compression, opener):
+    path = str(tmpdir.join(make_filename('prices', 'csv', compression)))
+    write_market_prices(prices, path, compression=compression)
+
+    with opener(path, 'rt') as f:
+        assert f.read() == prices.to_csv()
+
+
+def test_partitioned(prices, tmpdir):
+    root = str(tmpdir)
+    write_partitioned(prices, root, 'sc')
+
+    assert os.path.exists(os.path.join(root, 'city=sc', 'year=2009', 'part.parquet'))
+
+    df = load_partitioned(root, 'sc')
+    pd.testing.assert_frame_equal(df.astype({'procedencia': object}), prices)
+
+    assert load_partitioned(root, 'sc', years=[2009]).shape[0] == 4
+
+
+@pytest.mark.parametrize('format', ['parquet', 'feather'])
+def test_partitioned_years_written_separately(tmpdir, format):
+    root = str(tmpdir)
+    first = prepare_raw_market_prices(pd.read_csv(io.StringIO(MARKET_PRICES_CSV)))
+    # An unknown unit leaves the unit value missing, so the column is float in this year and int in the other
+    second = prepare_raw_market_prices(pd.read_csv(io.StringIO(
+        MARKET_PRICES_CSV.replace('/2008', '/2009').replace('4 Bs.-/Kilo', '') + '05/01/2009,Yuca,,3 Bs.-/Kilo,,,x\n')))
+    assert first['precio_minorista_unit_val'].dtype != second['precio_minorista_unit_val'].dtype
+
+    write_partitioned(first, root, 'sc', format=format)
+    write_partitioned(second, root, 'sc', format=format)
+
+    df = load_partitioned(root, 'sc')
+
+    assert df.shape[0] == 9
+    assert df['precio_minorista_unit_val'].dtype == 'float64'
+    assert df.loc[first.index, 'precio_minorista_unit_val'].tolist() == first['precio_minorista_unit_val'].tolist()
@@ -0,0 +1,49 @@
+import numpy as np
+
+from opendatabo.geometry import project, segment_distances, douglas_peucker_thresholds, simplify
+
+
+def _douglas_peucker(xy, tolerance):
+    if len(xy) < 3:
+        return list(range(len(xy)))
+
+    d = segment_distances(xy[1:-1], xy[0], xy[-1])
+    k = int(np.argmax(d)) + 1
+
+    if d[k - 1] <= tolerance:
+        return [0, len(xy) - 1]
+
+    left = _douglas_peucker(xy[:k + 1], tolerance)
+    right = _douglas_peucker(xy[k:], tolerance)
+    return left + [i + k for i in right[1:]]
+
+
+def test_project():
+    xy = project(np.array([[-63.18, -17.78], [-63.18, -17.77], [-63.17, -17.78]]))
+
+    assert xy[0].tolist() == [0.0, 0.0]
+    assert abs(xy[1, 1] - 1111.95) < 0.1
+    assert abs(xy[2, 0] - 1111.95 * np.cos(np.radians(17.78))) < 0.1
+
+
+def test_segment_distances():
+    d = segment_distances(np.array([[0.0, 1.0], [2.0, 0.0], [-3.0, 4.0]]), np.array([0.0, 0.0]), np.array([1.0, 0.0]))
+
+    assert d.tolist() == [1.0, 1.0, 5.0]
+
+
+def test_douglas_peucker_thresholds_match_recursive():
+    rng = np.random.RandomState(42)
+    xy = np.cumsum(rng.normal(size=(300, 2)) * 20, axis=0)
+
+    thresholds = douglas_peucker_thresholds(xy)
+
+    for tolerance in (0.5, 5.0, 20.0, 80.0):
+        assert np.flatnonzero(thresholds > tolerance).tolist() == _douglas_peucker(xy, tolerance)
+
+
+def test_simplify_keeps_end_points():
+    coords = np.array([[-63.18, -17.78], [-63.17999, -17.77], [-63.18, -17.76], [-63.18, -17.75]])
+
+    assert simplify(coords, 5.0).tolist() == [[-63.18, -17.78], [-63.18, -17.75]]
+    assert len(simplify(coords, 0.1)) == 4
@@ -0,0 +1,86 @@
+import io
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from opendatabo.merge import UnsortedPartitionError, merge_partitions
+from opendatabo.sic import City, Year, prepare_raw_market_prices, read_market_prices_csv
+from opendatabo.sync import PartitionStore
+
+from fixture_server import synthetic_market_prices_csv
+
+
+def _prepared(rows: int, year: int, seed: int) -> pd.DataFrame:
+    raw_df = pd.read_csv(io.StringIO(synthetic_market_prices_csv(rows, year=year, seed=seed)))
+    # Some rows without a variety, which sort after every other variety of their product
+    raw_df.loc[raw_df.index % 7 == 0, 'variedad'] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return prepare_raw_market_prices(raw_df)
+
+
+@pytest.fixture
+def store(tmpdir):
+    store = PartitionStore(str(tmpdir))
+
+    store.store(City.SANTA_CRUZ, Year(2009), _prepared(900, 2009, seed=1))
+
+    # The end of 2008 runs into the first days of 2009, with other prices
+    late = _prepared(900, 2008, seed=2)
+    late = late.assign(observaciones='tardio')
+    overlap = _prepared(60, 2009, seed=3)
+    store.store(City.SANTA_CRUZ, Year(2008), pd.concat([late, overlap]))
+
+    store.store(City.SANTA_CRUZ, Year(2010), _prepared(300, 2010, seed=4))
+    return store
+
+
+def test_write_city_matches_load_city(store):
+    buf = io.StringIO()
+
+    with pytest.warns(UserWarning):
+        stats = store.write_city(City.SANTA_CRUZ, buf, chunksize=97)
+
+    with pytest.warns(UserWarning):
+        expected = store.load_city(City.SANTA_CRUZ)
+
+    assert stats.duplicates > 0
+    assert stats.rows == expected.shape[0] == 900 + 900 + 300 + 60 - stats.duplicates
+
+    df = read_market_prices_csv(io.StringIO(buf.getvalue()))
+    pd.testing.assert_frame_equal(df, expected)
+
+    # The later year wins a key both have
+    assert not (df.loc[df.index.get_level_values('fecha') >= pd.Timestamp('2009-01-01').date(),
+                       'observaciones'] == 'tardio').any()
+
+
+def test_merge_partitions_columns(tmpdir):
+    first = str(tmpdir.join('2008.csv'))
+    second = str(tmpdir.join('2009.csv'))
+
+    with open(first, 'w') as f:
+        f.write('fecha,producto,variedad,mercado\n2008-01-02,Papa,Holandesa,Abasto\n2009-01-05,Papa,,Abasto\n')
+    with open(second, 'w') as f:
+        f.write('fecha,producto,variedad,procedencia\n2009-01-05,Papa,,"Valle, Alto"\n2009-01-05,Yuca,Blanca,\n')
+
+    buf = io.StringIO()
+    with pytest.warns(UserWarning):
+        stats = merge_partitions([first, second], buf, chunksize=1)
+
+    assert (stats.rows, stats.duplicates) == (3, 1)
+    assert buf.getvalue() == ('fecha,producto,variedad,mercado,procedencia\n'
+                              '2008-01-02,Papa,Holandesa,Abasto,\n'
+                              '2009-01-05,Papa,,,"Valle, Alto"\n'
+                              '2009-01-05,Yuca,Blanca,,\n')
+
+
+def test_merge_partitions_unsorted(tmpdir):
+    path = str(tmpdir.join('2008.csv'))
+    with open(path, 'w') as f:
+        f.write('fecha,producto,variedad\n2008-01-03,Papa,Holandesa\n2008-01-02,Papa,Holandesa\n')
+
+    with pytest.raises(UnsortedPartitionError):
+        merge_partitions([path], io.StringIO())
@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from opendatabo import metrics
+from opendatabo.metrics import Metrics
+from opendatabo.sic import City, Year, get_market_prices
+
+from conftest import MARKET_PRICES_CSV, sic_stub_path
+
+
+@pytest.fixture
+def recording():
+    m = metrics.enable()
+    yield m
+    metrics.disable()
+
+
+def test_disabled_is_noop():
+    metrics.disable()
+
+    with metrics.stage('x'):
+        metrics.incr('y')
+
+    assert metrics.current() is None
+
+
+def test_stage_and_counters(recording):
+    with metrics.stage('parse'):
+        metrics.incr('rows', 10)
+    with metrics.stage('parse'):
+        metrics.incr('rows', 5)
+
+    summary = recording.summary()
+
+    assert summary['stages']['parse']['calls'] == 2
+    assert summary['stages']['parse']['seconds'] >= 0
+    assert summary['counters'] == {'rows': 15}
+    assert json.loads(recording.to_json()) == summary
+
+
+def test_prometheus_format(tmpdir):
+    m = Metrics()
+    with m.stage('sic.request'):
+        pass
+    m.incr('sic.bytes', 123)
+
+    text = m.to_prometheus()
+
+    assert 'opendatabo_stage_calls_total{stage="sic.request"} 1' in text
+    assert 'opendatabo_sic_bytes_total 123' in text
+
+    path = str(tmpdir.join('run.prom'))
+    m.write_prometheus(path)
+    with open(path) as f:
+        assert f.read() == text
+
+
+def test_get_market_prices_instrumented(sic_stub, recording):
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2008)), MARKET_PRICES_CSV)
+
+    df = get_market_prices(City.SANTA_CRUZ, Year(2008))
+
+    summary = recording.summary()
+
+    assert {'sic.request', 'sic.parse', 'sic.prepare'} <= set(summary['stages'])
+    assert summary['counters']['sic.requests'] == 1
+    assert summary['counters']['sic.rows'] == df.shape[0]
+    assert summary['counters']['sic.bytes'] == len(MARKET_PRICES_CSV.encode('utf-8'))
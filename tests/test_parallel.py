@@ -0,0 +1,66 @@
+import io
+import warnings
+
+import pandas as pd
+import pytest
+
+from opendatabo.parallel import MarketPricesParser, split_csv
+from opendatabo.sic import City, Year, UnknownUnitError, get_market_prices, prepare_raw_market_prices
+
+from conftest import MARKET_PRICES_CSV, sic_stub_path
+from fixture_server import synthetic_market_prices_csv
+
+
+@pytest.fixture(scope='module')
+def parser():
+    with MarketPricesParser(processes=2, chunk_size=2000) as parser:
+        yield parser
+
+
+def test_split_csv():
+    payload = b'a,b\nw,2\n"x\ny",3\nz,5\n'
+
+    chunks = split_csv(payload, 1)
+
+    assert chunks == [b'a,b\nw,2\n', b'a,b\n"x\ny",3\n', b'a,b\nz,5\n']
+    assert split_csv(payload, 100) == [payload]
+
+    frames = [pd.read_csv(io.BytesIO(chunk)) for chunk in chunks]
+    pd.testing.assert_frame_equal(pd.concat(frames, ignore_index=True), pd.read_csv(io.BytesIO(payload)))
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_parse_many_matches_serial(compact):
+    payload = synthetic_market_prices_csv(500).encode('utf-8')
+    # The same rows again at the end, so duplicate keys span chunks
+    duplicated = payload + b''.join(payload.splitlines(keepends=True)[1:50])
+
+    with MarketPricesParser(processes=2, chunk_size=2000, compact=compact) as parser:
+        assert len(split_csv(duplicated, parser.chunk_size)) > 1
+
+        with pytest.warns(UserWarning):
+            frames = parser.parse_many([payload, duplicated, MARKET_PRICES_CSV.encode('utf-8')])
+
+    for data, df in zip([payload, duplicated, MARKET_PRICES_CSV.encode('utf-8')], frames):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            expected = prepare_raw_market_prices(pd.read_csv(io.BytesIO(data), encoding='utf-8'), compact=compact)
+
+        pd.testing.assert_frame_equal(df, expected)
+        assert list(df.dtypes) == list(expected.dtypes)
+
+
+def test_parse_unknown_unit(parser):
+    with pytest.raises(UnknownUnitError) as e:
+        parser.parse(b'fecha,producto,variedad,Precio Mayorista,Precio Minorista\n'
+                     b'02/01/2008,Papa,Holandesa,10 Bs.-/Barril,1 Bs.-/Kilo\n')
+
+    assert e.value.units == ['Barril']
+
+
+def test_get_market_prices_with_parser(sic_stub, parser):
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2008)), MARKET_PRICES_CSV)
+
+    df = get_market_prices(City.SANTA_CRUZ, Year(2008), parser=parser)
+
+    pd.testing.assert_frame_equal(df, get_market_prices(City.SANTA_CRUZ, Year(2008)))
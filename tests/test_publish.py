@@ -0,0 +1,61 @@
+import gzip
+import hashlib
+
+import pytest
+
+from opendatabo.publish import AmbiguousResourceError, Artifact, PublishResult, Publisher, make_ckan
+
+CSV = 'fecha,producto\n2008-01-02,Papa\n2008-01-03,Tomate\n'
+
+
+def test_artifact_render():
+    with Artifact.render(lambda fp: fp.write(CSV), 'sic.csv', 'csv') as artifact:
+        assert artifact.file.read() == CSV.encode('utf-8')
+        assert artifact.hash == hashlib.sha256(CSV.encode('utf-8')).hexdigest()
+        assert artifact.size == artifact.compressed_size == len(CSV)
+
+
+def test_artifact_render_compressed():
+    first = Artifact.render(lambda fp: fp.write(CSV), 'sic.csv', 'csv', compress=True)
+    second = Artifact.render(lambda fp: fp.write(CSV), 'sic.csv', 'csv', compress=True)
+
+    with first, second:
+        assert first.filename == 'sic.csv.gz'
+        assert first.hash == hashlib.sha256(CSV.encode('utf-8')).hexdigest()
+
+        content = first.file.read()
+        assert gzip.decompress(content) == CSV.encode('utf-8')
+        assert content == second.file.read()
+
+
+def test_publisher_skips_unchanged(ckan_stub):
+    publisher = Publisher(make_ckan(ckan_stub.url), 'sic')
+
+    with Artifact.render(lambda fp: fp.write(CSV), 'sic.csv', 'csv') as artifact:
+        assert publisher.publish('SIC SANTA_CRUZ', artifact).action == PublishResult.CREATED
+        assert publisher.publish('SIC CAMIRI', artifact).action == PublishResult.CREATED
+        assert publisher.publish('SIC SANTA_CRUZ', artifact).action == PublishResult.UNCHANGED
+        assert publisher.publish('SIC SANTA_CRUZ', artifact, force=True).action == PublishResult.UPDATED
+
+    assert ckan_stub.uploads['res-1'] == ('sic.csv', CSV.encode('utf-8'))
+
+    with Artifact.render(lambda fp: fp.write(CSV + '2008-01-04,Yuca\n'), 'sic.csv', 'csv') as artifact:
+        assert publisher.publish('SIC SANTA_CRUZ', artifact).action == PublishResult.UPDATED
+
+    # The package is read once and every call goes through the same kept-alive connection
+    assert ckan_stub.calls.count('package_show') == 1
+    assert len(ckan_stub.connections) == 1
+
+    # A new run sees the hashes stored on the resources
+    publisher = Publisher(make_ckan(ckan_stub.url), 'sic')
+    with Artifact.render(lambda fp: fp.write(CSV), 'sic.csv', 'csv') as artifact:
+        assert publisher.publish('SIC CAMIRI', artifact).action == PublishResult.UNCHANGED
+
+
+def test_publisher_ambiguous_resource(ckan_stub):
+    ckan_stub.resources = [{'id': 'a', 'name': 'SIC'}, {'id': 'b', 'name': 'SIC'}]
+    publisher = Publisher(make_ckan(ckan_stub.url), 'sic')
+
+    with Artifact.render(lambda fp: fp.write(CSV), 'sic.csv', 'csv') as artifact:
+        with pytest.raises(AmbiguousResourceError):
+            publisher.publish('SIC', artifact)
@@ -0,0 +1,97 @@
+from decimal import Decimal
+
+import numpy as np
+
+from opendatabo.cruzero import BusLine
+from opendatabo.routes import RouteSnapshot, diff_fingerprints
+
+from fixture_server import synthetic_bus_line_json
+
+
+def route_path(line_id: int) -> str:
+    return '/cruzero/lineasbuses/json_rutas?lbsId={}'.format(line_id)
+
+
+def serve_lines(stub, line_ids, seed: int = 0):
+    stub.add('/cruzero/lineasbuses', ''.join('mostrarLinea({}, 1)'.format(i) for i in line_ids))
+    for line_id in line_ids:
+        stub.add(route_path(line_id), synthetic_bus_line_json(line_id, points=20, seed=seed),
+                 content_type='application/json', etag='"{}-{}"'.format(line_id, seed))
+
+
+def test_fingerprint():
+    line = BusLine(1, 'Linea 1', Decimal('18.5'), Decimal('21.3'), Decimal('75'),
+                   coords=np.array([[-63.18, -17.78], [-63.19, -17.79]]))
+
+    assert line.fingerprint() == line.with_coords(line.coords + 1e-9).fingerprint()
+    assert line.fingerprint() != line.with_coords(line.coords + 1e-6).fingerprint()
+    assert line.fingerprint() != BusLine(1, 'Linea 1', Decimal('18.6'), Decimal('21.3'), Decimal('75'),
+                                         coords=line.coords).fingerprint()
+
+
+def test_diff_fingerprints():
+    diff = diff_fingerprints({1: 'a', 2: 'b', 3: 'c'}, {2: 'b', 3: 'x', 4: 'd'})
+
+    assert (diff.added, diff.removed, diff.modified, diff.unchanged) == ([4], [1], [3], [2])
+    assert diff.changed
+    assert not diff_fingerprints({1: 'a'}, {1: 'a'}).changed
+
+
+def test_snapshot_sync(cruzero_stub, tmpdir):
+    root = str(tmpdir)
+    serve_lines(cruzero_stub, [1, 2, 3])
+
+    result = RouteSnapshot(root).sync(workers=3)
+    assert result.diff.added == [1, 2, 3] and result.not_modified == 0
+
+    # Nothing changed upstream: every route is answered with 304 and loaded from the snapshot
+    before = len(cruzero_stub.requests)
+    snapshot = RouteSnapshot(root)
+    result = snapshot.sync(workers=3)
+
+    assert not result.diff.changed
+    assert result.not_modified == 3
+    assert [line.line_id for line in result.lines] == [1, 2, 3]
+    assert result.lines[0].fingerprint() == snapshot.fingerprints()[1]
+    assert len(cruzero_stub.requests) - before == 4
+
+    # Line 2 changes, line 3 disappears and line 4 shows up
+    cruzero_stub.add(route_path(2), synthetic_bus_line_json(2, points=20, seed=1),
+                     content_type='application/json', etag='"2-1"')
+    serve_lines(cruzero_stub, [4])
+    cruzero_stub.add('/cruzero/lineasbuses', 'mostrarLinea(1, 1) mostrarLinea(2, 1) mostrarLinea(4, 1)')
+
+    result = RouteSnapshot(root).sync(workers=3)
+
+    assert (result.diff.added, result.diff.removed, result.diff.modified) == ([4], [3], [2])
+    assert [(c['change'], c['line_id']) for c in RouteSnapshot(root).changes()[3:]] == \
+        [('added', 4), ('modified', 2), ('removed', 3)]
+    assert sorted(tmpdir.join('lines').listdir()) == [tmpdir.join('lines', '{}.json'.format(i)) for i in (1, 2, 4)]
+
+
+def test_snapshot_sync_keeps_failed_lines(cruzero_stub, tmpdir):
+    serve_lines(cruzero_stub, [1, 2])
+    RouteSnapshot(str(tmpdir)).sync()
+
+    cruzero_stub.add(route_path(2), 'Internal Server Error', status=500)
+    result = RouteSnapshot(str(tmpdir)).sync()
+
+    assert [f.line_id for f in result.failures] == [2]
+    assert [line.line_id for line in result.lines] == [1, 2]
+    assert not result.diff.changed
+
+
+def test_snapshot_fetch_waits_for_commit(cruzero_stub, tmpdir):
+    root = str(tmpdir)
+    serve_lines(cruzero_stub, [1, 2])
+
+    snapshot = RouteSnapshot(root)
+    result = snapshot.fetch()
+
+    # Nothing is written until the result is committed, so the next run still sees the changes
+    assert result.diff.added == [1, 2]
+    assert RouteSnapshot(root).fingerprints() == {}
+    assert RouteSnapshot(root).fetch().diff.added == [1, 2]
+
+    assert snapshot.commit(result).added == [1, 2]
+    assert not RouteSnapshot(root).fetch().diff.changed
@@ -0,0 +1,104 @@
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+from opendatabo.cruzero import BusLine
+from opendatabo.routing import TransferGraph, seconds_per_meter, _transfers
+
+
+def _line(line_id, coords, speed='20', distance='10', total_time='30'):
+    return BusLine(line_id, 'L{}'.format(line_id), Decimal(speed), Decimal(distance), Decimal(total_time),
+                   coords=np.array(coords, dtype=np.float64))
+
+
+@pytest.fixture
+def lines():
+    # An east-west line and a north-south one crossing it, and a third line far away
+    return [
+        _line(1, [(-63.20, -17.78), (-63.15, -17.78)]),
+        _line(2, [(-63.17, -17.76), (-63.17, -17.80)]),
+        _line(3, [(-63.00, -17.60), (-63.00, -17.55)]),
+    ]
+
+
+def test_seconds_per_meter():
+    assert seconds_per_meter(_line(1, [], total_time='30', distance='10')) == pytest.approx(0.18)
+    assert seconds_per_meter(_line(1, [], total_time='0', distance='10', speed='36')) == pytest.approx(0.1)
+    assert seconds_per_meter(_line(1, [], total_time='0', distance='0', speed='0')) == pytest.approx(0.24)
+
+
+def test_plan_transfers(lines):
+    graph = TransferGraph.build(lines, stop_spacing=100.0)
+
+    journey = graph.plan(-17.7801, -63.199, -17.799, -63.1701)
+
+    assert journey.line_ids == [1, 2]
+    # Stops of different lines never quite coincide, so changing lines takes a short walk
+    assert [leg.mode for leg in journey.legs] == ['walk', 'wait', 'bus', 'walk', 'wait', 'bus', 'walk']
+    assert journey.legs[3].seconds < 100
+    assert journey.seconds == pytest.approx(sum(leg.seconds for leg in journey.legs))
+    assert journey.legs[0].start == (-17.7801, -63.199)
+    assert journey.legs[-1].end == (-17.799, -63.1701)
+
+    # Riding line 1 about 3 km at 0.18 s/m, then line 2 about 2 km
+    ride = sum(leg.seconds for leg in journey.legs if leg.mode == 'bus')
+    assert 0.18 * 4900 < ride < 0.18 * 5400
+
+
+def test_plan_walks_when_faster(lines):
+    graph = TransferGraph.build(lines)
+
+    journey = graph.plan(-17.78, -63.20, -17.78, -63.199)
+
+    assert [leg.mode for leg in journey.legs] == ['walk']
+    assert journey.line_ids == []
+
+
+def test_plan_many_matches_plan(lines, tmpdir):
+    graph = TransferGraph.build(lines, stop_spacing=150.0)
+
+    rng = np.random.RandomState(3)
+    origins = [(-17.78 + dy, -63.19 + dx) for dx, dy in rng.uniform(-0.01, 0.01, size=(5, 2))]
+    destinations = [(-17.77 + dy, -63.17 + dx) for dx, dy in rng.uniform(-0.01, 0.01, size=(12, 2))]
+    pairs = [(o, d) for o in origins for d in destinations]
+
+    journeys = graph.plan_many([o for o, _ in pairs], [d for _, d in pairs])
+
+    path = str(tmpdir.join('graph.npz'))
+    graph.save(path)
+    loaded = TransferGraph.load(path)
+
+    assert loaded.params == graph.params
+    assert loaded.n_edges == graph.n_edges
+
+    for (o, d), journey in zip(pairs, journeys):
+        single = loaded.plan(o[0], o[1], d[0], d[1])
+        assert journey.seconds == pytest.approx(single.seconds)
+        assert journey.line_ids == single.line_ids
+
+
+def test_transfers_keep_the_nearest_stop_of_each_line():
+    # Stop 0 (line 0) has two stops of line 1 and one of line 2 within reach
+    xy = np.array([[0.0, 0.0], [30.0, 0.0], [10.0, 0.0], [0.0, 20.0], [500.0, 0.0]])
+    line = np.array([0, 1, 1, 2, 2])
+
+    a, b, d = _transfers(xy, line, 3, 50.0, block=2)
+    pairs = {(int(i), int(line[j])): (int(j), float(x)) for i, j, x in zip(a, b, d)}
+
+    assert len(pairs) == len(a)
+    assert pairs[0, 1] == (2, 10.0)
+    assert pairs[0, 2] == (3, 20.0)
+    assert (4, 0) not in pairs
+
+
+def test_save_load_without_suffix(lines, tmpdir):
+    graph = TransferGraph.build(lines, stop_spacing=150.0)
+
+    path = str(tmpdir.join('graph'))
+    graph.save(path)
+    loaded = TransferGraph.load(path)
+
+    assert loaded.n_edges == graph.n_edges
+    assert loaded.plan(-17.7801, -63.199, -17.799, -63.1701).seconds == \
+        pytest.approx(graph.plan(-17.7801, -63.199, -17.799, -63.1701).seconds)
@@ -1,13 +1,26 @@
+import io
+import os
+from urllib.parse import urlsplit
+
 import numpy as np
 import pandas as pd
 import pytest
+import requests
+
+from opendatabo.cache import MemoryCache
+from opendatabo.sic import get_market_prices, make_market_prices_url, City, Today, Year, parse_column_units, \
+    fetch_market_prices, iter_market_prices, RemoteErrorException, _FatalErrorGuard, UnknownUnitError, \
+    normalize_unit_prices, prepare_raw_market_prices, make_retry_policy
+from opendatabo.common import CircuitOpenError, DataNotAvailableException, HostLimiter
 
-from opendatabo.sic import get_market_prices, make_market_prices_url, City, Today, Year, parse_column_units
-from opendatabo.common import DataNotAvailableException
+from conftest import MARKET_PRICES_CSV, sic_stub_path
+from fixture_server import FIXTURES_DIR
 
 EXPECTED_COLS = {'procedencia', 'observaciones',
                  'precio_mayorista_val', 'precio_mayorista_unit_val', 'precio_mayorista_unit_name',
                  'precio_minorista_val', 'precio_minorista_unit_val', 'precio_minorista_unit_name',
+                 'precio_mayorista_per_kg', 'precio_mayorista_per_unit',
+                 'precio_minorista_per_kg', 'precio_minorista_per_unit',
                  }
 
 
@@ -19,11 +32,12 @@ def test_make_market_prices_url():
            == 'http://www.sicsantacruz.com/sic/sic2014/pref_sc_2010_ano_export.php'
 
 
-def test_get_scz_2008():
+def test_get_scz_2008(sic_stub):
+    sic_stub.replay_sic()
     df = get_market_prices(City.SANTA_CRUZ, Year(2008))
 
     assert set(df.columns).issuperset(EXPECTED_COLS)
-    assert df.shape[0] == 481
+    assert df.shape[0] == 120
 
 
 @pytest.mark.skip(reason='Fails on weekends and holidays :/')
@@ -33,19 +47,26 @@ def test_get_scz_today():
     assert set(df.columns).issuperset(EXPECTED_COLS)
 
 
-def test_get_scz_2008_limit_42():
+def test_get_scz_2008_limit_42(sic_stub):
+    sic_stub.replay_sic()
     df = get_market_prices(City.SANTA_CRUZ, Year(2008), limit=42)
 
     assert set(df.columns).issuperset(EXPECTED_COLS)
     assert df.shape[0] == 42
 
 
-def test_get_scz_2015():
+def test_get_scz_2015(sic_stub):
+    # The site redirects away from the years it has no export of
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2015)), '', status=302)
+
     with pytest.raises(DataNotAvailableException):
         get_market_prices(City.SANTA_CRUZ, Year(2015))
 
 
-def test_market_uniform_columns():
+def test_market_uniform_columns(sic_stub):
+    sic_stub.replay_sic()
+    checked = 0
+
     for city in City.all():
         for year in Year.all_valid():
             try:
@@ -55,6 +76,10 @@ def test_market_uniform_columns():
 
             assert df.index.names == ['fecha', 'producto', 'variedad']
             assert set(df.columns).issuperset(EXPECTED_COLS)
+            checked += 1
+
+    # Every recorded export, whatever columns it came with
+    assert checked == 2
 
 
 def test_parse_column_units():
@@ -65,6 +90,63 @@ def test_parse_column_units():
     assert u_k.fillna('').tolist() == ['unit', '', '']
 
 
+def test_parse_column_units_many():
+    x, u_v, u_k = parse_column_units(pd.Series(['100 Bs.-/qq', '25 Bs.-/100 U.', '3 Bs.-/Bolsa (2@)', '7 Bs.-/qq']))
+
+    assert x.tolist() == [100, 25, 3, 7]
+    assert u_v.tolist() == [112, 100, 50, 112]
+    assert u_k.tolist() == ['lb', 'unit', 'lb', 'lb']
+
+
+def test_parse_column_units_unknown():
+    with pytest.raises(UnknownUnitError) as e:
+        parse_column_units(pd.Series(['1 Bs.-/Unidad', '2 Bs.-/Cajita', '3 Bs.-/Balde', '4 Bs.-/Cajita']))
+
+    assert e.value.units == ['Balde', 'Cajita']
+
+
+def test_normalize_unit_prices():
+    per_kg, per_unit = normalize_unit_prices(*parse_column_units(
+        pd.Series(['18 Bs.-/Caja de 18 Kg', '100 Bs.-/Libra', '24 Bs.-/Docena', '5 Bs.-/Amarro', np.nan])))
+
+    assert per_kg.round(4).fillna(-1).tolist() == [1.0, round(100 / 0.45359237, 4), -1, -1, -1]
+    assert per_unit.fillna(-1).tolist() == [-1, -1, 2.0, -1, -1]
+
+
+def assert_compact_equivalent(raw_df: pd.DataFrame):
+    expected = prepare_raw_market_prices(raw_df)
+    compact = prepare_raw_market_prices(raw_df, compact=True)
+
+    assert compact['procedencia'].dtype.name == 'category'
+    assert compact.index.levels[0].dtype.kind == 'M'
+
+    # Back to plain objects and dates, the compact frame holds exactly the same data
+    restored = compact.reset_index()
+    restored['fecha'] = restored['fecha'].dt.date
+    for col in restored.columns:
+        if restored[col].dtype.name == 'category':
+            restored[col] = restored[col].astype(object)
+    restored.set_index(['fecha', 'producto', 'variedad'], inplace=True)
+
+    pd.testing.assert_frame_equal(restored, expected)
+
+
+def test_prepare_compact_equivalent():
+    assert_compact_equivalent(pd.read_csv(io.StringIO(MARKET_PRICES_CSV)))
+    assert_compact_equivalent(pd.read_csv(os.path.join(FIXTURES_DIR, 'sic', 'pref_cbba_2010_ano_export.csv')))
+
+
+def test_prepare_compact_duplicates():
+    raw_df = pd.read_csv(io.StringIO(MARKET_PRICES_CSV + '03/01/2008,Papa,Holandesa,110 Bs.-/qq,3 Bs.-/Libra,Beni,\n'))
+
+    with pytest.warns(UserWarning):
+        assert_compact_equivalent(raw_df)
+
+    compact = prepare_raw_market_prices(raw_df, compact=True)
+    assert compact.shape[0] == 4
+    assert compact['precio_mayorista_val'].tolist()[-1] == 110
+
+
 @pytest.mark.skip(reason='takes too long')
 def test_market_units():
     all_units = set()
@@ -91,3 +173,171 @@ def test_market_units():
                     pass
 
     pd.DataFrame({'unit': list(all_units)}).to_csv('units.csv')
+
+
+def test_fetch_market_prices_streams_outcomes(sic_stub):
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2008)), MARKET_PRICES_CSV, delay=0.5)
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2009)), MARKET_PRICES_CSV)
+    sic_stub.add(sic_stub_path(City.CAMIRI, Year(2008)), '', status=302)
+
+    jobs = [(City.SANTA_CRUZ, Year(2008)), (City.SANTA_CRUZ, Year(2009)), (City.CAMIRI, Year(2008))]
+
+    outcomes = list(fetch_market_prices(jobs, workers=3, per_host=3))
+
+    assert [(o.city, o.timeframe.value) for o in outcomes][-1] == (City.SANTA_CRUZ, 2008)
+
+    by_job = {(o.city, o.timeframe.value): o for o in outcomes}
+
+    assert by_job[City.SANTA_CRUZ, 2009].ok
+    assert by_job[City.SANTA_CRUZ, 2009].df.shape[0] == 4
+    assert set(by_job[City.SANTA_CRUZ, 2009].df.columns).issuperset(EXPECTED_COLS)
+
+    assert not by_job[City.CAMIRI, 2008].ok
+    assert isinstance(by_job[City.CAMIRI, 2008].error, DataNotAvailableException)
+
+
+def test_timeframe_cache_ttl():
+    assert Year(Year.MIN_VALUE).cache_ttl() is None
+    assert Year.current().cache_ttl() == Year.CURRENT_CACHE_TTL
+    assert Today().cache_ttl() == Today.CACHE_TTL
+
+
+def test_get_market_prices_cached(sic_stub):
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2008)), MARKET_PRICES_CSV)
+    cache = MemoryCache()
+
+    first = get_market_prices(City.SANTA_CRUZ, Year(2008), cache=cache)
+    second = get_market_prices(City.SANTA_CRUZ, Year(2008), cache=cache, limit=2)
+
+    assert len(sic_stub.requests) == 1
+    assert first.shape[0] == 4
+    assert second.shape[0] == 2
+
+
+def test_fatal_error_guard_across_chunks():
+    guard = _FatalErrorGuard(io.BytesIO(b'a,b\n1,2\n<b>Fatal error</b>: out of memory'))
+
+    assert guard.read(14) == b'a,b\n1,2\n<b>Fat'
+    with pytest.raises(RemoteErrorException):
+        guard.read(14)
+
+
+def test_get_market_prices_streaming_limit(sic_stub):
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2008)), MARKET_PRICES_CSV)
+
+    raw_df = get_market_prices(City.SANTA_CRUZ, Year(2008), limit=3, raw=True)
+
+    assert raw_df.shape[0] == 3
+    assert raw_df['producto'].tolist() == ['Papa', 'Tomate', 'Papa']
+
+
+def test_iter_market_prices(sic_stub):
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2008)), MARKET_PRICES_CSV)
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2009)),
+                 MARKET_PRICES_CSV * 2000 + '<br /><b>Fatal error</b>: Allowed memory size exhausted')
+
+    chunks = list(iter_market_prices(City.SANTA_CRUZ, Year(2008), chunksize=3))
+
+    assert [chunk.shape[0] for chunk in chunks] == [3, 1]
+    assert set(chunks[0].columns).issuperset(EXPECTED_COLS)
+
+    with pytest.raises(RemoteErrorException):
+        for _ in iter_market_prices(City.SANTA_CRUZ, Year(2009), chunksize=3, raw=True):
+            pass
+
+
+def test_get_scz_2008_replay(sic_stub):
+    sic_stub.replay_sic()
+
+    with pytest.warns(UserWarning):
+        df = get_market_prices(City.SANTA_CRUZ, Year(2008))
+
+    assert set(df.columns).issuperset(EXPECTED_COLS)
+    assert df.shape[0] == 120
+
+    df = get_market_prices(City.COCHABAMBA, Year(2010))
+    assert 'mercado' in df.columns
+
+
+def test_get_market_prices_replay_errors(sic_stub, monkeypatch):
+    monkeypatch.setattr('opendatabo.common.time.sleep', lambda t: None)
+
+    sic_stub.add_fixture(sic_stub_path(City.SANTA_CRUZ, Year(2015)), 'sic/fatal_error.html')
+    sic_stub.add(sic_stub_path(City.CAMIRI, Year(2015)), 'Internal Server Error', status=500)
+
+    with pytest.raises(RemoteErrorException):
+        get_market_prices(City.SANTA_CRUZ, Year(2015))
+    assert len(sic_stub.requests) == 6
+
+    with pytest.raises(DataNotAvailableException):
+        get_market_prices(City.CAMIRI, Year(2015))
+
+
+def test_get_market_prices_fatal_error_not_cached(sic_stub, monkeypatch):
+    monkeypatch.setattr('opendatabo.common.time.sleep', lambda t: None)
+    path = sic_stub_path(City.SANTA_CRUZ, Year(2008))
+    sic_stub.add_fixture(path, 'sic/fatal_error.html')
+    cache = MemoryCache()
+
+    with pytest.raises(RemoteErrorException):
+        get_market_prices(City.SANTA_CRUZ, Year(2008), cache=cache)
+    # Every attempt reached the site, none of them read the error back from the cache
+    assert len(sic_stub.requests) == 6
+
+    sic_stub.add(path, MARKET_PRICES_CSV)
+    assert get_market_prices(City.SANTA_CRUZ, Year(2008), cache=cache).shape[0] == 4
+
+
+def test_fatal_errors_do_not_open_the_circuit(sic_stub, monkeypatch):
+    monkeypatch.setattr('opendatabo.common.time.sleep', lambda t: None)
+    policy = make_retry_policy()
+
+    sic_stub.add_fixture(sic_stub_path(City.SANTA_CRUZ, Year(2015)), 'sic/fatal_error.html')
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2008)), MARKET_PRICES_CSV)
+
+    for _ in range(3):
+        with pytest.raises(RemoteErrorException):
+            get_market_prices(City.SANTA_CRUZ, Year(2015), retry_policy=policy)
+
+    # 18 failed exports of one year, and the other years still download
+    assert get_market_prices(City.SANTA_CRUZ, Year(2008), retry_policy=policy).shape[0] == 4
+
+    sic_stub.add(sic_stub_path(City.CAMIRI, Year(2015)), 'Internal Server Error', status=500)
+    for _ in range(10):
+        with pytest.raises(DataNotAvailableException):
+            get_market_prices(City.CAMIRI, Year(2015), retry_policy=policy)
+
+    with pytest.raises(CircuitOpenError):
+        get_market_prices(City.SANTA_CRUZ, Year(2008), retry_policy=policy)
+
+
+def test_fetch_market_prices_timeout(sic_stub):
+    sic_stub.replay_sic()
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2009)), MARKET_PRICES_CSV, delay=2.0)
+
+    outcomes = list(fetch_market_prices([(City.SANTA_CRUZ, Year(2009)), (City.COCHABAMBA, Year(2010))],
+                                        timeout=0.5))
+
+    assert [o.ok for o in outcomes] == [True, False]
+    assert isinstance(outcomes[1].error, requests.Timeout)
+
+
+def test_retries_release_the_host_slot(sic_stub, monkeypatch):
+    limiter = HostLimiter(1)
+    slot = limiter._semaphore(urlsplit(sic_stub.url).netloc)
+    free_while_waiting = []
+
+    def sleep(seconds):
+        # Another request could take the only slot while this one waits to retry
+        free = slot.acquire(blocking=False)
+        free_while_waiting.append(free)
+        if free:
+            slot.release()
+
+    monkeypatch.setattr('opendatabo.common.time.sleep', sleep)
+    sic_stub.add_fixture(sic_stub_path(City.SANTA_CRUZ, Year(2015)), 'sic/fatal_error.html')
+
+    with pytest.raises(RemoteErrorException):
+        get_market_prices(City.SANTA_CRUZ, Year(2015), limiter=limiter)
+
+    assert free_while_waiting and all(free_while_waiting)
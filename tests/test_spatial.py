@@ -0,0 +1,98 @@
+import os
+from decimal import Decimal
+
+import numpy as np
+
+from opendatabo.cruzero import BusLine
+from opendatabo.geometry import project, segment_distances
+from opendatabo.spatial import RouteIndex, pairs_within
+
+
+def _line(line_id, coords):
+    return BusLine(line_id, 'L{}'.format(line_id), Decimal('20'), Decimal('10'), Decimal('30'),
+                   coords=np.array(coords, dtype=np.float64))
+
+
+def _random_lines(n=30, points=50, seed=1):
+    rng = np.random.RandomState(seed)
+    lines = []
+    for i in range(n):
+        start = np.array([-63.18, -17.78]) + rng.uniform(-0.05, 0.05, size=2)
+        lines.append(_line(i + 1, start + np.cumsum(rng.normal(scale=0.001, size=(points, 2)), axis=0)))
+    return lines
+
+
+def _brute_force(lines, origin, lat, lng, radius):
+    p = project(np.array([[lng, lat]]), origin)
+    result = []
+    for line in lines:
+        xy = project(line.coords, origin)
+        d = segment_distances(p, xy[:-1], xy[1:]).min()
+        if d <= radius:
+            result.append((line.line_id, d))
+    return sorted(result, key=lambda r: r[1])
+
+
+def test_query_radius_matches_brute_force():
+    lines = _random_lines()
+    index = RouteIndex.build(lines, cell_size=200.0)
+
+    rng = np.random.RandomState(2)
+    lats = -17.78 + rng.uniform(-0.06, 0.06, size=40)
+    lngs = -63.18 + rng.uniform(-0.06, 0.06, size=40)
+
+    batched = index.query_radius_many(lats, lngs, 300.0)
+
+    for lat, lng, found in zip(lats, lngs, batched):
+        expected = _brute_force(lines, index.origin, lat, lng, 300.0)
+        assert [l for l, _ in found] == [l for l, _ in expected]
+        assert np.allclose([d for _, d in found], [d for _, d in expected])
+
+
+def test_lines_in_bbox_and_nearest():
+    lines = [_line(1, [[-63.20, -17.80], [-63.10, -17.80]]),
+             _line(2, [[-63.20, -17.70], [-63.10, -17.70]]),
+             _line(3, [[-63.15, -17.90], [-63.15, -17.85]])]
+    index = RouteIndex.build(lines, cell_size=500.0)
+
+    # The box lies between the end points of line 1, which only crosses it
+    assert index.lines_in_bbox(-17.81, -63.16, -17.79, -63.14) == [1]
+    assert index.lines_in_bbox(-17.95, -63.30, -17.60, -63.00) == [1, 2, 3]
+    assert index.lines_in_bbox(-17.60, -63.30, -17.50, -63.00) == []
+
+    assert index.lines_near(-17.801, -63.15, 200.0) == [1]
+
+    line_id, distance = index.nearest_line(-17.74, -63.15)
+    assert line_id == 2
+    assert abs(distance - 4447.8) < 5
+
+    assert index.nearest_line(-17.74, -63.15, max_radius=1000.0) is None
+
+
+def test_save_load(tmpdir):
+    lines = _random_lines(n=5)
+    index = RouteIndex.build(lines)
+
+    # Saved exactly where asked, with or without the .npz suffix
+    for name in ('index.npz', 'index'):
+        path = str(tmpdir.join(name))
+        index.save(path)
+        loaded = RouteIndex.load(path)
+
+        assert loaded.query_radius(-17.78, -63.18, 2000.0) == index.query_radius(-17.78, -63.18, 2000.0)
+
+    assert sorted(os.listdir(str(tmpdir))) == ['index', 'index.npz']
+
+
+def test_pairs_within_matches_brute_force():
+    rng = np.random.RandomState(4)
+    a = rng.uniform(-2000, 2000, size=(200, 2))
+    b = rng.uniform(-2000, 2000, size=(300, 2))
+
+    i, j, d = pairs_within(a, b, 150.0)
+
+    distances = np.hypot(*(a[:, None, :] - b[None, :, :]).transpose(2, 0, 1))
+    expected = set(zip(*np.nonzero(distances <= 150.0)))
+
+    assert set(zip(i.tolist(), j.tolist())) == expected
+    assert np.allclose(d, distances[i, j])
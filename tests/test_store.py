@@ -0,0 +1,85 @@
+import datetime
+import io
+
+import pandas as pd
+
+from opendatabo.sic import City, prepare_raw_market_prices
+from opendatabo.aggregates import PriceAggregates
+from opendatabo.store import PriceStore
+
+from conftest import MARKET_PRICES_CSV
+
+
+def prepared(csv: str = MARKET_PRICES_CSV) -> pd.DataFrame:
+    return prepare_raw_market_prices(pd.read_csv(io.StringIO(csv)))
+
+
+def test_upsert_and_history(tmpdir):
+    path = str(tmpdir.join('prices.db'))
+
+    with PriceStore(path) as store:
+        assert store.upsert(City.SANTA_CRUZ, prepared()) == 4
+        assert store.upsert(City.CAMIRI, prepared()) == 4
+
+    with PriceStore(path) as store:
+        assert store.count() == 8
+        assert store.cities() == [City.SANTA_CRUZ, City.CAMIRI]
+
+        history = store.price_history('Papa', 'Holandesa')
+        assert history.index.names == ['city', 'fecha', 'producto', 'variedad']
+        assert list(history.index.get_level_values('city')) == ['cam', 'cam', 'sc', 'sc']
+        assert list(history['precio_mayorista_val']) == [100, 105, 100, 105]
+
+        history = store.price_history('Papa', cities=[City.SANTA_CRUZ], start=datetime.date(2008, 1, 3))
+        assert history.shape[0] == 1
+        assert history.index[0] == ('sc', datetime.date(2008, 1, 3), 'Papa', 'Holandesa')
+
+        row = store.price_history('Huevo', cities=[City.SANTA_CRUZ]).iloc[0]
+        assert row['observaciones'] == 'sin stock'
+        assert row['precio_minorista_per_unit'] == 1.0
+        assert pd.isnull(row['precio_minorista_per_kg'])
+        assert pd.isnull(row['mercado'])
+
+
+def test_upsert_replaces_rows():
+    store = PriceStore()
+    store.upsert(City.SANTA_CRUZ, prepared())
+
+    updated = MARKET_PRICES_CSV.replace('105 Bs.-/qq', '110 Bs.-/qq')
+    store.upsert(City.SANTA_CRUZ, prepared(updated))
+
+    assert store.count() == 4
+    assert list(store.price_history('Papa')['precio_mayorista_val']) == [100, 110]
+
+
+def test_latest_prices():
+    store = PriceStore()
+    store.upsert(City.SANTA_CRUZ, prepared())
+
+    latest = store.latest_prices()
+
+    assert list(latest.index) == [('sc', datetime.date(2008, 1, 3), 'Huevo', 'Blanco'),
+                                  ('sc', datetime.date(2008, 1, 3), 'Papa', 'Holandesa'),
+                                  ('sc', datetime.date(2008, 1, 2), 'Tomate', 'Perita'),
+                                  ]
+    assert latest['precio_mayorista_val'].tolist() == [25, 105, 50]
+
+    assert store.latest_prices(producto='Papa').shape[0] == 1
+    assert store.latest_prices(cities=[City.CAMIRI]).empty
+
+
+def test_blank_variedad():
+    csv = MARKET_PRICES_CSV + '04/01/2008,Papa,,110 Bs.-/qq,2 Bs.-/Libra,Cochabamba,\n'
+    df = prepared(csv)
+    assert df.index.get_level_values('variedad').isnull().any()
+
+    aggregates = PriceAggregates(PriceStore())
+    assert aggregates.ingest(City.SANTA_CRUZ, df) == 5
+
+    history = aggregates.store.price_history('Papa')
+    assert history.shape[0] == 3
+    assert pd.isnull(history.index[-1][3])
+    assert history['precio_mayorista_val'].tolist() == [100, 105, 110]
+
+    assert aggregates.series('Papa').index.get_level_values('variedad').isnull().sum() == 1
+    assert aggregates.store.latest_prices(producto='Papa').shape[0] == 2
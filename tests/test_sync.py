@@ -0,0 +1,115 @@
+import datetime
+import time
+
+import pandas as pd
+
+from opendatabo.sic import City, Year, get_market_prices
+from opendatabo.sync import PartitionStore
+
+from conftest import MARKET_PRICES_CSV, sic_stub_path
+
+
+def test_sync_only_fetches_mutable_partitions(sic_stub, tmpdir):
+    current = Year.current()
+    years = [Year(2008), Year(2009), current]
+
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2008)), MARKET_PRICES_CSV)
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2009)), '', status=302)
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, current), MARKET_PRICES_CSV.replace('/2008', '/{}'.format(current.value)))
+
+    store = PartitionStore(str(tmpdir))
+    report = store.sync(cities=[City.SANTA_CRUZ], years=years)
+
+    assert sorted(y.value for _, y in report.changed) == [2008, current.value]
+    assert [y.value for _, y in report.unavailable] == [2009]
+    assert report.changed_cities == [City.SANTA_CRUZ]
+    assert len(sic_stub.requests) == 3
+
+    # Fresh store on the same directory: closed years are not fetched again, the running year may be
+    store = PartitionStore(str(tmpdir))
+    current_entry = store.entry(City.SANTA_CRUZ, current)
+    current_entry['fetched_at'] -= Year.CURRENT_CACHE_TTL
+
+    report = store.sync(cities=[City.SANTA_CRUZ], years=years)
+
+    assert [y.value for _, y in report.skipped] == [2008, 2009]
+    assert [y.value for _, y in report.unchanged] == [current.value]
+    assert report.changed_cities == []
+    assert len(sic_stub.requests) == 4
+
+    full_df = store.load_city(City.SANTA_CRUZ)
+    assert full_df.shape[0] == 8
+    assert full_df.index.is_monotonic_increasing
+
+
+def test_partition_round_trip(sic_stub, tmpdir):
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2008)), MARKET_PRICES_CSV)
+    df = get_market_prices(City.SANTA_CRUZ, Year(2008))
+
+    store = PartitionStore(str(tmpdir))
+    assert store.store(City.SANTA_CRUZ, Year(2008), df)
+    assert not store.store(City.SANTA_CRUZ, Year(2008), df)
+
+    pd.testing.assert_frame_equal(store.load_partition(City.SANTA_CRUZ, Year(2008)), df.sort_index())
+
+
+def test_needs_refresh_after_new_year(tmpdir):
+    store = PartitionStore(str(tmpdir))
+    year = Year(2008)
+    new_year = time.mktime(datetime.datetime(2009, 1, 1).timetuple())
+
+    # Last fetched in December, before the year closed: its final rows are still missing
+    store.manifest = {'sc': {'2008': {'status': 'ok', 'fetched_at': new_year - 7 * 24 * 60 * 60}}}
+    assert store.needs_refresh(City.SANTA_CRUZ, year)
+
+    store.manifest['sc']['2008']['fetched_at'] = new_year + 60
+    assert not store.needs_refresh(City.SANTA_CRUZ, year)
+
+
+def test_unavailable_partitions_are_retried(sic_stub, tmpdir):
+    path = sic_stub_path(City.SANTA_CRUZ, Year(2008))
+    sic_stub.add(path, 'Not Found', status=404)
+
+    store = PartitionStore(str(tmpdir))
+    report = store.sync(cities=[City.SANTA_CRUZ], years=[Year(2008)])
+    assert report.unavailable == [(City.SANTA_CRUZ, Year(2008))]
+
+    fetched_at = store.entry(City.SANTA_CRUZ, Year(2008))['fetched_at']
+    assert not store.needs_refresh(City.SANTA_CRUZ, Year(2008))
+    assert store.needs_refresh(City.SANTA_CRUZ, Year(2008), now=fetched_at + PartitionStore.UNAVAILABLE_RETRY_TTL)
+
+    # Once the site answers again, the year is fetched
+    sic_stub.add(path, MARKET_PRICES_CSV)
+    store.entry(City.SANTA_CRUZ, Year(2008))['fetched_at'] -= PartitionStore.UNAVAILABLE_RETRY_TTL
+    report = store.sync(cities=[City.SANTA_CRUZ], years=[Year(2008)])
+    assert report.changed == [(City.SANTA_CRUZ, Year(2008))]
+    assert store.years(City.SANTA_CRUZ) == [Year(2008)]
+
+
+def test_failed_fetch_keeps_stored_partition(sic_stub, tmpdir):
+    path = sic_stub_path(City.SANTA_CRUZ, Year(2008))
+    sic_stub.add(path, MARKET_PRICES_CSV)
+
+    store = PartitionStore(str(tmpdir))
+    store.sync(cities=[City.SANTA_CRUZ], years=[Year(2008)])
+
+    # Neither an outage nor a missing export takes away a year already stored
+    for status in (503, 404):
+        sic_stub.add(path, 'Unavailable', status=status)
+        report = store.sync(cities=[City.SANTA_CRUZ], years=[Year(2008)], force=True)
+
+        assert report.unavailable == []
+        assert [(city, year) for city, year, _ in report.failed] == [(City.SANTA_CRUZ, Year(2008))]
+        assert store.years(City.SANTA_CRUZ) == [Year(2008)]
+        assert store.load_city(City.SANTA_CRUZ).shape[0] == 4
+
+
+def test_outage_is_not_unavailable(sic_stub, tmpdir):
+    sic_stub.add(sic_stub_path(City.SANTA_CRUZ, Year(2008)), 'Internal Server Error', status=500)
+
+    store = PartitionStore(str(tmpdir))
+    report = store.sync(cities=[City.SANTA_CRUZ], years=[Year(2008)])
+
+    assert report.unavailable == []
+    assert len(report.failed) == 1
+    assert store.needs_refresh(City.SANTA_CRUZ, Year(2008))
@@ -0,0 +1,129 @@
+import json
+import os
+import zipfile
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+from opendatabo.cruzero import BusLine
+from opendatabo.tiles import lnglat_to_world, world_to_lnglat, tile_bounds, clip_polyline, render_tiles, \
+    write_tiles
+
+
+def _lines():
+    rng = np.random.RandomState(0)
+    lines = []
+    for i in range(3):
+        coords = np.array([-63.18, -17.78]) + np.cumsum(rng.uniform(-0.0004, 0.0005, size=(400, 2)), axis=0)
+        lines.append(BusLine(i + 1, 'Linea {}'.format(i + 1), Decimal('18.5'), Decimal('21.3'), Decimal('75'),
+                             coords=coords.round(7)))
+    return lines
+
+
+def test_world_round_trip():
+    coords = np.array([[-63.18, -17.78], [0.0, 0.0], [179.0, 80.0]])
+    np.testing.assert_allclose(world_to_lnglat(lnglat_to_world(coords)), coords, atol=1e-9)
+
+    np.testing.assert_allclose(lnglat_to_world(np.array([[0.0, 0.0]])), [[0.5, 0.5]])
+
+    west, south, east, north = tile_bounds(1, 0, 0)
+    assert (west, east) == (-180.0, 0.0)
+    assert south == pytest.approx(0.0)
+    assert north == pytest.approx(85.0511287798)
+
+
+def test_clip_polyline():
+    xy = np.array([[0.5, 0.5], [1.5, 0.5], [1.5, 1.5], [0.5, 1.5], [0.5, 0.8]])
+
+    parts = clip_polyline(xy, (0, 0), (1, 1))
+
+    assert len(parts) == 2
+    np.testing.assert_allclose(parts[0], [[0.5, 0.5], [1.0, 0.5]])
+    np.testing.assert_allclose(parts[1], [[0.5, 1.0], [0.5, 0.8]])
+
+    # A route wholly inside stays in one piece, with every vertex
+    np.testing.assert_allclose(clip_polyline(xy, (0, 0), (2, 2))[0], xy)
+    assert clip_polyline(xy, (5, 5), (6, 6)) == []
+
+
+def test_render_tiles():
+    lines = _lines()
+
+    tiles = list(render_tiles(lines, min_zoom=10, max_zoom=15, processes=1))
+    by_zoom = {}
+    for z, x, y, data in tiles:
+        by_zoom.setdefault(z, []).append(json.loads(data.decode('utf-8')))
+
+    assert sorted(by_zoom) == list(range(10, 16))
+    assert len(by_zoom[15]) > len(by_zoom[10])
+
+    def vertices(collections):
+        return sum(len(c) for fc in collections for f in fc['features']
+                   for c in ([f['geometry']['coordinates']] if f['geometry']['type'] == 'LineString'
+                             else f['geometry']['coordinates']))
+
+    # Low zooms draw the same routes with fewer vertices
+    assert vertices(by_zoom[10]) < vertices(by_zoom[15])
+
+    feature = by_zoom[10][0]['features'][0]
+    assert feature['id'] == 1
+    assert feature['properties'] == {'line_id': 1, 'name': 'Linea 1', 'speed': 18.5, 'distance': 21.3,
+                                     'total_time': 75.0}
+
+    # Every tile only holds geometry within its bounds, plus the buffer
+    for z, x, y, data in tiles:
+        west, south, east, north = tile_bounds(z, x, y)
+        margin = (east - west) * 8 / 256 + 1e-6
+        for f in json.loads(data.decode('utf-8'))['features']:
+            coords = f['geometry']['coordinates']
+            points = np.array(coords if f['geometry']['type'] == 'LineString' else sum(coords, []))
+            assert (points[:, 0] >= west - margin).all() and (points[:, 0] <= east + margin).all()
+
+
+def test_render_tiles_processes():
+    lines = _lines()
+
+    serial = list(render_tiles(lines, min_zoom=12, max_zoom=14, processes=1))
+    parallel = list(render_tiles(lines, min_zoom=12, max_zoom=14, processes=2, batch_size=4))
+
+    assert parallel == serial
+
+
+def test_write_tiles(tmpdir):
+    lines = _lines()
+    directory = str(tmpdir.join('tiles'))
+    archive = str(tmpdir.join('tiles.zip'))
+
+    stats = write_tiles(lines, directory, min_zoom=11, max_zoom=13, processes=1)
+    write_tiles(lines, archive, min_zoom=11, max_zoom=13, processes=1)
+
+    with zipfile.ZipFile(archive) as z:
+        names = sorted(z.namelist())
+        assert len(names) == sum(stats.tiles.values()) + 1
+
+        for name in names:
+            with open(os.path.join(directory, *name.split('/')), 'rb') as f:
+                assert f.read() == z.read(name)
+
+    with open(os.path.join(directory, 'tiles.json')) as f:
+        tilejson = json.load(f)
+    assert (tilejson['minzoom'], tilejson['maxzoom']) == (11, 13)
+    assert tilejson['tiles'] == ['{z}/{x}/{y}.geojson']
+
+
+def test_write_tiles_drops_stale_tiles(tmpdir):
+    lines = _lines()
+    directory = str(tmpdir.join('tiles'))
+
+    def written():
+        return sorted(os.path.relpath(os.path.join(root, name), directory)
+                      for root, _, names in os.walk(directory) for name in names)
+
+    write_tiles(lines, directory, min_zoom=11, max_zoom=13, processes=1)
+    stats = write_tiles(lines[:1], directory, min_zoom=11, max_zoom=11, processes=1)
+
+    # Only the tiles of the last run are left, and nothing is left aside
+    assert len(written()) == sum(stats.tiles.values()) + 1
+    assert all(name.startswith('11' + os.sep) for name in written() if name != 'tiles.json')
+    assert sorted(os.listdir(str(tmpdir))) == ['tiles']